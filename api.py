@@ -0,0 +1,56 @@
+"""
+MedVault JSON API Helpers
+Field selection, serialization and ETags for the /api/v1 routes in app.py.
+Those routes read plain column rows, never ORM objects, and hand them here
+to be written out as JSON.
+
+Collections are tagged with a digest of the version counters their rows
+depend on (see migrations.py) rather than of their content, so a client
+polling with If-None-Match is answered 304 before any row is read.
+"""
+
+import hashlib
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None  # json gives the same output, only slower
+
+
+class FieldError(ValueError):
+    """?fields= named a field the resource does not have"""
+
+
+def selected_fields(available, requested):
+    """Names picked by a comma-separated ?fields= value, in the order given; all of `available` by default"""
+    names = list(dict.fromkeys(name.strip() for name in (requested or '').split(',') if name.strip()))
+    if not names:
+        return list(available)
+    unknown = [name for name in names if name not in available]
+    if unknown:
+        raise FieldError(f"Unknown field(s) {', '.join(unknown)}; choose from {', '.join(available)}")
+    return names
+
+
+def as_dicts(names, rows):
+    """Rows whose leading columns are `names` -> one dict per row"""
+    return [dict(zip(names, row)) for row in rows]
+
+
+def _isoformat(value):
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+def dumps(value):
+    """Compact JSON as bytes; dates and times in ISO 8601"""
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, separators=(',', ':'), default=_isoformat).encode()
+
+
+def collection_etag(*parts):
+    """ETag for a collection from everything its content depends on"""
+    return hashlib.blake2b(repr(parts).encode(), digest_size=12).hexdigest()
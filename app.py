@@ -3,24 +3,91 @@ MedVault: Appointment Booking & Medical Records Management System
 Senior Project Implementation with Professional Design
 """
 
-from flask import Flask, render_template, request, session, redirect, url_for, flash, send_from_directory
+from flask import Flask, Request, render_template, request, session, redirect, url_for, flash, jsonify, abort, send_file
 from flask_sqlalchemy import SQLAlchemy
-from flask_mail import Mail, Message
+from flask_mail import Mail
+from sqlalchemy import and_, delete, event, func, insert, inspect, or_, update
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import joinedload
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from werkzeug.security import generate_password_hash, check_password_hash
-from werkzeug.utils import secure_filename
+from werkzeug.security import safe_join
+from werkzeug.utils import secure_filename, send_file as send_file_with_environ
+from collections import namedtuple
+from itertools import islice
+from operator import attrgetter
 from datetime import datetime, timedelta
+import base64
+import hmac
+import io
+import json
+import math
 import random
+import re
+import secrets
+import sqlite3
 import string
+import threading
+import time
 import os
 
+from blobstore import BlobStore
+from cache import MISSING, FragmentCacheExtension, LazyList, SharedStamp, TTLCache, VersionedCache
+from encryption import is_encrypted, keyring_from_config
+import events as live_events
+from migrations import run_migrations
+from otpstore import store_from_config
+from outbox import OutboxSender
+from previews import PreviewPool
+from sqlstats import SQLStats
+import api
+import metrics
+import slots
+
+class MedVaultRequest(Request):
+    """Spools file uploads into the blob store, hashing them on the way"""
+    
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return upload_store().spool()
+
 # Configuration
 app = Flask(__name__)
+app.request_class = MedVaultRequest
 app.secret_key = 'medvault_secret_key_2024'  # Change in production
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///medvault.db'
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('MEDVAULT_DATABASE_URI', 'sqlite:///medvault.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['UPLOAD_FOLDER'] = 'static/uploads'
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
 
+# SQLite waits this long for a lock before reporting the database busy,
+# then write paths retry a few times with backoff
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'connect_args': {'timeout': 15}}
+DB_BUSY_RETRIES = 5
+
+# Keyset pagination for list pages (?cursor=...&limit=...)
+PAGE_SIZE = 25
+PAGE_SIZE_MAX = 100
+
+# Dashboards show this many of the newest unread notifications; /notifications pages through all of them
+NOTIFICATION_FEED_SIZE = 10
+
+# Most doctors a search returns, best match first
+SEARCH_RESULTS = 50
+SEARCH_FILTERS = ('specialization', 'location', 'min_fee', 'max_fee', 'min_experience', 'hospital_id')
+
+# Nearest-doctor search (?lat=&lon=&radius=), radius in km
+NEAR_RADIUS_KM = 25
+NEAR_RADIUS_MAX_KM = 500
+
+# Preview widths in pixels; previews of a blob never change
+PREVIEW_SIZES = {'small': 320, 'medium': 640, 'large': 1280}
+PREVIEW_MAX_AGE = 365 * 24 * 3600
+
+# Limits for the /api/slots endpoint
+MAX_SLOT_DOCTORS = 100
+MAX_SLOT_DAYS = 60
+
 # Email Configuration
 app.config['MAIL_SERVER'] = 'smtp.gmail.com'
 app.config['MAIL_PORT'] = 587
@@ -29,11 +96,125 @@ app.config['MAIL_USERNAME'] = 'your_email@gmail.com'  # Configure with your emai
 app.config['MAIL_PASSWORD'] = 'your_app_password'      # Configure with app password
 app.config['MAIL_DEFAULT_SENDER'] = 'MedVault <noreply@medvault.com>'
 
+# Email Outbox: background sender threads per worker process (0 = run outbox.py instead)
+app.config['OUTBOX_WORKERS'] = int(os.environ.get('MEDVAULT_OUTBOX_WORKERS', 1))
+app.config['OUTBOX_BATCH_SIZE'] = 50
+app.config['OUTBOX_MAX_ATTEMPTS'] = 6
+app.config['OUTBOX_RETRY_BASE_SECONDS'] = 30
+
+# One-time codes: 'sql' (otp_code table), 'memory' (single worker only) or a
+# redis:// URL. A code lives OTP_TTL seconds and is burnt after
+# OTP_MAX_ATTEMPTS wrong guesses; expired ones are swept every OTP_SWEEP_INTERVAL
+# seconds (0 = no sweeper in this process).
+app.config['OTP_STORE'] = os.environ.get('MEDVAULT_OTP_STORE', 'sql')
+app.config['OTP_TTL'] = 600
+app.config['OTP_MAX_ATTEMPTS'] = 5
+app.config['OTP_SWEEP_INTERVAL'] = int(os.environ.get('MEDVAULT_OTP_SWEEP_INTERVAL', 300))
+
+# Session checks: how long a user's security version is cached, and the file
+# workers touch to tell each other to drop their cached versions
+app.config['SECURITY_CACHE_TTL'] = 300
+app.config['SECURITY_STAMP_FILE'] = os.environ.get(
+    'MEDVAULT_SECURITY_STAMP', os.path.join(app.instance_path, 'security.stamp'))
+
+# Public pages (welcome, about, contact) are rendered once per PAGE_CACHE_TTL
+# seconds in each worker. A doctor search is cached for SEARCH_CACHE_TTL once
+# it was asked SEARCH_CACHE_MIN_HITS times within that window, so popular
+# searches stay cached and one-off ones don't crowd them out.
+app.config['PAGE_CACHE_TTL'] = 300
+app.config['SEARCH_CACHE_TTL'] = 60
+app.config['SEARCH_CACHE_MIN_HITS'] = 2
+
+# Dashboard fragments are keyed on the user's data versions, so a change shows
+# at once; the TTL bounds how long a renamed doctor or patient keeps the old name
+app.config['FRAGMENT_CACHE_TTL'] = 600
+app.config['FRAGMENT_CACHE_SIZE'] = 20000
+
+# Doctor/hospital directory snapshot: how often each worker checks the
+# database version counter for profile changes made by other workers
+app.config['DIRECTORY_CHECK_INTERVAL'] = 2.0
+
+# SQL instrumentation: requests slower than this go to the slow log with their
+# slowest statements; per-endpoint totals are served at /internal/sql-stats
+# to callers sending SQL_STATS_TOKEN in X-Stats-Token (the route is disabled without one)
+app.config['SQL_SLOW_REQUEST_MS'] = int(os.environ.get('MEDVAULT_SLOW_REQUEST_MS', 500))
+app.config['SQL_SLOW_LOG'] = os.environ.get('MEDVAULT_SLOW_LOG', os.path.join(app.root_path, 'app.log'))
+app.config['SQL_STATS_TOKEN'] = os.environ.get('MEDVAULT_STATS_TOKEN', '')
+
+# Prometheus scrapes /metrics; when set, it must send "Authorization: Bearer <token>"
+app.config['METRICS_TOKEN'] = os.environ.get('MEDVAULT_METRICS_TOKEN', '')
+
+# Record downloads are sent by the worker by default. Set DOWNLOAD_OFFLOAD to
+# 'x-accel-redirect' (nginx) or 'x-sendfile' (Apache mod_xsendfile, lighttpd)
+# to have the front proxy send the bytes instead. For nginx the prefix must be
+# an internal location serving UPLOAD_FOLDER:
+#     location /_protected_uploads/ { internal; alias /srv/medvault/static/uploads/; }
+app.config['DOWNLOAD_OFFLOAD'] = os.environ.get('MEDVAULT_DOWNLOAD_OFFLOAD', '').lower()
+app.config['DOWNLOAD_ACCEL_PREFIX'] = os.environ.get('MEDVAULT_DOWNLOAD_ACCEL_PREFIX', '/_protected_uploads/')
+
+# Record previews: rendered by low-priority processes in each web worker
+# (0 = none; run previews.py instead). Jobs beyond PREVIEW_MAX_PENDING are
+# dropped and rendered when first viewed.
+app.config['PREVIEW_WORKERS'] = int(os.environ.get('MEDVAULT_PREVIEW_WORKERS', 1))
+app.config['PREVIEW_MAX_PENDING'] = 50
+app.config['PREVIEW_NICE'] = 10
+
+# Live events: dashboards open EVENTS_URL, served by events.py listening on
+# EVENTS_BIND (TCP for clients, UDP for commit wake-ups), to hear about new
+# notifications and appointment changes. Unset = off, nothing is recorded.
+app.config['EVENTS_URL'] = os.environ.get('MEDVAULT_EVENTS_URL', '')
+app.config['EVENTS_BIND'] = os.environ.get('MEDVAULT_EVENTS_BIND', '127.0.0.1:5002')
+
+# Encryption at rest for uploaded files: comma-separated base64 master keys,
+# the first encrypts new uploads (python encryption.py genkey). Unset = off.
+app.config['ENCRYPTION_KEYS'] = os.environ.get('MEDVAULT_ENCRYPTION_KEYS', '')
+
 # Ensure upload directory exists
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
 db = SQLAlchemy(app)
 mail = Mail(app)
+sql_stats = SQLStats(app)
+metrics.init_app(app)
+_outbox_start_lock = threading.Lock()
+user_security_cache = TTLCache(ttl=app.config['SECURITY_CACHE_TTL'])
+page_cache = TTLCache(ttl=app.config['PAGE_CACHE_TTL'], maxsize=1000)
+page_hits = TTLCache(ttl=app.config['SEARCH_CACHE_TTL'])
+fragment_cache = TTLCache(ttl=app.config['FRAGMENT_CACHE_TTL'], maxsize=app.config['FRAGMENT_CACHE_SIZE'])
+app.jinja_env.add_extension(FragmentCacheExtension)
+app.jinja_env.fragment_cache = fragment_cache
+security_stamp = SharedStamp(app.config['SECURITY_STAMP_FILE'])
+preview_pool = PreviewPool(workers=app.config['PREVIEW_WORKERS'], max_pending=app.config['PREVIEW_MAX_PENDING'],
+                           nice=app.config['PREVIEW_NICE'])
+
+def _sql_math(function):
+    def call(value):
+        if value is None:
+            return None
+        try:
+            return function(value)
+        except ValueError:
+            return None  # Out of domain, e.g. acos(2): NULL, as SQLite's own
+    return call
+
+def add_sqlite_math(dbapi_connection):
+    """Python versions of the SQLite math functions nearest_doctors uses"""
+    for name in ('acos', 'cos', 'radians', 'sin'):
+        dbapi_connection.create_function(name, 1, _sql_math(getattr(math, name)), deterministic=True)
+
+@event.listens_for(Engine, 'connect')
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """WAL lets readers proceed while a booking holds the write lock"""
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        try:
+            cursor.execute('SELECT acos(1), cos(0), radians(0), sin(0)')
+        except sqlite3.OperationalError:
+            # SQLite built without SQLITE_ENABLE_MATH_FUNCTIONS (before 3.35, or some distributions)
+            add_sqlite_math(dbapi_connection)
+        cursor.close()
 
 # ==================== DATABASE MODELS ====================
 
@@ -46,12 +227,18 @@ class User(db.Model):
     is_verified = db.Column(db.Boolean, default=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     last_login = db.Column(db.DateTime, nullable=True)
+    security_version = db.Column(db.Integer, nullable=False, default=1)  # bump to end all sessions
+    unread_notifications = db.Column(db.Integer, nullable=False, default=0)  # kept by triggers, see migrations.py
+    # Bumped by triggers whenever anything the user is shown changes
+    appointments_version = db.Column(db.Integer, nullable=False, default=0)
+    records_version = db.Column(db.Integer, nullable=False, default=0)
+    notifications_version = db.Column(db.Integer, nullable=False, default=0)
     
     # Relationships
     patient = db.relationship('Patient', backref='user', uselist=False, cascade='all, delete-orphan')
     doctor = db.relationship('Doctor', backref='user', uselist=False, cascade='all, delete-orphan')
     hospital = db.relationship('Hospital', backref='user', uselist=False, cascade='all, delete-orphan')
-    otps = db.relationship('OTP', backref='user', cascade='all, delete-orphan')
+    otp_codes = db.relationship('OTPCode', cascade='all, delete-orphan')
     
     def set_password(self, password):
         self.password_hash = generate_password_hash(password, method='pbkdf2:sha256')
@@ -59,18 +246,14 @@ class User(db.Model):
     def check_password(self, password):
         return check_password_hash(self.password_hash, password)
 
-class OTP(db.Model):
-    """OTP Verification Model"""
-    id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    otp_code = db.Column(db.String(6), nullable=False)
-    purpose = db.Column(db.String(20), nullable=False)  # registration, login, reset
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    expires_at = db.Column(db.DateTime, nullable=False)
-    is_used = db.Column(db.Boolean, default=False)
-    
-    def is_valid(self):
-        return not self.is_used and datetime.utcnow() < self.expires_at
+class OTPCode(db.Model):
+    """Live one-time code of a user for one purpose (otpstore.SQLOTPStore)"""
+    __tablename__ = 'otp_code'
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    purpose = db.Column(db.String(20), primary_key=True)  # registration, login
+    code_hash = db.Column(db.String(64), nullable=False)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
 
 class Patient(db.Model):
     """Patient Profile Model"""
@@ -108,6 +291,11 @@ class Doctor(db.Model):
     consultation_fee = db.Column(db.Float, default=0.0)
     is_available = db.Column(db.Boolean, default=True)
     
+    __table_args__ = (
+        db.Index('ix_doctor_available_specialization', 'is_available', 'specialization'),
+        db.Index('ix_doctor_hospital', 'hospital_id'),
+    )
+    
     # Relationships
     hospital = db.relationship('Hospital', backref='doctors')
     appointments = db.relationship('Appointment', backref='doctor', lazy='dynamic')
@@ -124,6 +312,9 @@ class Hospital(db.Model):
     description = db.Column(db.Text, nullable=True)
     logo = db.Column(db.String(200), nullable=True)
     emergency_number = db.Column(db.String(20), nullable=True)
+    # Filled from the address by geocode.py; mirrored into the hospital_location R*Tree
+    latitude = db.Column(db.Float, nullable=True)
+    longitude = db.Column(db.Float, nullable=True)
     
     # Relationships
     departments = db.relationship('Department', backref='hospital', cascade='all, delete-orphan')
@@ -144,6 +335,10 @@ class DoctorAvailability(db.Model):
     start_time = db.Column(db.Time, nullable=False)
     end_time = db.Column(db.Time, nullable=False)
     is_available = db.Column(db.Boolean, default=True)
+    
+    __table_args__ = (
+        db.Index('ix_doctor_availability_doctor_day', 'doctor_id', 'day_of_week'),
+    )
 
 class Appointment(db.Model):
     """Appointment Booking Model"""
@@ -158,6 +353,17 @@ class Appointment(db.Model):
     notes = db.Column(db.Text, nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    __table_args__ = (
+        db.Index('ix_appointment_patient_date', 'patient_id', 'appointment_date'),
+        db.Index('ix_appointment_doctor_date', 'doctor_id', 'appointment_date'),
+        db.Index('ix_appointment_hospital_date', 'hospital_id', 'appointment_date'),
+        db.Index('ix_appointment_doctor_patient', 'doctor_id', 'patient_id'),
+        db.Index('ix_appointment_hospital_patient', 'hospital_id', 'patient_id'),
+        # A slot can only be held by one appointment that is not cancelled
+        db.Index('uq_appointment_active_slot', 'doctor_id', 'appointment_date', 'appointment_time',
+                 unique=True, sqlite_where=db.text("status != 'cancelled'")),
+    )
 
 class MedicalRecord(db.Model):
     """Medical Records Storage"""
@@ -166,12 +372,63 @@ class MedicalRecord(db.Model):
     record_type = db.Column(db.String(50), nullable=False)  # prescription, lab_result, scan, report
     title = db.Column(db.String(200), nullable=False)
     description = db.Column(db.Text, nullable=True)
-    file_path = db.Column(db.String(300), nullable=True)
+    file_path = db.Column(db.String(300), nullable=True)  # blobs/ab/cd/<sha256> below UPLOAD_FOLDER
+    file_name = db.Column(db.String(255), nullable=True)  # As uploaded, for downloads
     record_date = db.Column(db.Date, default=datetime.utcnow)
     uploaded_by = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     is_shared = db.Column(db.Boolean, default=False)
-    shared_with = db.Column(db.String(500), nullable=True)  # Comma-separated doctor IDs
+    
+    __table_args__ = (
+        db.Index('ix_medical_record_patient_created', 'patient_id', 'created_at'),
+    )
+    
+    # Relationships
+    shares = db.relationship('RecordShare', backref='record', cascade='all, delete-orphan')
+
+class Blob(db.Model):
+    """Stored Upload Content, Shared by Every Record with the Same File"""
+    sha256 = db.Column(db.String(64), primary_key=True)
+    size = db.Column(db.BigInteger, nullable=False)
+    ref_count = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        db.Index('ix_blob_ref_count_updated', 'ref_count', 'updated_at'),
+    )
+
+# Records take and release blob references in the same flush that writes them
+@event.listens_for(MedicalRecord, 'after_insert')
+def reference_blob(mapper, connection, record):
+    digest = BlobStore.digest_of(record.file_path)
+    if digest:
+        now = datetime.utcnow()
+        size = upload_store().size(digest)
+        connection.execute(sqlite_insert(Blob).values(sha256=digest, size=size, ref_count=1, created_at=now,
+                                                      updated_at=now).on_conflict_do_update(
+            index_elements=['sha256'], set_={'ref_count': Blob.ref_count + 1, 'updated_at': now}
+        ))
+
+@event.listens_for(MedicalRecord, 'after_delete')
+def release_blob(mapper, connection, record):
+    digest = BlobStore.digest_of(record.file_path)
+    if digest:
+        connection.execute(update(Blob).where(Blob.sha256 == digest).values(
+            ref_count=Blob.ref_count - 1, updated_at=datetime.utcnow()))
+
+class RecordShare(db.Model):
+    """Medical Record shared with a Doctor"""
+    id = db.Column(db.Integer, primary_key=True)
+    record_id = db.Column(db.Integer, db.ForeignKey('medical_record.id'), nullable=False)
+    doctor_id = db.Column(db.Integer, db.ForeignKey('doctor.id'), nullable=False)
+    shared_at = db.Column(db.DateTime, default=datetime.utcnow)
+    expires_at = db.Column(db.DateTime, nullable=True)  # None = until revoked
+    
+    __table_args__ = (
+        db.UniqueConstraint('record_id', 'doctor_id', name='uq_record_share'),
+        db.Index('ix_record_share_doctor', 'doctor_id', 'shared_at'),
+    )
 
 class Prescription(db.Model):
     """Prescription Model"""
@@ -195,36 +452,145 @@ class Notification(db.Model):
     notification_type = db.Column(db.String(50), nullable=False)  # appointment, reminder, alert
     is_read = db.Column(db.Boolean, default=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        db.Index('ix_notification_user_unread', 'user_id', 'is_read', 'created_at'),
+        db.Index('ix_notification_user_created', 'user_id', 'created_at'),
+    )
+
+class LiveEvent(db.Model):
+    """Change pushed to a user's open pages by the live event server (events.py)"""
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, nullable=False)
+    kind = db.Column(db.String(30), nullable=False)  # notification, appointment
+    payload = db.Column(db.Text, nullable=False)  # JSON
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    
+    __table_args__ = (
+        db.Index('ix_live_event_user', 'user_id', 'id'),
+    )
+
+class EmailOutbox(db.Model):
+    """Outgoing Email Queue, delivered by the background OutboxSender"""
+    id = db.Column(db.Integer, primary_key=True)
+    recipient = db.Column(db.String(120), nullable=False)
+    subject = db.Column(db.String(200), nullable=False)
+    body = db.Column(db.Text, nullable=False)
+    status = db.Column(db.String(20), default='pending')  # pending, sending, sent, dead
+    attempts = db.Column(db.Integer, default=0)
+    next_attempt_at = db.Column(db.DateTime, default=datetime.utcnow)
+    claimed_by = db.Column(db.String(32), nullable=True)
+    claimed_at = db.Column(db.DateTime, nullable=True)
+    last_error = db.Column(db.String(500), nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    sent_at = db.Column(db.DateTime, nullable=True)
+    
+    __table_args__ = (
+        db.Index('ix_email_outbox_due', 'status', 'next_attempt_at'),
+        db.Index('ix_email_outbox_claim', 'claimed_by'),
+    )
+
+class CacheVersion(db.Model):
+    """Version Counters for Data Cached in Every Worker"""
+    name = db.Column(db.String(50), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+outbox_sender = OutboxSender(
+    app, db, EmailOutbox, mail,
+    workers=app.config['OUTBOX_WORKERS'],
+    batch_size=app.config['OUTBOX_BATCH_SIZE'],
+    max_attempts=app.config['OUTBOX_MAX_ATTEMPTS'],
+    retry_base_seconds=app.config['OUTBOX_RETRY_BASE_SECONDS'],
+)
+otp_store = store_from_config(app, db, OTPCode)
+
+def live_event_rows(session):
+    """live_event rows for the notifications and appointment status changes a flush writes"""
+    rows = []
+    for obj in session.new:
+        if isinstance(obj, Notification):
+            rows.append({'user_id': obj.user_id, 'kind': 'notification', 'payload': json.dumps({
+                'id': obj.id, 'title': obj.title, 'message': obj.message, 'type': obj.notification_type,
+                'created_at': obj.created_at.isoformat(),
+            })})
+    for obj in list(session.new) + list(session.dirty):
+        if not isinstance(obj, Appointment):
+            continue
+        if obj not in session.new and not inspect(obj).attrs.status.history.has_changes():
+            continue
+        payload = json.dumps({
+            'id': obj.id, 'status': obj.status, 'date': obj.appointment_date.isoformat(),
+            'time': obj.appointment_time.strftime('%H:%M'), 'doctor_id': obj.doctor_id, 'patient_id': obj.patient_id,
+        })
+        users = session.connection().execute(db.select(
+            db.select(Patient.user_id).where(Patient.id == obj.patient_id).scalar_subquery(),
+            db.select(Doctor.user_id).where(Doctor.id == obj.doctor_id).scalar_subquery(),
+        )).one()
+        rows.extend({'user_id': user_id, 'kind': 'appointment', 'payload': payload}
+                    for user_id in set(users) if user_id is not None)
+    return rows
+
+@event.listens_for(db.session, 'after_flush')
+def record_live_events(session, flush_context):
+    """Write live events in the transaction that made the changes, so they go out only if it commits"""
+    if not app.config['EVENTS_URL']:
+        return
+    rows = live_event_rows(session)
+    if rows:
+        now = datetime.utcnow()
+        session.connection().execute(insert(LiveEvent), [dict(row, created_at=now) for row in rows])
+        session.info['live_events'] = True
+
+@event.listens_for(db.session, 'after_commit')
+def wake_live_events(session):
+    if session.info.pop('live_events', False):
+        live_events.wake(live_events.parse_address(app.config['EVENTS_BIND']))
+
+@event.listens_for(db.session, 'after_rollback')
+def drop_live_events(session):
+    session.info.pop('live_events', None)
 
 # ==================== HELPER FUNCTIONS ====================
 
 def generate_otp(length=6):
     """Generate random OTP"""
-    return ''.join(random.choices(string.digits, k=length))
+    return ''.join(secrets.choice(string.digits) for _ in range(length))
+
+def issue_otp(user_id, purpose):
+    """Make a new code the user's only live one for `purpose` and return it"""
+    otp_code = generate_otp()
+    otp_store.issue(user_id, purpose, otp_code, app.config['OTP_TTL'])
+    return otp_code
+
+def enqueue_email(recipient, subject, body):
+    """Queue an email for the background sender.
+    
+    The row is added to the current session, so the email goes out only if
+    the caller's transaction commits. Call outbox_sender.wake() afterwards.
+    """
+    db.session.add(EmailOutbox(recipient=recipient, subject=subject, body=body))
 
 def send_otp_email(email, otp, purpose):
-    """Send OTP via email"""
+    """Queue OTP email; delivered by the outbox sender once the caller commits"""
     subject = f"MedVault - OTP for {purpose.title()}"
     body = f"""
     Your OTP for {purpose.title()} on MedVault is: {otp}
     
-    This OTP is valid for 10 minutes. Please do not share this OTP with anyone.
+    This OTP is valid for {app.config['OTP_TTL'] // 60} minutes. Please do not share this OTP with anyone.
     
     If you did not request this, please ignore this email.
     
     Best regards,
     MedVault Team
     """
-    try:
-        msg = Message(subject, recipients=[email], body=body)
-        mail.send(msg)
-        return True
-    except Exception as e:
-        print(f"Email sending failed: {e}")
-        return False
-
-def create_notification(user_id, title, message, notif_type='info'):
-    """Create a notification for user"""
+    enqueue_email(email, subject, body)
+
+def create_notification(user_id, title, message, notif_type='info', email_to=None):
+    """Create a notification for user, optionally emailing it to `email_to` as well.
+    
+    Does not commit, the caller owns the transaction; the user's unread
+    count goes up with it. Call outbox_sender.wake() after committing an email.
+    """
     notification = Notification(
         user_id=user_id,
         title=title,
@@ -232,31 +598,673 @@ def create_notification(user_id, title, message, notif_type='info'):
         notification_type=notif_type
     )
     db.session.add(notification)
+    if email_to:
+        enqueue_email(email_to, f"MedVault - {title}", message)
+    return notification
+
+def unread_notification_count(user_id):
+    """The user's unread notifications, read off the counter rather than counted"""
+    return db.session.execute(
+        db.select(User.unread_notifications).where(User.id == user_id)
+    ).scalar() or 0
+
+def notification_feed(user_id, limit=NOTIFICATION_FEED_SIZE):
+    """(unread count, newest `limit` unread notifications) for a dashboard.
+    
+    The counter rides along on each row, so this stays one query.
+    """
+    rows = Notification.query.filter_by(user_id=user_id, is_read=False).join(
+        User, User.id == Notification.user_id
+    ).add_columns(User.unread_notifications).order_by(Notification.created_at.desc()).limit(limit).all()
+    return (rows[0][1] if rows else 0), [notification for notification, _ in rows]
+
+def run_with_busy_retry(work, attempts=DB_BUSY_RETRIES, base_delay=0.05):
+    """Run a unit of work, retrying with backoff while SQLite reports the database busy"""
+    for attempt in range(attempts):
+        try:
+            return work()
+        except OperationalError as e:
+            db.session.rollback()
+            busy = 'locked' in str(e.orig) or 'busy' in str(e.orig)
+            if not busy or attempt == attempts - 1:
+                raise
+            time.sleep(base_delay * (2 ** attempt) * random.uniform(0.5, 1.5))
+
+class SlotTaken(Exception):
+    """The appointment slot was claimed by another booking"""
+
+def book_slot(patient, doctor, appointment_date, appointment_time, reason=None):
+    """Claim a slot: the appointment and the doctor's notification commit together.
+    
+    The partial unique index on active (doctor, date, time) slots decides
+    concurrent claims; the loser gets SlotTaken.
+    """
+    doctor_email = doctor.user.email
+    
+    def claim():
+        appointment = Appointment(
+            patient_id=patient.id,
+            doctor_id=doctor.id,
+            hospital_id=doctor.hospital_id,
+            appointment_date=appointment_date,
+            appointment_time=appointment_time,
+            reason=reason,
+            status='pending'
+        )
+        db.session.add(appointment)
+        create_notification(
+            doctor.user_id,
+            'New Appointment',
+            f'New appointment request from {patient.first_name} {patient.last_name} on {appointment_date.isoformat()}',
+            'appointment',
+            email_to=doctor_email
+        )
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            raise SlotTaken()
+        outbox_sender.wake()
+        return appointment
+    
+    return run_with_busy_retry(claim)
+
+def share_records(record_ids, doctor_ids, expires_at=None):
+    """Share every record with every doctor; re-sharing renews the expiry.
+    
+    Does not commit, the caller owns the transaction.
+    """
+    now = datetime.utcnow()
+    rows = [
+        {'record_id': record_id, 'doctor_id': doctor_id, 'shared_at': now, 'expires_at': expires_at}
+        for record_id in set(record_ids) for doctor_id in set(doctor_ids)
+    ]
+    if not rows:
+        return 0
+    
+    stmt = sqlite_insert(RecordShare).values(rows)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['record_id', 'doctor_id'],
+        set_={'shared_at': stmt.excluded.shared_at, 'expires_at': stmt.excluded.expires_at}
+    )
+    db.session.execute(stmt)
+    db.session.execute(
+        update(MedicalRecord).where(MedicalRecord.id.in_(set(record_ids))).values(is_shared=True)
+    )
+    return len(rows)
+
+def unshare_records(record_ids, doctor_ids=None):
+    """Revoke shares of the records, from the given doctors or from everyone.
+    
+    Does not commit, the caller owns the transaction.
+    """
+    record_ids = set(record_ids)
+    if not record_ids:
+        return 0
+    
+    stmt = delete(RecordShare).where(RecordShare.record_id.in_(record_ids))
+    if doctor_ids is not None:
+        stmt = stmt.where(RecordShare.doctor_id.in_(set(doctor_ids)))
+    removed = db.session.execute(stmt).rowcount
+    
+    still_shared = db.session.query(RecordShare.id).filter(RecordShare.record_id == MedicalRecord.id).exists()
+    db.session.execute(
+        update(MedicalRecord).where(MedicalRecord.id.in_(record_ids)).values(is_shared=still_shared)
+    )
+    return removed
+
+def records_shared_with(doctor_id, *columns):
+    """Query of records currently shared with a doctor, newest share first.
+    
+    Extra `columns` are selected alongside each record.
+    """
+    now = datetime.utcnow()
+    return db.session.query(MedicalRecord, *columns).join(RecordShare).filter(
+        RecordShare.doctor_id == doctor_id,
+        or_(RecordShare.expires_at.is_(None), RecordShare.expires_at > now)
+    ).order_by(RecordShare.shared_at.desc())
+
+def viewable_record(record_id):
+    """The record if the logged-in user may see it, else None.
+    
+    That is its patient, whoever uploaded it, or a doctor it is currently
+    shared with.
+    """
+    user_id = session['user_id']
+    own_patient = db.session.query(Patient.id).filter(Patient.user_id == user_id)
+    own_doctor = db.session.query(Doctor.id).filter(Doctor.user_id == user_id).scalar_subquery()
+    shared = records_shared_with(own_doctor).with_entities(MedicalRecord.id).order_by(None)
+    return MedicalRecord.query.filter(
+        MedicalRecord.id == record_id,
+        or_(MedicalRecord.uploaded_by == user_id, MedicalRecord.patient_id.in_(own_patient),
+            MedicalRecord.id.in_(shared))
+    ).first()
+
+def find_free_slots(doctor_ids, start_date, days):
+    """Free appointment slots for the doctors over [start_date, start_date + days).
+    
+    Two indexed queries regardless of the number of doctors or days. Ids
+    that are not in the doctor directory get no slots.
+    """
+    doctors_by_id = directory_cache.get().doctors_by_id
+    doctor_ids = {doctor_id for doctor_id in doctor_ids if doctor_id in doctors_by_id}
+    if not doctor_ids:
+        return {}
+    end_date = start_date + timedelta(days=days)
+    
+    windows = {doctor_id: {} for doctor_id in doctor_ids}
+    published = set()
+    for row in db.session.query(
+        DoctorAvailability.doctor_id, DoctorAvailability.day_of_week,
+        DoctorAvailability.start_time, DoctorAvailability.end_time, DoctorAvailability.is_available
+    ).filter(DoctorAvailability.doctor_id.in_(doctor_ids)):
+        published.add(row.doctor_id)
+        if row.is_available:
+            windows[row.doctor_id].setdefault(row.day_of_week, []).append(
+                (slots.to_minutes(row.start_time), slots.to_minutes(row.end_time))
+            )
+    for doctor_id in doctor_ids - published:
+        windows[doctor_id] = slots.DEFAULT_WEEKLY_WINDOWS
+    
+    appointments = db.session.query(
+        Appointment.doctor_id, Appointment.appointment_date, Appointment.appointment_time
+    ).filter(
+        Appointment.doctor_id.in_(doctor_ids),
+        Appointment.appointment_date >= start_date,
+        Appointment.appointment_date < end_date,
+        Appointment.status != 'cancelled'
+    )
+    
+    return slots.free_slots(slots.build_templates(windows), slots.build_booked(appointments),
+                            start_date, days, now=datetime.now())
+
+def is_slot_free(doctor_id, appointment_date, appointment_time):
+    """Check a single slot against the doctor's availability and bookings"""
+    free = find_free_slots([doctor_id], appointment_date, 1).get(doctor_id, {})
+    return appointment_time.strftime('%H:%M') in free.get(appointment_date.isoformat(), [])
+
+def user_security_state(user_id):
+    """(is_verified, security_version) for a user, or None if the user is gone"""
+    if security_stamp.changed():
+        user_security_cache.clear()
+    
+    state = user_security_cache.get(user_id)
+    if state is MISSING:
+        row = db.session.query(User.is_verified, User.security_version).filter(User.id == user_id).first()
+        state = (bool(row.is_verified), row.security_version) if row else None
+        user_security_cache.set(user_id, state)
+    return state
+
+def bump_security_version(user, unverify=False):
+    """End every session of the user, in every worker process"""
+    user.security_version = (user.security_version or 1) + 1
+    if unverify:
+        user.is_verified = False
     db.session.commit()
+    
+    user_security_cache.delete(user.id)
+    security_stamp.bump()
+
+def mark_verified(user):
+    """Commit the user as verified; workers holding an unverified state drop it"""
+    was_verified = user.is_verified
+    user.is_verified = True
+    db.session.commit()
+    
+    if not was_verified:
+        user_security_cache.delete(user.id)
+        security_stamp.bump()
+
+def upload_store():
+    return BlobStore(app.config['UPLOAD_FOLDER'], keyring_from_config(app.config['ENCRYPTION_KEYS']))
+
+def send_record_file(record):
+    """Download response for a record's file.
+    
+    Blobs get their SHA-256 as a strong ETag, so revalidation is a 304 and
+    Range requests (If-Range included) are answered with partial content.
+    With DOWNLOAD_OFFLOAD set only headers are sent and the proxy streams
+    the file, so the worker is free as soon as the headers are out.
+    Encrypted files are decrypted by the worker chunk by chunk instead.
+    """
+    path = safe_join(os.path.abspath(app.config['UPLOAD_FOLDER']), record.file_path)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+    download_name = record.file_name or os.path.basename(record.file_path)
+    
+    if is_encrypted(path):
+        reader = upload_store().open(path)
+        response = send_file(reader, as_attachment=True, download_name=download_name,
+                             etag=BlobStore.digest_of(record.file_path), last_modified=os.path.getmtime(path),
+                             conditional=False)
+        response.content_length = reader.size
+        response.make_conditional(request, accept_ranges=True, complete_length=reader.size)
+        response.accept_ranges = 'bytes'
+        response.cache_control.private = True
+        return response
+    
+    offload = app.config['DOWNLOAD_OFFLOAD']
+    environ = request.environ
+    if offload:
+        # The proxy applies the client's Range header to the file itself
+        environ = {key: value for key, value in environ.items() if key not in ('HTTP_RANGE', 'HTTP_IF_RANGE')}
+    response = send_file_with_environ(
+        path, environ, as_attachment=True, download_name=download_name,
+        etag=BlobStore.digest_of(record.file_path) or True, conditional=True, use_x_sendfile=bool(offload),
+        response_class=app.response_class,
+    )
+    if not offload:
+        # Advertised on full responses too, so players and viewers know they can seek
+        response.accept_ranges = 'bytes'
+    elif offload == 'x-accel-redirect' and 'X-Sendfile' in response.headers:
+        del response.headers['X-Sendfile']
+        response.headers['X-Accel-Redirect'] = (app.config['DOWNLOAD_ACCEL_PREFIX'].rstrip('/') + '/'
+                                                + record.file_path.replace(os.sep, '/'))
+    # Medical data: browsers may keep a copy, shared caches may not
+    response.cache_control.private = True
+    return response
+
+def preview_targets(digest):
+    """({width: preview path}, "cannot preview" marker path) for a blob"""
+    store = upload_store()
+    targets = {width: store.preview_path(digest, width) for width in PREVIEW_SIZES.values()}
+    return targets, store.preview_path(digest, None)
+
+def queue_previews(digest):
+    """Have the preview pool render a blob's previews unless they exist"""
+    targets, marker = preview_targets(digest)
+    if os.path.exists(marker) or all(os.path.exists(path) for path in targets.values()):
+        return None
+    store = upload_store()
+    return preview_pool.submit(store.path(digest), targets, marker, store.keyring)
+
+def cache_version(name):
+    return db.session.query(CacheVersion.version).filter(CacheVersion.name == name).scalar() or 0
+
+def bump_cache_version(name, connection=None):
+    """Tell every worker that cached data called `name` changed.
+    
+    Does not commit, the caller owns the transaction: the bump becomes
+    visible together with the change it announces. Runs on the session
+    unless a Core `connection` (e.g. a bulk import's) is given.
+    """
+    (connection or db.session).execute(sqlite_insert(CacheVersion).values(name=name, version=1).on_conflict_do_update(
+        index_elements=['name'], set_={'version': CacheVersion.version + 1}
+    ))
+
+# Compact, read-only directory rows shared by all requests of a worker
+DirectoryHospital = namedtuple('DirectoryHospital', 'id name address')
+DirectoryDoctor = namedtuple('DirectoryDoctor', 'id first_name last_name specialization qualification experience '
+                                                'consultation_fee bio is_available hospital_id hospital')
+Directory = namedtuple('Directory', 'doctors available_doctors hospitals doctors_by_id doctors_by_hospital')
+
+def load_directory():
+    """Every doctor and hospital, as DirectoryDoctor/DirectoryHospital tuples"""
+    hospitals = {
+        row.id: DirectoryHospital(row.id, row.name, row.address)
+        for row in db.session.query(Hospital.id, Hospital.name, Hospital.address).order_by(Hospital.id)
+    }
+    doctors = tuple(
+        DirectoryDoctor(row.id, row.first_name, row.last_name, row.specialization, row.qualification,
+                        row.experience, row.consultation_fee,
+                        # Templates show a 100 character teaser; 101 keeps their "..." check working
+                        row.bio[:101] if row.bio else row.bio,
+                        bool(row.is_available), row.hospital_id, hospitals.get(row.hospital_id))
+        for row in db.session.query(
+            Doctor.id, Doctor.first_name, Doctor.last_name, Doctor.specialization, Doctor.qualification,
+            Doctor.experience, Doctor.consultation_fee, Doctor.bio, Doctor.is_available, Doctor.hospital_id
+        ).order_by(Doctor.id)
+    )
+    doctors_by_hospital = {}
+    for doctor in doctors:
+        doctors_by_hospital.setdefault(doctor.hospital_id, []).append(doctor)
+    return Directory(
+        doctors=doctors,
+        available_doctors=tuple(doctor for doctor in doctors if doctor.is_available),
+        hospitals=tuple(hospitals.values()),
+        doctors_by_id={doctor.id: doctor for doctor in doctors},
+        doctors_by_hospital={hospital_id: tuple(group) for hospital_id, group in doctors_by_hospital.items()},
+    )
+
+directory_cache = VersionedCache(load_directory, lambda: cache_version('directory'),
+                                 check_interval=app.config['DIRECTORY_CHECK_INTERVAL'])
+
+def encode_cursor(*values):
+    """Opaque page cursor for the last row of a page"""
+    raw = json.dumps([v.isoformat() if hasattr(v, 'isoformat') else v for v in values])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+def decode_cursor(cursor, *types):
+    """Inverse of encode_cursor; returns None for a missing or malformed cursor"""
+    if not cursor:
+        return None
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        if len(values) != len(types):
+            return None
+        return tuple(
+            t.fromisoformat(v) if hasattr(t, 'fromisoformat') else t(v)
+            for t, v in zip(types, values)
+        )
+    except (ValueError, TypeError):
+        return None
+
+def page_size():
+    """Requested page size, clamped to PAGE_SIZE_MAX"""
+    return max(1, min(request.args.get('limit', PAGE_SIZE, type=int) or PAGE_SIZE, PAGE_SIZE_MAX))
+
+def keyset_page(query, sort_column, id_column, cursor=None, limit=PAGE_SIZE, key=None):
+    """One page of `query`, newest first by (sort_column, id_column).
+    
+    Seeks past the cursor instead of using OFFSET, so every page costs the
+    same index range scan however deep it is. `key` extracts the
+    (sort, id) values from a row; by default they are read off the row by
+    column name. Returns (rows, next_cursor).
+    """
+    position = decode_cursor(cursor, sort_column.type.python_type, int)
+    if position:
+        sort_value, last_id = position
+        query = query.filter(or_(
+            sort_column < sort_value,
+            and_(sort_column == sort_value, id_column < last_id)
+        ))
+    
+    rows = query.order_by(sort_column.desc(), id_column.desc()).limit(limit + 1).all()
+    if len(rows) <= limit:
+        return rows, None
+    
+    rows = rows[:limit]
+    last = rows[-1]
+    keys = key(last) if key else (getattr(last, sort_column.key), getattr(last, id_column.key))
+    return rows, encode_cursor(*keys)
+
+def patient_roster_page(appointment_filter):
+    """One page of distinct patients with appointments matching the filter, by patient id.
+    
+    Reads the (doctor|hospital, patient) index in order and stops after one
+    page of distinct ids. Returns (patients, next_cursor).
+    """
+    limit = page_size()
+    position = decode_cursor(request.args.get('cursor'), int)
+    
+    ids_query = db.session.query(Appointment.patient_id).filter(appointment_filter).distinct()
+    if position:
+        ids_query = ids_query.filter(Appointment.patient_id > position[0])
+    patient_ids = [row.patient_id for row in ids_query.order_by(Appointment.patient_id).limit(limit + 1)]
+    
+    next_cursor = encode_cursor(patient_ids[limit - 1]) if len(patient_ids) > limit else None
+    patient_ids = patient_ids[:limit]
+    patients = Patient.query.filter(Patient.id.in_(patient_ids)).order_by(Patient.id).all() if patient_ids else []
+    return patients, next_cursor
+
+# bm25 weights for the doctor_search columns: name, specialization,
+# qualification, bio, hospital_name, hospital_address
+DOCTOR_SEARCH_RANK = 'bm25(doctor_search, 3.0, 5.0, 1.0, 0.5, 1.5, 1.0)'
+
+def fts_prefix_match(text, columns=None):
+    """Free text -> FTS5 query matching every word as a prefix, optionally only in `columns`"""
+    words = re.findall(r'\w+', text or '')
+    if not words:
+        return None
+    match = ' '.join(f'"{word}"*' for word in words)
+    return f'{{{" ".join(columns)}}} : ({match})' if columns else match
+
+def search_doctors_query(terms=None, location=None, min_fee=None, max_fee=None, min_experience=None,
+                         hospital_id=None, ranked=True):
+    """Available doctors matching the search, best match first.
+    
+    `terms` is matched against everything indexed for a doctor, `location`
+    only against the hospital name and address. Both are prefix matches
+    answered by the doctor_search full-text index. With ranked=False the
+    matches are only filtered, for callers that impose their own order.
+    """
+    query = Doctor.query.filter_by(is_available=True)
+    
+    match = ' AND '.join(filter(None, [
+        fts_prefix_match(terms),
+        fts_prefix_match(location, ['hospital_name', 'hospital_address']),
+    ]))
+    if match and not ranked:
+        matching = db.select(db.text('rowid')).select_from(db.text('doctor_search')).where(
+            db.text('doctor_search MATCH :match').bindparams(match=match))
+        # "+ 0" keeps SQLite from driving the query off the match list, so a
+        # caller's own filter (nearby hospitals) picks the rows to check
+        query = query.filter((Doctor.id + 0).in_(matching))
+    elif match:
+        scores = db.text(
+            f'SELECT rowid AS doctor_id, {DOCTOR_SEARCH_RANK} AS score FROM doctor_search '
+            f'WHERE doctor_search MATCH :match'
+        ).bindparams(match=match).columns(doctor_id=db.Integer, score=db.Float).subquery()
+        query = query.join(scores, scores.c.doctor_id == Doctor.id).order_by(scores.c.score, Doctor.id)
+    else:
+        query = query.order_by(Doctor.id)
+    
+    if min_fee is not None:
+        query = query.filter(Doctor.consultation_fee >= min_fee)
+    if max_fee is not None:
+        query = query.filter(Doctor.consultation_fee <= max_fee)
+    if min_experience is not None:
+        query = query.filter(Doctor.experience >= min_experience)
+    if hospital_id is not None:
+        query = query.filter(Doctor.hospital_id == hospital_id)
+    return query
+
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE_LAT = 111.32
+
+def bounding_box(latitude, longitude, radius_km):
+    """Latitude/longitude box that contains every point within radius_km"""
+    dlat = radius_km / KM_PER_DEGREE_LAT
+    south, north = max(-90.0, latitude - dlat), min(90.0, latitude + dlat)
+    # Degrees of longitude shrink towards the poles; size the box for the widest edge
+    cos_edge = math.cos(math.radians(max(abs(south), abs(north))))
+    dlon = radius_km / (KM_PER_DEGREE_LAT * cos_edge) if cos_edge > 1e-9 else 360.0
+    west, east = longitude - dlon, longitude + dlon
+    if west < -180.0 or east > 180.0:
+        # Crosses the antimeridian (or a pole): search the whole band
+        west, east = -180.0, 180.0
+    return {'south': south, 'north': north, 'west': west, 'east': east}
+
+def nearest_doctors(query, latitude, longitude, radius_km, limit=SEARCH_RESULTS):
+    """The `limit` doctors from `query` nearest to a point and within radius_km, as (doctor, km) pairs.
+    
+    Candidates come from the hospital_location R*Tree, searched in growing
+    boxes until enough doctors turn up or the radius is reached, so only
+    hospitals near the point are ever measured.
+    """
+    lat, lon = math.radians(latitude), math.radians(longitude)
+    hospital_lat, hospital_lon = func.radians(Hospital.latitude), func.radians(Hospital.longitude)
+    # Great-circle distance (spherical law of cosines), evaluated by SQLite
+    distance = EARTH_RADIUS_KM * func.acos(func.min(1.0,
+        math.sin(lat) * func.sin(hospital_lat)
+        + math.cos(lat) * func.cos(hospital_lat) * func.cos(hospital_lon - lon)
+    ))
+    
+    query = query.order_by(None).join(Hospital, Hospital.id == Doctor.hospital_id)
+    reach = min(radius_km, 5.0)
+    while True:
+        # IN (...) lets SQLite start from the R*Tree hits and reach doctors through ix_doctor_hospital
+        nearby = db.select(db.text('id')).select_from(db.text('hospital_location')).where(db.text(
+            'max_lat >= :south AND min_lat <= :north AND max_lon >= :west AND min_lon <= :east'
+        ).bindparams(**bounding_box(latitude, longitude, reach)))
+        rows = query.filter(Doctor.hospital_id.in_(nearby)).add_columns(distance.label('distance_km')).filter(
+            distance <= reach
+        ).order_by('distance_km', Doctor.id).limit(limit).all()
+        if len(rows) >= limit or reach >= radius_km:
+            return [(doctor, km) for doctor, km in rows]
+        reach = min(reach * 4, radius_km)
+
+# Fields of each /api/v1 collection; ?fields=a,b picks some of them. They
+# are read as plain columns and must only depend on rows whose changes bump
+# the collection's version counter.
+def api_fields(*columns):
+    return {column.key: column for column in columns}
+
+API_FIELDS = {
+    'appointments': api_fields(
+        Appointment.id, Appointment.patient_id, Appointment.doctor_id, Appointment.hospital_id,
+        Appointment.appointment_date, Appointment.appointment_time, Appointment.status, Appointment.reason,
+        Appointment.notes, Appointment.created_at, Appointment.updated_at),
+    'records': api_fields(
+        MedicalRecord.id, MedicalRecord.patient_id, MedicalRecord.record_type, MedicalRecord.title,
+        MedicalRecord.description, MedicalRecord.file_name, MedicalRecord.record_date, MedicalRecord.created_at,
+        MedicalRecord.is_shared),
+    'notifications': api_fields(
+        Notification.id, Notification.title, Notification.message, Notification.notification_type,
+        Notification.is_read, Notification.created_at),
+}
+
+# Doctors are served from the directory snapshot, so their fields read DirectoryDoctor tuples
+API_DOCTOR_FIELDS = {
+    name: attrgetter(name) for name in ('id', 'first_name', 'last_name', 'specialization', 'qualification',
+                                        'experience', 'consultation_fee', 'hospital_id')
+}
+API_DOCTOR_FIELDS['hospital_name'] = lambda doctor: doctor.hospital.name if doctor.hospital else None
+
+API_PROFILES = {'patient': Patient, 'doctor': Doctor, 'hospital': Hospital}
+
+def api_owner(*stamps):
+    """(profile id, *stamps) of the logged-in user in one query, or None without a profile.
+    
+    `stamps` are columns or scalar subqueries, typically the user's version
+    counters for the collection being read.
+    """
+    profile = API_PROFILES.get(session.get('user_type'))
+    if profile is None:
+        return None
+    return db.session.execute(db.select(profile.id, *stamps).join(User, User.id == profile.user_id).where(
+        profile.user_id == session['user_id'])).first()
+
+def api_page(query, names, sort_column, id_column):
+    """One keyset page of `query` (selecting the `names` fields) as {'data': [...], 'next_cursor': ...}"""
+    # Labelled, so they are selected even when also asked for as fields
+    query = query.add_columns(sort_column.label('sort_key'), id_column.label('row_id'))
+    rows, next_cursor = keyset_page(query, sort_column, id_column, request.args.get('cursor'), page_size(),
+                                    key=lambda row: tuple(row[-2:]))
+    return {'data': api.as_dicts(names, rows), 'next_cursor': next_cursor}
+
+def api_collection(build, *stamps):
+    """JSON response for a collection, with conditional GET.
+    
+    The ETag is derived from `stamps` (the version counters of what the
+    collection shows) and the query string, so a client that already holds
+    the current version gets a 304 without `build` ever running. Read the
+    stamps before the rows: a change landing in between then only costs
+    one extra download.
+    """
+    etag = api.collection_etag(request.endpoint, session.get('user_id'), sorted(request.args.items(multi=True)),
+                               *stamps)
+    if request.if_none_match.contains_weak(etag):
+        response = app.response_class(status=304)
+    else:
+        response = app.response_class(api.dumps(build()), mimetype='application/json')
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+def requested_slot_range():
+    """(start date, days) from ?start=YYYY-MM-DD&days=N; raises ValueError with a message for the client"""
+    days = request.args.get('days', 14, type=int)
+    try:
+        start_date = datetime.strptime(request.args['start'], '%Y-%m-%d').date()
+    except KeyError:
+        start_date = datetime.now().date()
+    except ValueError:
+        raise ValueError('start must be YYYY-MM-DD')
+    if not 1 <= days <= MAX_SLOT_DAYS:
+        raise ValueError(f'days must be between 1 and {MAX_SLOT_DAYS}')
+    return start_date, days
+
+def cached_page(key, render, ttl=None, min_hits=1):
+    """The page `render()` returns, served from page_cache under `key` for `ttl` seconds.
+    
+    Visitors with flashed messages waiting always get a fresh render, since
+    the page shows them. With min_hits > 1 a page is only stored once it was
+    asked for that many times within `ttl`.
+    """
+    if '_flashes' in session:
+        return render()
+    page = page_cache.get(key)
+    if page is not MISSING:
+        return page
+    
+    page = render()
+    ttl = ttl or app.config['PAGE_CACHE_TTL']
+    if min_hits > 1:
+        hits = page_hits.get(key, 0) + 1
+        if hits < min_hits:
+            page_hits.set(key, hits, ttl)
+            return page
+        page_hits.delete(key)
+    page_cache.set(key, page, ttl)
+    return page
+
+# What a dashboard's {% cache %} fragments are keyed on: the user (id and
+# creation time, so a reused id never sees another user's fragments) and
+# their data versions, plus the unread count for the bell
+DashboardVersions = namedtuple('DashboardVersions', 'owner appointments records notifications unread')
+
+def dashboard_owner(profile_model):
+    """(profile, DashboardVersions) of the logged-in user in one query; (None, None) without a profile"""
+    row = db.session.query(
+        profile_model, User.id, User.created_at, User.appointments_version, User.records_version,
+        User.notifications_version, User.unread_notifications
+    ).join(User, User.id == profile_model.user_id).filter(profile_model.user_id == session['user_id']).first()
+    if row is None:
+        return None, None
+    profile, user_id, created_at, *versions = row
+    return profile, DashboardVersions((user_id, created_at), *versions)
 
 # ==================== MIDDLEWARE ====================
 
+@app.before_request
+def start_outbox_sender():
+    """Start this worker's email sender threads on its first request"""
+    if not outbox_sender.running and app.config['OUTBOX_WORKERS'] and not app.testing:
+        with _outbox_start_lock:
+            outbox_sender.start()
+
+@app.before_request
+def start_otp_sweeper():
+    """Start this worker's expired-code sweeper on its first request"""
+    if not otp_store.sweeping and app.config['OTP_SWEEP_INTERVAL'] and not app.testing:
+        with _outbox_start_lock:
+            otp_store.start_sweeper(app.config['OTP_SWEEP_INTERVAL'])
+
 @app.before_request
 def check_user_verified():
-    """Check if logged-in user is verified, redirect to login if not"""
-    if 'user_id' in session:
-        user = User.query.get(session.get('user_id'))
-        if user and not user.is_verified:
-            session.clear()
-            flash('Your email has not been verified. Please log in to continue.', 'warning')
-            return redirect(url_for('login'))
+    """Check if logged-in user is verified, redirect to login if not.
+    
+    The session carries the user's security version; it is compared with a
+    cached copy, so the database is only read after the version changes.
+    """
+    if 'user_id' not in session or request.endpoint == 'static':
+        return
+    
+    state = user_security_state(session['user_id'])
+    if state and 'security_version' not in session:
+        # Session from before versions existed: it was issued at the initial
+        # version, so any bump since then has ended it
+        session['verified'] = state[0]
+        session['security_version'] = 1
+    
+    if not state or not state[0] or not session.get('verified') or session['security_version'] != state[1]:
+        session.clear()
+        flash('Your email has not been verified. Please log in to continue.', 'warning')
+        return redirect(url_for('login'))
 
 # ==================== ROUTES ====================
 
 @app.route('/')
 def welcome():
     """Welcome/Landing Page"""
-    return render_template('welcome.html')
+    return cached_page('welcome', lambda: render_template('welcome.html'))
 
 @app.route('/about')
 def about():
     """About Page"""
-    return render_template('about.html')
+    return cached_page('about', lambda: render_template('about.html'))
 
 @app.route('/contact', methods=['GET', 'POST'])
 def contact():
@@ -270,7 +1278,7 @@ def contact():
         flash(f'Thank you, {name}! Your message has been sent. We will contact you soon.', 'success')
         return redirect(url_for('contact'))
     
-    return render_template('contact.html')
+    return cached_page('contact', lambda: render_template('contact.html'))
 
 @app.route('/login', methods=['GET', 'POST'])
 def login():
@@ -299,24 +1307,14 @@ def login():
                 return redirect(url_for('register'))
             
             # Generate and send OTP
-            otp_code = generate_otp()
-            otp = OTP(
-                user_id=user.id,
-                otp_code=otp_code,
-                purpose='login',
-                expires_at=datetime.utcnow() + timedelta(minutes=10)
-            )
-            db.session.add(otp)
+            otp_code = issue_otp(user.id, 'login')
+            send_otp_email(email, otp_code, 'login')
             db.session.commit()
+            outbox_sender.wake()
             
-            # Send OTP email (store demo OTP for development/testing)
-            sent = send_otp_email(email, otp_code, 'login')
+            # Store demo OTP for development/testing
             session['demo_otp'] = otp_code
-            if sent:
-                flash('OTP sent to your email. Please enter it below.', 'info')
-            else:
-                # Demo mode - show OTP
-                flash(f'OTP sent (Demo: Your OTP is {otp_code})', 'info')
+            flash('OTP sent to your email. Please enter it below.', 'info')
 
             session['login_email'] = email
             session['login_user_id'] = user.id
@@ -334,18 +1332,9 @@ def login():
                 return redirect(url_for('login'))
             
             user = User.query.get(login_user_id)
-            otp_record = OTP.query.filter_by(
-                user_id=login_user_id,
-                otp_code=otp_code,
-                purpose='login',
-                is_used=False
-            ).order_by(OTP.created_at.desc()).first()
-            
-            if otp_record and otp_record.is_valid():
-                otp_record.is_used = True
-                user.is_verified = True
+            if otp_store.verify(login_user_id, 'login', otp_code):
                 user.last_login = datetime.utcnow()
-                db.session.commit()
+                mark_verified(user)
                 # Clear demo OTP after successful login verification
                 session.pop('demo_otp', None)
 
@@ -353,6 +1342,8 @@ def login():
                 session['user_id'] = user.id
                 session['user_type'] = user.user_type
                 session['email'] = user.email
+                session['verified'] = True
+                session['security_version'] = user.security_version
                 
                 flash('Login successful! Welcome to MedVault.', 'success')
                 
@@ -407,23 +1398,14 @@ def register():
             db.session.commit()
             
             # Generate OTP
-            otp_code = generate_otp()
-            otp = OTP(
-                user_id=temp_user.id,
-                otp_code=otp_code,
-                purpose='registration',
-                expires_at=datetime.utcnow() + timedelta(minutes=10)
-            )
-            db.session.add(otp)
+            otp_code = issue_otp(temp_user.id, 'registration')
+            send_otp_email(email, otp_code, 'registration')
             db.session.commit()
+            outbox_sender.wake()
             
-            # Send OTP email (in dev we also keep OTP in session for demo)
-            sent = send_otp_email(email, otp_code, 'registration')
+            # In dev we also keep OTP in session for demo
             session['demo_otp'] = otp_code
-            if sent:
-                flash('OTP sent to your email. Please verify to complete registration.', 'info')
-            else:
-                flash(f'OTP sent (Demo: Your OTP is {otp_code})', 'info')
+            flash('OTP sent to your email. Please verify to complete registration.', 'info')
 
             session['register_user_id'] = temp_user.id
             session['register_email'] = email
@@ -449,18 +1431,9 @@ def verify_otp():
                 flash('Session expired. Please try registration again.', 'error')
                 return redirect(url_for('register'))
             
-            otp_record = OTP.query.filter_by(
-                user_id=user_id,
-                otp_code=otp_code,
-                purpose='registration',
-                is_used=False
-            ).order_by(OTP.created_at.desc()).first()
-            
-            if otp_record and otp_record.is_valid():
-                otp_record.is_used = True
+            if otp_store.verify(user_id, 'registration', otp_code):
                 user = User.query.get(user_id)
-                user.is_verified = True
-                db.session.commit()
+                mark_verified(user)
 
                 # Clear demo OTP after successful verification
                 session.pop('demo_otp', None)
@@ -469,6 +1442,8 @@ def verify_otp():
                 session['user_id'] = user.id
                 session['user_type'] = user.user_type
                 session['email'] = user.email
+                session['verified'] = True
+                session['security_version'] = user.security_version
                 session.pop('register_user_id', None)
                 session.pop('register_email', None)
                 session.pop('otp_purpose', None)
@@ -492,23 +1467,16 @@ def verify_otp():
                 return redirect(url_for('login'))
             
             user = User.query.get(login_user_id)
-            otp_record = OTP.query.filter_by(
-                user_id=login_user_id,
-                otp_code=otp_code,
-                purpose='login',
-                is_used=False
-            ).order_by(OTP.created_at.desc()).first()
-            
-            if otp_record and otp_record.is_valid():
-                otp_record.is_used = True
-                user.is_verified = True
+            if otp_store.verify(login_user_id, 'login', otp_code):
                 user.last_login = datetime.utcnow()
-                db.session.commit()
+                mark_verified(user)
                 
                 session.clear()
                 session['user_id'] = user.id
                 session['user_type'] = user.user_type
                 session['email'] = user.email
+                session['verified'] = True
+                session['security_version'] = user.security_version
                 
                 flash('Login successful! Welcome to MedVault.', 'success')
                 
@@ -575,9 +1543,11 @@ def complete_doctor_profile():
     if not doctor:
         doctor = Doctor(user_id=user.id)
         db.session.add(doctor)
+        bump_cache_version('directory')
         db.session.commit()
+        directory_cache.invalidate()
     
-    hospitals = Hospital.query.all()
+    hospitals = directory_cache.get().hospitals
     
     if request.method == 'POST':
         doctor.first_name = request.form.get('first_name')
@@ -590,7 +1560,9 @@ def complete_doctor_profile():
         doctor.bio = request.form.get('bio')
         doctor.consultation_fee = float(request.form.get('consultation_fee', 0))
         
+        bump_cache_version('directory')
         db.session.commit()
+        directory_cache.invalidate()
         flash('Profile completed successfully!', 'success')
         return redirect(url_for('doctor_dashboard'))
     
@@ -608,7 +1580,9 @@ def complete_hospital_profile():
     if not hospital:
         hospital = Hospital(user_id=user.id)
         db.session.add(hospital)
+        bump_cache_version('directory')
         db.session.commit()
+        directory_cache.invalidate()
     
     if request.method == 'POST':
         hospital.name = request.form.get('name')
@@ -618,7 +1592,9 @@ def complete_hospital_profile():
         hospital.description = request.form.get('description')
         hospital.emergency_number = request.form.get('emergency_number')
         
+        bump_cache_version('directory')
         db.session.commit()
+        directory_cache.invalidate()
         flash('Profile completed successfully!', 'success')
         return redirect(url_for('hospital_dashboard'))
     
@@ -631,34 +1607,46 @@ def logout():
     flash('You have been logged out.', 'info')
     return redirect(url_for('welcome'))
 
+@app.route('/logout_all')
+def logout_all():
+    """Logout on All Devices"""
+    if 'user_id' not in session:
+        return redirect(url_for('login'))
+    
+    user = db.session.get(User, session['user_id'])
+    if user:
+        bump_security_version(user)
+    session.clear()
+    flash('You have been logged out on all devices.', 'info')
+    return redirect(url_for('welcome'))
+
 @app.route('/patient/dashboard')
 def patient_dashboard():
     """Patient Dashboard"""
     if session.get('user_type') != 'patient':
         return redirect(url_for('login'))
     
-    patient = Patient.query.filter_by(user_id=session['user_id']).first()
+    patient, versions = dashboard_owner(Patient)
     
     # If patient profile doesn't exist, redirect to complete it
     if not patient:
         flash('Please complete your patient profile first.', 'warning')
         return redirect(url_for('complete_patient_profile'))
     
-    appointments = Appointment.query.filter_by(patient_id=patient.id).order_by(
-        Appointment.appointment_date.desc()
-    ).limit(5).all()
-    records = MedicalRecord.query.filter_by(patient_id=patient.id).order_by(
+    # Only queried if the fragments showing them are not cached
+    appointments = LazyList(lambda: Appointment.query.filter_by(patient_id=patient.id).options(
+        joinedload(Appointment.doctor)
+    ).order_by(Appointment.appointment_date.desc()).limit(5))
+    records = LazyList(lambda: MedicalRecord.query.filter_by(patient_id=patient.id).order_by(
         MedicalRecord.created_at.desc()
-    ).limit(5).all()
-    notifications = Notification.query.filter_by(
-        user_id=session['user_id'], is_read=False
-    ).order_by(Notification.created_at.desc()).all()
+    ).limit(5))
     
     return render_template('patient_dashboard.html', 
                          patient=patient, 
                          appointments=appointments, 
                          records=records,
-                         notifications=notifications)
+                         versions=versions,
+                         unread_count=versions.unread)
 
 @app.route('/doctor/dashboard')
 def doctor_dashboard():
@@ -666,28 +1654,30 @@ def doctor_dashboard():
     if session.get('user_type') != 'doctor':
         return redirect(url_for('login'))
     
-    doctor = Doctor.query.filter_by(user_id=session['user_id']).first()
+    doctor, versions = dashboard_owner(Doctor)
     
     # If doctor profile doesn't exist, redirect to complete it
     if not doctor:
         flash('Please complete your doctor profile first.', 'warning')
         return redirect(url_for('complete_doctor_profile'))
     
-    appointments = Appointment.query.filter_by(doctor_id=doctor.id).order_by(
-        Appointment.appointment_date.desc()
-    ).limit(10).all()
-    notifications = Notification.query.filter_by(
-        user_id=session['user_id'], is_read=False
-    ).order_by(Notification.created_at.desc()).all()
+    # Only queried if the fragments showing them are not cached
+    appointments = LazyList(lambda: Appointment.query.filter_by(doctor_id=doctor.id).options(
+        joinedload(Appointment.patient)
+    ).order_by(Appointment.appointment_date.desc()).limit(10))
+    notifications = LazyList(lambda: notification_feed(session['user_id'])[1])
     
     today = datetime.now().date()
-    today_appointments = [a for a in appointments if a.appointment_date == today]
+    today_appointments = LazyList(lambda: [a for a in appointments if a.appointment_date == today])
     
     return render_template('doctor_dashboard.html',
                          doctor=doctor,
                          appointments=appointments,
+                         today=today,
                          today_appointments=today_appointments,
-                         notifications=notifications)
+                         notifications=notifications,
+                         versions=versions,
+                         unread_count=versions.unread)
 
 @app.route('/hospital/dashboard')
 def hospital_dashboard():
@@ -695,26 +1685,27 @@ def hospital_dashboard():
     if session.get('user_type') != 'hospital':
         return redirect(url_for('login'))
     
-    hospital = Hospital.query.filter_by(user_id=session['user_id']).first()
+    hospital, versions = dashboard_owner(Hospital)
     
     # If hospital profile doesn't exist, redirect to complete it
     if not hospital:
         flash('Please complete your hospital profile first.', 'warning')
         return redirect(url_for('complete_hospital_profile'))
     
-    doctors = Doctor.query.filter_by(hospital_id=hospital.id).all()
-    appointments = Appointment.query.filter_by(hospital_id=hospital.id).order_by(
-        Appointment.appointment_date.desc()
-    ).limit(10).all()
-    notifications = Notification.query.filter_by(
-        user_id=session['user_id'], is_read=False
-    ).order_by(Notification.created_at.desc()).all()
+    doctors = directory_cache.get().doctors_by_hospital.get(hospital.id, ())
+    # Only queried if the fragments showing them are not cached
+    appointments = LazyList(lambda: Appointment.query.filter_by(hospital_id=hospital.id).options(
+        joinedload(Appointment.patient), joinedload(Appointment.doctor)
+    ).order_by(Appointment.appointment_date.desc()).limit(10))
+    notifications = LazyList(lambda: notification_feed(session['user_id'])[1])
     
     return render_template('hospital_dashboard.html',
                          hospital=hospital,
                          doctors=doctors,
                          appointments=appointments,
-                         notifications=notifications)
+                         notifications=notifications,
+                         versions=versions,
+                         unread_count=versions.unread)
 
 @app.route('/appointments')
 def appointments():
@@ -729,34 +1720,72 @@ def appointments():
         if not patient:
             flash('Please complete your profile first.', 'warning')
             return redirect(url_for('complete_patient_profile'))
-        appointments = Appointment.query.filter_by(patient_id=patient.id).order_by(
-            Appointment.appointment_date.desc()
-        ).all()
-        doctors = Doctor.query.filter_by(is_available=True).all()
-        return render_template('appointments.html', appointments=appointments, doctors=doctors, mode='patient')
+        appointments, next_cursor = keyset_page(
+            Appointment.query.filter_by(patient_id=patient.id).options(joinedload(Appointment.doctor)),
+            Appointment.appointment_date, Appointment.id, request.args.get('cursor'), page_size()
+        )
+        return render_template('appointments.html', appointments=appointments, mode='patient',
+                               next_cursor=next_cursor)
     
     elif user_type == 'doctor':
         doctor = Doctor.query.filter_by(user_id=session['user_id']).first()
         if not doctor:
             flash('Please complete your profile first.', 'warning')
             return redirect(url_for('complete_doctor_profile'))
-        appointments = Appointment.query.filter_by(doctor_id=doctor.id).order_by(
-            Appointment.appointment_date.desc()
-        ).all()
-        return render_template('appointments.html', appointments=appointments, mode='doctor')
+        appointments, next_cursor = keyset_page(
+            Appointment.query.filter_by(doctor_id=doctor.id).options(joinedload(Appointment.patient)),
+            Appointment.appointment_date, Appointment.id, request.args.get('cursor'), page_size()
+        )
+        return render_template('appointments.html', appointments=appointments, mode='doctor',
+                               next_cursor=next_cursor)
     
     elif user_type == 'hospital':
         hospital = Hospital.query.filter_by(user_id=session['user_id']).first()
         if not hospital:
             flash('Please complete your profile first.', 'warning')
             return redirect(url_for('complete_hospital_profile'))
-        appointments = Appointment.query.filter_by(hospital_id=hospital.id).order_by(
-            Appointment.appointment_date.desc()
-        ).all()
-        return render_template('appointments.html', appointments=appointments, mode='hospital')
+        appointments, next_cursor = keyset_page(
+            Appointment.query.filter_by(hospital_id=hospital.id).options(
+                joinedload(Appointment.patient), joinedload(Appointment.doctor)
+            ),
+            Appointment.appointment_date, Appointment.id, request.args.get('cursor'), page_size()
+        )
+        return render_template('appointments.html', appointments=appointments, mode='hospital',
+                               next_cursor=next_cursor)
     
     return redirect(url_for('welcome'))
 
+@app.route('/notifications')
+def notifications():
+    """Notifications Page"""
+    if 'user_id' not in session:
+        return redirect(url_for('login'))
+    
+    query = Notification.query.filter_by(user_id=session['user_id'])
+    unread_only = request.args.get('unread') == '1'
+    if unread_only:
+        query = query.filter_by(is_read=False)
+    notifications, next_cursor = keyset_page(
+        query, Notification.created_at, Notification.id, request.args.get('cursor'), page_size()
+    )
+    return render_template('notifications.html', notifications=notifications, next_cursor=next_cursor,
+                           unread_count=unread_notification_count(session['user_id']), unread_only=unread_only)
+
+@app.route('/notifications/read', methods=['POST'])
+def mark_notifications_read():
+    """Mark Notifications Read"""
+    if 'user_id' not in session:
+        return redirect(url_for('login'))
+    
+    # The listed notifications, or all of them when none are given
+    statement = update(Notification).filter_by(user_id=session['user_id'], is_read=False)
+    notification_ids = request.form.getlist('notification_id', type=int)
+    if notification_ids:
+        statement = statement.where(Notification.id.in_(notification_ids))
+    db.session.execute(statement.values(is_read=True))
+    db.session.commit()
+    return redirect(url_for('notifications', unread=request.args.get('unread')))
+
 @app.route('/book_appointment', methods=['GET', 'POST'])
 def book_appointment():
     """Book New Appointment"""
@@ -769,39 +1798,59 @@ def book_appointment():
         return redirect(url_for('complete_patient_profile'))
     
     if request.method == 'POST':
-        doctor_id = request.form.get('doctor_id')
+        doctor_id = request.form.get('doctor_id', type=int)
         appointment_date = request.form.get('appointment_date')
         appointment_time = request.form.get('appointment_time')
         reason = request.form.get('reason')
         
-        doctor = Doctor.query.get(doctor_id)
+        doctor = db.session.get(Doctor, doctor_id) if doctor_id else None
+        try:
+            slot_date = datetime.strptime(appointment_date, '%Y-%m-%d').date()
+            slot_time = datetime.strptime(appointment_time, '%H:%M').time()
+        except (TypeError, ValueError):
+            slot_date = slot_time = None
         
-        appointment = Appointment(
-            patient_id=patient.id,
-            doctor_id=doctor_id,
-            hospital_id=doctor.hospital_id,
-            appointment_date=datetime.strptime(appointment_date, '%Y-%m-%d').date(),
-            appointment_time=datetime.strptime(appointment_time, '%H:%M').time(),
-            reason=reason,
-            status='pending'
-        )
+        if not doctor or not slot_date:
+            flash('Please choose a doctor, date and time slot.', 'error')
+            return redirect(url_for('book_appointment'))
         
-        db.session.add(appointment)
-        db.session.commit()
+        if not is_slot_free(doctor.id, slot_date, slot_time):
+            flash('That time slot is not available. Please choose another one.', 'error')
+            return redirect(url_for('book_appointment'))
         
-        # Create notification for doctor
-        create_notification(
-            doctor.user_id,
-            'New Appointment',
-            f'New appointment request from {patient.first_name} {patient.last_name} on {appointment_date}',
-            'appointment'
-        )
+        try:
+            book_slot(patient, doctor, slot_date, slot_time, reason)
+        except SlotTaken:
+            flash('Sorry, that time slot was just booked by someone else. Please choose another one.', 'error')
+            return redirect(url_for('book_appointment'))
         
         flash('Appointment booked successfully!', 'success')
         return redirect(url_for('appointments'))
     
-    doctors = Doctor.query.filter_by(is_available=True).all()
-    return render_template('book_appointment.html', doctors=doctors)
+    return render_template('book_appointment.html', doctors=directory_cache.get().available_doctors)
+
+@app.route('/api/slots')
+def available_slots():
+    """Free Appointment Slots as JSON"""
+    if 'user_id' not in session:
+        return jsonify({'error': 'Login required'}), 401
+    
+    doctor_ids = request.args.getlist('doctor_id', type=int)
+    try:
+        start_date, days = requested_slot_range()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    if not doctor_ids or len(doctor_ids) > MAX_SLOT_DOCTORS:
+        return jsonify({'error': f'Pass 1-{MAX_SLOT_DOCTORS} doctor_id values'}), 400
+    
+    free = find_free_slots(doctor_ids, start_date, days)
+    return jsonify({
+        'start': start_date.isoformat(),
+        'days': days,
+        'slot_minutes': slots.SLOT_MINUTES,
+        'doctors': {str(doctor_id): dates for doctor_id, dates in free.items()},
+    })
 
 @app.route('/appointment/action/<int:appointment_id>/<action>')
 def appointment_action(appointment_id, action):
@@ -821,7 +1870,13 @@ def appointment_action(appointment_id, action):
         appointment.status = 'completed'
         message = 'Appointment marked as completed!'
     
-    db.session.commit()
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # A cancelled appointment whose slot has been booked again since
+        db.session.rollback()
+        flash('That time slot has already been taken by another appointment.', 'error')
+        return redirect(url_for('appointments'))
     flash(message, 'success')
     return redirect(url_for('appointments'))
 
@@ -835,23 +1890,88 @@ def medical_records():
     
     if user_type == 'patient':
         patient = Patient.query.filter_by(user_id=session['user_id']).first()
-        records = MedicalRecord.query.filter_by(patient_id=patient.id).order_by(
-            MedicalRecord.created_at.desc()
-        ).all()
-        return render_template('medical_records.html', records=records, mode='patient')
+        records, next_cursor = keyset_page(
+            MedicalRecord.query.filter_by(patient_id=patient.id),
+            MedicalRecord.created_at, MedicalRecord.id, request.args.get('cursor'), page_size()
+        )
+        return render_template('medical_records.html', records=records, mode='patient', next_cursor=next_cursor)
     
     elif user_type in ['doctor', 'hospital']:
         # For doctors/hospitals, show shared records or search
-        records = []
+        records, next_cursor = [], None
         if user_type == 'doctor':
             doctor = Doctor.query.filter_by(user_id=session['user_id']).first()
-            records = MedicalRecord.query.filter(
-                MedicalRecord.shared_with.contains(str(doctor.id))
-            ).all()
-        return render_template('medical_records.html', records=records, mode=user_type)
+            rows, next_cursor = keyset_page(
+                records_shared_with(doctor.id, RecordShare.shared_at, RecordShare.id).order_by(None),
+                RecordShare.shared_at, RecordShare.id, request.args.get('cursor'), page_size(),
+                key=lambda row: (row.shared_at, row.id)
+            )
+            records = [row.MedicalRecord for row in rows]
+        return render_template('medical_records.html', records=records, mode=user_type, next_cursor=next_cursor)
     
     return redirect(url_for('welcome'))
 
+@app.route('/records/share', methods=['POST'])
+def share_medical_records():
+    """Share or Unshare Medical Records in Bulk"""
+    if session.get('user_type') != 'patient':
+        return redirect(url_for('login'))
+    
+    patient = Patient.query.filter_by(user_id=session['user_id']).first()
+    if not patient:
+        flash('Please complete your profile first.', 'warning')
+        return redirect(url_for('complete_patient_profile'))
+    
+    def invalid(message):
+        if request.is_json:
+            return jsonify({'error': message}), 400
+        flash(message, 'error')
+        return redirect(url_for('medical_records'))
+    
+    if request.is_json:
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            return invalid('Expected a JSON object.')
+    else:
+        data = {
+            'action': request.form.get('action'),
+            'record_ids': request.form.getlist('record_ids'),
+            'doctor_ids': request.form.getlist('doctor_ids'),
+            'expires_in_days': request.form.get('expires_in_days'),
+        }
+    action = data.get('action') or 'share'
+    if action not in ('share', 'unshare'):
+        return invalid(f'Unknown action {action!r}; use share or unshare.')
+    
+    try:
+        if not all(isinstance(data.get(name) or [], list) for name in ('record_ids', 'doctor_ids')):
+            raise TypeError
+        requested_ids = [int(i) for i in data.get('record_ids') or []]
+        doctor_ids = [int(i) for i in data.get('doctor_ids') or []]
+        expires_in_days = int(data['expires_in_days']) if data.get('expires_in_days') else None
+    except (TypeError, ValueError):
+        return invalid('Invalid share request.')
+    
+    # Only the patient's own records can be shared
+    record_ids = [row.id for row in db.session.query(MedicalRecord.id).filter(
+        MedicalRecord.patient_id == patient.id, MedicalRecord.id.in_(requested_ids)
+    )]
+    
+    if action == 'unshare':
+        count = unshare_records(record_ids, doctor_ids or None)
+        message = f'Stopped sharing {len(record_ids)} record(s).'
+    else:
+        doctor_ids = [row.id for row in db.session.query(Doctor.id).filter(Doctor.id.in_(doctor_ids))]
+        expires_at = datetime.utcnow() + timedelta(days=expires_in_days) if expires_in_days else None
+        count = share_records(record_ids, doctor_ids, expires_at)
+        message = f'Shared {len(record_ids)} record(s) with {len(doctor_ids)} doctor(s).'
+    db.session.commit()
+    
+    if request.is_json:
+        return jsonify({'action': action, 'records': record_ids, 'changed': count})
+    flash(message, 'success')
+    return redirect(url_for('medical_records'))
+
 @app.route('/upload_record', methods=['GET', 'POST'])
 def upload_record():
     """Upload Medical Record"""
@@ -869,11 +1989,14 @@ def upload_record():
         description = request.form.get('description')
         file = request.files.get('file')
         
-        file_path = None
+        file_path = file_name = None
         if file and file.filename:
-            filename = secure_filename(f"{patient.id}_{datetime.now().strftime('%Y%m%d%H%M%S')}_{file.filename}")
-            file.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
-            file_path = filename
+            # Identical files are stored once; the record holds a reference
+            store = upload_store()
+            digest, size, _ = store.store(file.stream)
+            metrics.UPLOAD_BYTES.inc(size)
+            file_path = store.relative_path(digest)
+            file_name = secure_filename(file.filename) or 'record'
         
         record = MedicalRecord(
             patient_id=patient.id,
@@ -881,11 +2004,14 @@ def upload_record():
             title=title,
             description=description,
             file_path=file_path,
+            file_name=file_name,
             uploaded_by=session['user_id']
         )
         
         db.session.add(record)
         db.session.commit()
+        if file_path:
+            queue_previews(digest)
         
         flash('Medical record uploaded successfully!', 'success')
         return redirect(url_for('medical_records'))
@@ -898,27 +2024,83 @@ def download_record(record_id):
     if 'user_id' not in session:
         return redirect(url_for('login'))
     
-    record = MedicalRecord.query.get(record_id)
+    # Records the user may not see are not found, like missing ones
+    record = viewable_record(record_id)
+    if record is None:
+        abort(404)
     
     if record.file_path:
-        return send_from_directory(app.config['UPLOAD_FOLDER'], record.file_path, as_attachment=True)
+        return send_record_file(record)
     
     flash('File not found.', 'error')
     return redirect(url_for('medical_records'))
 
+@app.route('/record_preview/<int:record_id>/<size>')
+def record_preview(record_id, size):
+    """Medical Record Preview Image"""
+    if 'user_id' not in session:
+        return redirect(url_for('login'))
+    
+    record = viewable_record(record_id)
+    digest = BlobStore.digest_of(record.file_path) if record else None
+    if digest is None or size not in PREVIEW_SIZES:
+        abort(404)
+    
+    store = upload_store()
+    path = store.preview_path(digest, PREVIEW_SIZES[size])
+    if not os.path.isfile(path):
+        # Not rendered yet (or dropped while the pool was busy): queue it, the page shows the icon meanwhile
+        queue_previews(digest)
+        abort(404)
+    # Previews are small; read whole (and decrypted when encryption is on)
+    with store.open(path) as f:
+        image = io.BytesIO(f.read())
+    response = send_file(image, mimetype='image/jpeg', max_age=PREVIEW_MAX_AGE, etag=f'{digest}-{size}',
+                         last_modified=os.path.getmtime(path))
+    response.cache_control.public = False
+    response.cache_control.private = True
+    response.cache_control.immutable = True
+    return response
+
+def render_doctor_search(directory):
+    """The search results page for this request's arguments"""
+    latitude = request.args.get('lat', type=float)
+    longitude = request.args.get('lon', type=float)
+    near = latitude is not None and longitude is not None and -90 <= latitude <= 90 and -180 <= longitude <= 180
+    
+    query = search_doctors_query(
+        terms=request.args.get('specialization'),
+        location=request.args.get('location'),
+        min_fee=request.args.get('min_fee', type=float),
+        max_fee=request.args.get('max_fee', type=float),
+        min_experience=request.args.get('min_experience', type=int),
+        hospital_id=request.args.get('hospital_id', type=int),
+        ranked=not near,
+    )
+    query = query.options(joinedload(Doctor.hospital))
+    
+    if near:
+        radius = min(max(request.args.get('radius', NEAR_RADIUS_KM, type=float), 1), NEAR_RADIUS_MAX_KM)
+        doctors = []
+        for doctor, distance_km in nearest_doctors(query, latitude, longitude, radius):
+            doctor.distance_km = distance_km
+            doctors.append(doctor)
+    elif not any(request.args.get(name) for name in SEARCH_FILTERS):
+        # Plain listing: no query needed
+        doctors = directory.available_doctors[:SEARCH_RESULTS]
+    else:
+        doctors = query.limit(SEARCH_RESULTS).all()
+    return render_template('search_doctors.html', doctors=doctors)
+
 @app.route('/search_doctors')
 def search_doctors():
     """Search for Doctors"""
-    specialization = request.args.get('specialization')
-    location = request.args.get('location')
-
-    query = Doctor.query.filter_by(is_available=True)
-
-    if specialization:
-        query = query.filter(Doctor.specialization.ilike(f'%{specialization}%'))
-
-    doctors = query.all()
-    return render_template('search_doctors.html', doctors=doctors)
+    # Doctor and hospital profile changes bump the directory version and so
+    # change the key; newly geocoded hospitals show up within the TTL
+    directory, version = directory_cache.get_versioned()
+    key = ('search_doctors', version, tuple(sorted(request.args.items(multi=True))))
+    return cached_page(key, lambda: render_doctor_search(directory), ttl=app.config['SEARCH_CACHE_TTL'],
+                       min_hits=app.config['SEARCH_CACHE_MIN_HITS'])
 
 @app.route('/doctor/patients')
 def doctor_patients():
@@ -932,9 +2114,7 @@ def doctor_patients():
         return redirect(url_for('complete_doctor_profile'))
 
     # Get unique patients who have appointments with this doctor
-    appointments = Appointment.query.filter_by(doctor_id=doctor.id).all()
-    patient_ids = list(set([appt.patient_id for appt in appointments]))
-    patients = Patient.query.filter(Patient.id.in_(patient_ids)).all() if patient_ids else []
+    patients, next_cursor = patient_roster_page(Appointment.doctor_id == doctor.id)
 
     # Calculate ages
     for patient in patients:
@@ -943,7 +2123,7 @@ def doctor_patients():
         else:
             patient.age = None
 
-    return render_template('doctor_patients.html', doctor=doctor, patients=patients)
+    return render_template('doctor_patients.html', doctor=doctor, patients=patients, next_cursor=next_cursor)
 
 @app.route('/hospital/patients')
 def hospital_patients():
@@ -957,9 +2137,7 @@ def hospital_patients():
         return redirect(url_for('complete_hospital_profile'))
 
     # Get unique patients who have appointments at this hospital
-    appointments = Appointment.query.filter_by(hospital_id=hospital.id).all()
-    patient_ids = list(set([appt.patient_id for appt in appointments]))
-    patients = Patient.query.filter(Patient.id.in_(patient_ids)).all() if patient_ids else []
+    patients, next_cursor = patient_roster_page(Appointment.hospital_id == hospital.id)
 
     # Calculate ages
     for patient in patients:
@@ -968,7 +2146,180 @@ def hospital_patients():
         else:
             patient.age = None
 
-    return render_template('hospital_patients.html', hospital=hospital, patients=patients)
+    return render_template('hospital_patients.html', hospital=hospital, patients=patients, next_cursor=next_cursor)
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """Prometheus Metrics"""
+    token = app.config['METRICS_TOKEN']
+    if token and not hmac.compare_digest(request.headers.get('Authorization', '').encode(),
+                                         f'Bearer {token}'.encode()):
+        abort(403)
+    return metrics.render()
+
+@app.route('/internal/sql-stats')
+def sql_stats_report():
+    """Per-Endpoint SQL Statistics for this Worker"""
+    token = app.config['SQL_STATS_TOKEN']
+    # Header only: a query string ends up in access logs and browser history
+    supplied = request.headers.get('X-Stats-Token', '')
+    if not token or not hmac.compare_digest(supplied.encode(), token.encode()):
+        abort(404)
+    
+    if request.args.get('reset'):
+        sql_stats.reset()
+    return jsonify({'pid': os.getpid(), 'endpoints': sql_stats.snapshot()})
+
+# ==================== JSON API ====================
+# Versioned JSON for the mobile app and partners, using the same login session
+# as the pages. Collections take ?fields=a,b, ?cursor= and ?limit=, and
+# answer If-None-Match with 304 while nothing they show has changed.
+
+@app.route('/api/v1/appointments')
+def api_appointments():
+    """Appointments of the Logged-in User as JSON"""
+    if 'user_id' not in session:
+        return jsonify({'error': 'Login required'}), 401
+    
+    fields = API_FIELDS['appointments']
+    try:
+        names = api.selected_fields(fields, request.args.get('fields'))
+    except api.FieldError as e:
+        return jsonify({'error': str(e)}), 400
+    owner = api_owner(User.appointments_version)
+    if owner is None:
+        return jsonify({'error': 'Complete your profile first'}), 403
+    profile_id, version = owner
+    owner_column = getattr(Appointment, f"{session['user_type']}_id")
+    status = request.args.get('status')
+    
+    def build():
+        query = db.session.query(*(fields[name] for name in names)).filter(owner_column == profile_id)
+        if status:
+            query = query.filter(Appointment.status == status)
+        return api_page(query, names, Appointment.appointment_date, Appointment.id)
+    
+    return api_collection(build, version)
+
+@app.route('/api/v1/records')
+def api_records():
+    """Medical Record Metadata of the Logged-in User as JSON"""
+    if 'user_id' not in session:
+        return jsonify({'error': 'Login required'}), 401
+    
+    fields = API_FIELDS['records']
+    try:
+        names = api.selected_fields(fields, request.args.get('fields'))
+    except api.FieldError as e:
+        return jsonify({'error': str(e)}), 400
+    user_type = session.get('user_type')
+    if user_type == 'doctor':
+        # Shares that run out change the list without a write, so the next expiry is a stamp too
+        next_expiry = db.select(func.min(RecordShare.expires_at)).where(
+            RecordShare.doctor_id == Doctor.id, RecordShare.expires_at > datetime.utcnow()
+        ).scalar_subquery()
+        owner = api_owner(User.records_version, next_expiry)
+    else:
+        owner = api_owner(User.records_version)
+    if owner is None:
+        return jsonify({'error': 'Complete your profile first'}), 403
+    profile_id, *stamps = owner
+    
+    def build():
+        columns = [fields[name] for name in names]
+        if user_type == 'patient':
+            return api_page(db.session.query(*columns).filter(MedicalRecord.patient_id == profile_id), names,
+                            MedicalRecord.created_at, MedicalRecord.id)
+        if user_type == 'doctor':
+            return api_page(records_shared_with(profile_id).with_entities(*columns).order_by(None), names,
+                            RecordShare.shared_at, RecordShare.id)
+        return {'data': [], 'next_cursor': None}
+    
+    return api_collection(build, *stamps)
+
+@app.route('/api/v1/notifications')
+def api_notifications():
+    """Notifications of the Logged-in User as JSON"""
+    if 'user_id' not in session:
+        return jsonify({'error': 'Login required'}), 401
+    
+    fields = API_FIELDS['notifications']
+    try:
+        names = api.selected_fields(fields, request.args.get('fields'))
+    except api.FieldError as e:
+        return jsonify({'error': str(e)}), 400
+    version, unread_count = db.session.execute(db.select(
+        User.notifications_version, User.unread_notifications
+    ).where(User.id == session['user_id'])).one()
+    unread_only = request.args.get('unread') == '1'
+    
+    def build():
+        query = db.session.query(*(fields[name] for name in names)).filter_by(user_id=session['user_id'])
+        if unread_only:
+            query = query.filter_by(is_read=False)
+        page = api_page(query, names, Notification.created_at, Notification.id)
+        page['unread_count'] = unread_count
+        return page
+    
+    return api_collection(build, version)
+
+@app.route('/api/v1/doctors')
+def api_doctors():
+    """Available Doctors as JSON"""
+    try:
+        names = api.selected_fields(API_DOCTOR_FIELDS, request.args.get('fields'))
+    except api.FieldError as e:
+        return jsonify({'error': str(e)}), 400
+    specialization = (request.args.get('specialization') or '').lower()
+    hospital_id = request.args.get('hospital_id', type=int)
+    # The tag must name the version of the list the body is built from
+    directory, version = directory_cache.get_versioned()
+    
+    def build():
+        position = decode_cursor(request.args.get('cursor'), int)
+        after = position[0] if position else 0
+        limit = page_size()
+        matches = (
+            doctor for doctor in directory.available_doctors
+            if doctor.id > after
+            and (not specialization or doctor.specialization.lower() == specialization)
+            and (hospital_id is None or doctor.hospital_id == hospital_id)
+        )
+        doctors = list(islice(matches, limit + 1))
+        getters = [API_DOCTOR_FIELDS[name] for name in names]
+        return {
+            'data': [dict(zip(names, (get(doctor) for get in getters))) for doctor in doctors[:limit]],
+            'next_cursor': encode_cursor(doctors[limit - 1].id) if len(doctors) > limit else None,
+        }
+    
+    return api_collection(build, version)
+
+@app.route('/api/v1/doctors/<int:doctor_id>/availability')
+def api_doctor_availability(doctor_id):
+    """Free Slots of a Doctor as JSON"""
+    if 'user_id' not in session:
+        return jsonify({'error': 'Login required'}), 401
+    
+    try:
+        start_date, days = requested_slot_range()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if db.session.execute(db.select(Doctor.id).where(Doctor.id == doctor_id)).first() is None:
+        return jsonify({'error': 'No such doctor'}), 404
+    
+    free = find_free_slots([doctor_id], start_date, days).get(doctor_id, {})
+    response = app.response_class(api.dumps({
+        'doctor_id': doctor_id,
+        'start': start_date.isoformat(),
+        'days': days,
+        'slot_minutes': slots.SLOT_MINUTES,
+        'dates': free,
+    }), mimetype='application/json')
+    # Anyone's booking changes it, so it is tagged by content rather than by a version
+    response.add_etag()
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
 
 # Error Handlers
 @app.errorhandler(404)
@@ -980,8 +2331,13 @@ def internal_server_error(e):
     return render_template('error.html', error='Internal server error'), 500
 
 # Initialize Database
-with app.app_context():
+def init_db():
+    """Create missing tables and migrate an existing database to the current schema"""
     db.create_all()
+    run_migrations(db)
+
+with app.app_context():
+    init_db()
 
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0', port=5001)
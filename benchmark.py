@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+"""
+MedVault HTTP Benchmark
+Replays a weighted mix of what patients, doctors and hospitals do (dashboards,
+appointment lists, searches, slot lookups, bookings, uploads, downloads,
+mobile app polls) through the Flask test client, in-process, against the
+configured database.
+
+For every route it reports p50/p95/p99 latency and queries per request,
+and compares them with a stored baseline. A route fails its budget when:
+- its p95 exceeds the baseline p95 by more than LATENCY_TOLERANCE plus
+  LATENCY_SLACK_MS (or a hand-set budget_p95_ms in the baseline), or
+- its mean queries per request grow by more than QUERY_TOLERANCE plus
+  QUERY_SLACK, which catches a list page turning into N+1 queries.
+Latency is only comparable on the same machine; on a noisy one, raise
+MEDVAULT_BENCH_TOLERANCE (0.25 by default).
+A failed budget makes the run exit with status 1.
+
+Users are picked, with a fixed seed, from accounts that have a profile, so
+the same dataset gives the same request sequence. Run it against a
+generated dataset; bookings and uploads are written to it.
+
+    MEDVAULT_DATABASE_URI=sqlite:////tmp/bench-1x.db python generate_data.py 1
+    MEDVAULT_DATABASE_URI=sqlite:////tmp/bench-1x.db python benchmark.py save 2000
+    ... change something ...
+    MEDVAULT_DATABASE_URI=sqlite:////tmp/bench-1x.db python benchmark.py 2000
+
+Usage: python benchmark.py [requests] [seed]
+       python benchmark.py save [requests] [seed]     (writes the baseline)
+"""
+
+import io
+import json
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import namedtuple
+from datetime import date
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Uploads are not previewed while benchmarking
+os.environ.setdefault('MEDVAULT_PREVIEW_WORKERS', '0')
+
+from app import app, db, Doctor, Hospital, MedicalRecord, Patient, User
+
+BASELINE_FILE = os.environ.get('MEDVAULT_BENCH_BASELINE', 'benchmark_baseline.json')
+REQUESTS = 1000
+WARMUP = 50
+USERS_PER_ROLE = 200
+# p95 may grow by this fraction plus the slack, so small routes are not failed for noise
+LATENCY_TOLERANCE = float(os.environ.get('MEDVAULT_BENCH_TOLERANCE', '0.25'))
+LATENCY_SLACK_MS = 2.0
+# Mean queries per request may grow this much; periodic cache checks add the odd query
+QUERY_TOLERANCE = 0.1
+QUERY_SLACK = 0.5
+PERCENTILES = (50, 95, 99)
+
+Scenario = namedtuple('Scenario', 'name role weight run')
+
+
+# ---------- scenarios ----------
+# Each one makes its requests through bench.request(route, ...), which times them
+
+def view(path):
+    return lambda bench, user: bench.request(path, 'GET', path)
+
+
+def poll(path):
+    """A mobile client refreshing a collection, sending the ETag of its last copy"""
+    def run(bench, user):
+        etag = bench.etags.get((user, path))
+        response = bench.request(f'{path} poll', 'GET', path, headers={'If-None-Match': etag} if etag else {})
+        bench.etags[(user, path)] = response.headers.get('ETag')
+    return run
+
+
+def search(bench, user):
+    specialization = bench.random.choice(bench.specializations)
+    bench.request('/search_doctors?specialization', 'GET', '/search_doctors',
+                  query_string={'specialization': specialization})
+
+
+def slots(bench, user):
+    doctor_ids = bench.random.sample(bench.doctor_ids, min(3, len(bench.doctor_ids)))
+    return bench.request('/api/slots', 'GET', '/api/slots', query_string={'doctor_id': doctor_ids, 'days': 14})
+
+
+def book(bench, user):
+    response = slots(bench, user)
+    free = [(doctor_id, day, at) for doctor_id, dates in (response.get_json() or {}).get('doctors', {}).items()
+            for day, times in dates.items() for at in times]
+    if free:
+        doctor_id, day, at = bench.random.choice(free)
+        bench.request('/book_appointment POST', 'POST', '/book_appointment', data={
+            'doctor_id': doctor_id, 'appointment_date': day, 'appointment_time': at, 'reason': 'Benchmark visit'})
+
+
+def upload(bench, user):
+    content = bench.random.randbytes(bench.random.randint(2, 64) * 1024)
+    bench.request('/upload_record POST', 'POST', '/upload_record', data={
+        'title': 'Benchmark scan', 'record_type': 'scan', 'file': (io.BytesIO(content), 'scan.bin')})
+
+
+def download(bench, user):
+    record_id = bench.uploaded.get(user)
+    if record_id is None:
+        upload(bench, user)
+        record_id = bench.uploaded[user] = db.session.execute(
+            db.select(MedicalRecord.id).where(MedicalRecord.uploaded_by == user)
+            .order_by(MedicalRecord.id.desc()).limit(1)).scalar()
+        db.session.remove()
+    bench.request('/download_record', 'GET', f'/download_record/{record_id}')
+
+
+SCENARIOS = [
+    Scenario('patient dashboard', 'patient', 20, view('/patient/dashboard')),
+    Scenario('patient appointments', 'patient', 10, view('/appointments')),
+    Scenario('patient records', 'patient', 6, view('/records')),
+    Scenario('search doctors', 'patient', 10, search),
+    Scenario('browse doctors', 'patient', 4, view('/search_doctors')),
+    Scenario('booking form', 'patient', 4, view('/book_appointment')),
+    Scenario('free slots', 'patient', 8, slots),
+    Scenario('book appointment', 'patient', 4, book),
+    Scenario('upload record', 'patient', 2, upload),
+    Scenario('download record', 'patient', 4, download),
+    Scenario('app appointments', 'patient', 8, poll('/api/v1/appointments')),
+    Scenario('app notifications', 'patient', 4, poll('/api/v1/notifications')),
+    Scenario('doctor dashboard', 'doctor', 10, view('/doctor/dashboard')),
+    Scenario('doctor appointments', 'doctor', 6, view('/appointments')),
+    Scenario('doctor patients', 'doctor', 4, view('/doctor/patients')),
+    Scenario('app schedule', 'doctor', 6, poll('/api/v1/appointments')),
+    Scenario('shared records', 'doctor', 2, view('/records')),
+    Scenario('hospital dashboard', 'hospital', 4, view('/hospital/dashboard')),
+    Scenario('hospital appointments', 'hospital', 2, view('/appointments')),
+    Scenario('hospital patients', 'hospital', 2, view('/hospital/patients')),
+]
+
+
+# ---------- running ----------
+
+def percentile(values, p):
+    """Nearest-rank percentile of an already sorted list"""
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+class Benchmark:
+    """Runs scenarios and keeps latency and query counts per route"""
+
+    def __init__(self, seed=42, users_per_role=USERS_PER_ROLE, scenarios=SCENARIOS):
+        self.random = random.Random(seed)
+        self.scenarios = scenarios
+        self.client = app.test_client()
+        self.samples = {}  # route -> [(ms, queries, status)]
+        self.uploaded = {}  # user id -> a record that user uploaded
+        self.etags = {}  # (user id, path) -> ETag of the copy the "app" holds
+        self.recording = True
+        self._queries = 0
+
+        roles = {'patient': Patient, 'doctor': Doctor, 'hospital': Hospital}
+        self.users = {}
+        for role, model in roles.items():
+            ids = db.session.execute(db.select(model.user_id).order_by(model.user_id)).scalars().all()
+            self.users[role] = self.random.sample(ids, min(users_per_role, len(ids)))
+        self.doctor_ids = db.session.execute(
+            db.select(Doctor.id).where(Doctor.is_available.is_(True)).order_by(Doctor.id)).scalars().all()
+        self.specializations = sorted(db.session.execute(db.select(Doctor.specialization).distinct()).scalars())
+        self.emails = dict(db.session.execute(db.select(User.id, User.email).where(
+            User.id.in_([user for users in self.users.values() for user in users]))).all())
+        db.session.remove()
+        self.current_user = None
+
+    def _count(self, *args):
+        self._queries += 1
+
+    def login(self, role, user):
+        if self.current_user != user:
+            with self.client.session_transaction() as sess:
+                sess.clear()
+                sess['user_id'] = user
+                sess['user_type'] = role
+                sess['email'] = self.emails[user]
+            self.current_user = user
+
+    def request(self, route, method, path, **kwargs):
+        self._queries = 0
+        started = time.perf_counter()
+        response = self.client.open(path, method=method, **kwargs)
+        response.get_data()  # Streamed downloads are read in full
+        elapsed = (time.perf_counter() - started) * 1000
+        if self.recording:
+            self.samples.setdefault(route, []).append((elapsed, self._queries, response.status_code))
+        response.close()
+        return response
+
+    def run(self, requests=REQUESTS, warmup=WARMUP):
+        scenarios = [scenario for scenario in self.scenarios if self.users[scenario.role]]
+        weights = [scenario.weight for scenario in scenarios]
+        event.listen(Engine, 'before_cursor_execute', self._count)
+        try:
+            for number in range(warmup + requests):
+                self.recording = number >= warmup
+                scenario = self.random.choices(scenarios, weights)[0]
+                user = self.random.choice(self.users[scenario.role])
+                self.login(scenario.role, user)
+                scenario.run(self, user)
+        finally:
+            event.remove(Engine, 'before_cursor_execute', self._count)
+        return self.results()
+
+    def results(self):
+        """{route: {requests, p50, p95, p99, mean_ms, queries, max_queries, errors}}"""
+        results = {}
+        for route, samples in sorted(self.samples.items()):
+            latencies = sorted(ms for ms, _, _ in samples)
+            queries = [count for _, count, _ in samples]
+            row = {'requests': len(samples)}
+            for p in PERCENTILES:
+                row[f'p{p}'] = round(percentile(latencies, p), 2)
+            row['mean_ms'] = round(sum(latencies) / len(latencies), 2)
+            row['queries'] = round(sum(queries) / len(queries), 2)
+            row['max_queries'] = max(queries)
+            row['errors'] = sum(status >= 400 for _, _, status in samples)
+            results[route] = row
+        return results
+
+
+def compare(results, baseline):
+    """Budget failures of `results` against a baseline, as messages"""
+    failures = []
+    for route, row in results.items():
+        budget = baseline.get('routes', {}).get(route)
+        if budget is None:
+            continue
+        p95_budget = budget.get('budget_p95_ms') or budget['p95'] * (1 + LATENCY_TOLERANCE) + LATENCY_SLACK_MS
+        if row['p95'] > p95_budget:
+            failures.append(f'{route}: p95 {row["p95"]:.1f}ms is over its {p95_budget:.1f}ms budget '
+                            f'(baseline {budget["p95"]:.1f}ms)')
+        queries_budget = budget['queries'] * (1 + QUERY_TOLERANCE) + QUERY_SLACK
+        if row['queries'] > queries_budget:
+            failures.append(f'{route}: {row["queries"]:.1f} queries per request is over its {queries_budget:.1f} '
+                            f'budget (baseline {budget["queries"]:.1f})')
+    for route, row in results.items():
+        if row['errors']:
+            failures.append(f'{route}: {row["errors"]} of {row["requests"]} requests failed')
+    return failures
+
+
+def print_results(results, baseline=None):
+    routes = (baseline or {}).get('routes', {})
+    print(f"{'route':<32} {'n':>5} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'queries':>8} {'base p95':>9}")
+    for route, row in results.items():
+        base = routes.get(route, {}).get('p95')
+        print(f"{route:<32} {row['requests']:>5} {row['p50']:>8.1f} {row['p95']:>8.1f} {row['p99']:>8.1f} "
+              f"{row['queries']:>8.1f} {base if base is not None else '-':>9}")
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    save = bool(args) and args[0] == 'save'
+    if save:
+        args = args[1:]
+    requests = int(args[0]) if args else REQUESTS
+    seed = int(args[1]) if len(args) > 1 else 42
+
+    app.config['UPLOAD_FOLDER'] = tempfile.mkdtemp(prefix='medvault-bench-')
+    # Templates live next to app.py in this checkout rather than in templates/
+    if not os.path.isdir(os.path.join(app.root_path, 'templates')):
+        app.template_folder = app.root_path
+    with app.app_context():
+        results = Benchmark(seed).run(requests)
+
+    if save:
+        with open(BASELINE_FILE, 'w') as f:
+            json.dump({'requests': requests, 'seed': seed, 'date': date.today().isoformat(),
+                       'database': app.config['SQLALCHEMY_DATABASE_URI'], 'routes': results}, f, indent=2)
+        print_results(results)
+        print(f"\n✅ Baseline saved to {BASELINE_FILE}")
+        sys.exit(0)
+
+    baseline = None
+    if os.path.exists(BASELINE_FILE):
+        with open(BASELINE_FILE) as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+    failures = compare(results, baseline or {})
+    if failures:
+        print(f"\n❌ {len(failures)} budget failures:")
+        for failure in failures:
+            print(f"   - {failure}")
+        sys.exit(1)
+    print(f"\n✅ All routes within budget" + ("" if baseline else f" (no baseline at {BASELINE_FILE})"))
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+"""
+MedVault Content-Addressed Upload Storage
+Uploaded files are stored once per distinct content, under the SHA-256 of
+their bytes, in a fan-out tree below the upload folder:
+
+    blobs/9f/86/9f86d081884c7d659a2feaa0c55ad015a3bf4f1b2b0b822cd15d6c15b0f00a08
+
+Uploads are hashed (and encrypted, see encryption.py) while werkzeug writes
+them to disk (see HashingSpool), so a file of any size is read from the
+client once, never held in memory, and becomes a blob with a rename. Records point at the blob path; the Blob
+table counts the records per blob, and files nobody refers to any more are
+removed by collect_garbage().
+
+Usage: python blobstore.py gc [grace hours]
+"""
+
+import glob
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete
+
+from encryption import EncryptingWriter, open_file, plaintext_size
+
+BLOB_DIR = 'blobs'
+CHUNK_SIZE = 64 * 1024
+
+
+class HashingSpool:
+    """Temporary upload file that hashes everything written to it.
+
+    With a keyring the bytes reach the disk encrypted, so reading the spool
+    back gives ciphertext; BlobStore.open() decrypts stored blobs.
+    """
+
+    def __init__(self, directory, keyring=None):
+        os.makedirs(directory, exist_ok=True)
+        self.file = tempfile.NamedTemporaryFile(dir=directory, prefix='upload-', delete=False)
+        self.writer = EncryptingWriter(self.file, keyring) if keyring else self.file
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.sha256.update(data)
+        self.size += len(data)
+        self.writer.write(data)
+        return len(data)
+
+    def finish(self):
+        """Write out buffered data and make it durable"""
+        if self.writer is not self.file:
+            # werkzeug rewinds the spool once the upload is parsed
+            self.file.seek(0, os.SEEK_END)
+            self.writer.finish()
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def __getattr__(self, name):
+        # read/seek/flush/... for werkzeug's FileStorage
+        return getattr(self.file, name)
+
+    def __iter__(self):
+        return iter(self.file)
+
+    def close(self):
+        self.file.close()
+        try:
+            os.unlink(self.file.name)
+        except FileNotFoundError:
+            pass  # Became a blob
+
+
+class BlobStore:
+    """SHA-256 addressed files below `root` (the upload folder), encrypted when given a keyring"""
+
+    def __init__(self, root, keyring=None):
+        self.root = root
+        self.keyring = keyring
+
+    def relative_path(self, digest):
+        """blobs/ab/cd/abcd... - the value kept in MedicalRecord.file_path"""
+        return os.path.join(BLOB_DIR, digest[:2], digest[2:4], digest)
+
+    def path(self, digest):
+        return os.path.join(self.root, self.relative_path(digest))
+
+    @staticmethod
+    def digest_of(file_path):
+        """The digest a MedicalRecord.file_path refers to, or None for files stored before blobs"""
+        parts = (file_path or '').replace(os.sep, '/').split('/')
+        if len(parts) == 4 and parts[0] == BLOB_DIR and len(parts[3]) == 64:
+            return parts[3]
+        return None
+
+    def preview_path(self, digest, width):
+        """Rendered preview next to the blob; width None is the "cannot preview" marker"""
+        return f'{self.path(digest)}.preview-{width or "none"}' + ('.jpg' if width else '')
+
+    def spool(self):
+        return HashingSpool(os.path.join(self.root, BLOB_DIR, 'tmp'), self.keyring)
+
+    def open(self, path):
+        """Seekable plaintext of a blob or preview path; DecryptingReader.size when encrypted"""
+        return open_file(path, self.keyring)
+
+    def size(self, digest):
+        return plaintext_size(self.path(digest), self.keyring)
+
+    def files(self):
+        """Paths of every stored blob and preview"""
+        for directory, _, names in os.walk(os.path.join(self.root, BLOB_DIR)):
+            if os.path.basename(directory) == 'tmp':
+                continue
+            for name in names:
+                if not name.endswith(('.deleting', '.tmp', '.preview-none')):
+                    yield os.path.join(directory, name)
+
+    def store(self, stream):
+        """Store an uploaded stream. Returns (digest, size, created).
+
+        A HashingSpool is moved into place as is; any other stream is copied
+        into one chunk by chunk first. `created` is False when the content
+        was already stored.
+        """
+        if isinstance(stream, HashingSpool):
+            spool = stream
+        else:
+            spool = self.spool()
+            try:
+                shutil.copyfileobj(stream, spool, CHUNK_SIZE)
+            except BaseException:
+                spool.close()
+                raise
+
+        digest = spool.sha256.hexdigest()
+        target = self.path(digest)
+        created = False
+        try:
+            # Already stored: a fresh mtime keeps collect_garbage() off it
+            os.utime(target)
+        except FileNotFoundError:
+            spool.finish()
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            # Atomic: readers see the whole file or none of it, and two
+            # uploads of the same content just replace one another
+            os.replace(spool.name, target)
+            created = True
+        if spool is not stream:
+            spool.close()
+        return digest, spool.size, created
+
+    def remove(self, digest, unused_since=None):
+        """Delete a blob file, unless store() touched it after `unused_since` (a timestamp)"""
+        target = self.path(digest)
+        doomed = f'{target}.deleting'
+        try:
+            # After the rename store() can no longer touch it and writes a new copy instead
+            os.rename(target, doomed)
+        except FileNotFoundError:
+            return False
+        if unused_since is not None and os.stat(doomed).st_mtime > unused_since:
+            os.rename(doomed, target)
+            return False
+        os.unlink(doomed)
+        for preview in glob.glob(glob.escape(target) + '.preview-*'):
+            os.unlink(preview)
+        return True
+
+
+def collect_garbage(db, Blob, store, grace=timedelta(hours=1)):
+    """Delete blobs no record has referred to for `grace`. Returns the number removed.
+
+    The grace period covers uploads in flight: an upload of the same
+    content touches the file before its record commits and takes a
+    reference again, and a touched file is kept.
+    """
+    cutoff = datetime.utcnow() - grace
+    doomed = db.session.execute(
+        delete(Blob).where(Blob.ref_count <= 0, Blob.updated_at < cutoff).returning(Blob.sha256)
+    ).scalars().all()
+    db.session.commit()
+    unused_since = time.time() - grace.total_seconds()
+    return sum(store.remove(digest, unused_since) for digest in doomed)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] != 'gc':
+        print(__doc__)
+        sys.exit(1)
+
+    from app import app, db, Blob, upload_store
+
+    hours = float(sys.argv[2]) if len(sys.argv) > 2 else 1
+    with app.app_context():
+        removed = collect_garbage(db, Blob, upload_store(), timedelta(hours=hours))
+    print(f"✅ Removed {removed} unreferenced blobs")
@@ -0,0 +1,212 @@
+"""
+MedVault In-Process Caches
+Small, thread-safe caches that live inside one worker process, plus a stamp
+file and versioned snapshots that let any worker tell the others to drop
+what they cached, and a {% cache %} template tag for page fragments.
+"""
+
+import os
+import threading
+import time
+
+from jinja2 import nodes
+from jinja2.ext import Extension
+
+MISSING = object()
+
+
+class TTLCache:
+    """Dict-like cache where every entry expires after `ttl` seconds"""
+
+    def __init__(self, ttl=60, maxsize=10000):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, default=MISSING):
+        entry = self._data.get(key)
+        if entry is None:
+            return default
+        expires, value = entry
+        if expires < time.monotonic():
+            with self._lock:
+                self._data.pop(key, None)
+            return default
+        return value
+
+    def set(self, key, value, ttl=None):
+        expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            if len(self._data) >= self.maxsize and key not in self._data:
+                self._evict()
+            self._data[key] = (expires, value)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def _evict(self):
+        now = time.monotonic()
+        expired = [key for key, (expires, _) in self._data.items() if expires < now]
+        for key in expired:
+            del self._data[key]
+        if len(self._data) >= self.maxsize:
+            # Still full: drop the entries closest to expiry
+            for key, _ in sorted(self._data.items(), key=lambda item: item[1][0])[:self.maxsize // 10 or 1]:
+                del self._data[key]
+
+
+class SharedStamp:
+    """Cross-process "something changed" signal backed by a file's mtime.
+
+    bump() touches the file; changed() reports whether any process bumped it
+    since this process last looked. The file is stat'ed at most once per
+    `check_interval` seconds, so the check is nearly free on hot paths.
+    """
+
+    def __init__(self, path, check_interval=1.0):
+        self.path = path
+        self.check_interval = check_interval
+        self._seen = self._read()
+        self._next_check = 0.0
+
+    def _read(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return 0
+
+    def bump(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with open(self.path, 'a'):
+            pass
+        # Guarantee a new mtime even on filesystems with coarse timestamps
+        now = max(time.time_ns(), self._read() + 1)
+        os.utime(self.path, ns=(now, now))
+
+    def changed(self):
+        now = time.monotonic()
+        if now < self._next_check:
+            return False
+        self._next_check = now + self.check_interval
+        current = self._read()
+        if current != self._seen:
+            self._seen = current
+            return True
+        return False
+
+
+class VersionedCache:
+    """A value built by `load()` and kept until `read_version()` returns something new.
+
+    The version (e.g. a counter row in the database that writers bump in
+    the same transaction as their change) is read at most once per
+    `check_interval` seconds, so reads in between cost nothing. Any worker
+    that bumps the counter makes every other worker rebuild within one
+    interval; invalidate() makes this worker check on its next read.
+    """
+
+    def __init__(self, load, read_version, check_interval=2.0):
+        self.load = load
+        self.read_version = read_version
+        self.check_interval = check_interval
+        self._entry = None  # (value, version), replaced as one
+        self._next_check = 0.0
+        self._lock = threading.Lock()
+
+    def get(self):
+        return self.get_versioned()[0]
+
+    def get_versioned(self):
+        """(value, version it was loaded at), from the same load"""
+        entry = self._entry
+        if entry is not None and time.monotonic() < self._next_check:
+            return entry
+        with self._lock:
+            if self._entry is None or time.monotonic() >= self._next_check:
+                version = self.read_version()
+                if self._entry is None or version != self._entry[1]:
+                    # Read the version first: a write landing during load()
+                    # leaves a newer version behind and is picked up next time
+                    self._entry = (self.load(), version)
+                self._next_check = time.monotonic() + self.check_interval
+            return self._entry
+
+    def invalidate(self):
+        self._next_check = 0.0
+
+    def clear(self):
+        with self._lock:
+            self._entry = None
+
+
+class LazyList:
+    """A list loaded by `load()` on first use.
+
+    Handed to a template instead of query results, the query only runs if a
+    fragment that shows the rows is not cached.
+    """
+
+    def __init__(self, load):
+        self._load = load
+        self._items = None
+
+    def _get(self):
+        if self._items is None:
+            self._items = list(self._load())
+        return self._items
+
+    def __iter__(self):
+        return iter(self._get())
+
+    def __len__(self):
+        return len(self._get())
+
+    def __getitem__(self, index):
+        return self._get()[index]
+
+    def __bool__(self):
+        return bool(self._get())
+
+
+class FragmentCacheExtension(Extension):
+    """{% cache 'name', key, parts... %}...{% endcache %}: the block is rendered
+    once per distinct key and served from `environment.fragment_cache` (a
+    TTLCache) after that. Without a cache configured, blocks always render.
+
+    The key must hold everything the block shows, e.g. the version counters
+    of the rows in it.
+    """
+
+    tags = {'cache'}
+
+    def __init__(self, environment):
+        super().__init__(environment)
+        environment.extend(fragment_cache=None)
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        key = [parser.parse_expression()]
+        while parser.stream.skip_if('comma'):
+            key.append(parser.parse_expression())
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        call = self.call_method('_cached', [nodes.Tuple(key, 'load')])
+        return nodes.CallBlock(call, [], [], body).set_lineno(lineno)
+
+    def _cached(self, key, caller):
+        cache = self.environment.fragment_cache
+        if cache is None:
+            return caller()
+        fragment = cache.get(key)
+        if fragment is MISSING:
+            fragment = caller()
+            cache.set(key, fragment)
+        return fragment
@@ -0,0 +1,125 @@
+"""
+Shared pytest fixtures for the MedVault test suite
+Every test runs against a throwaway SQLite database, never instance/medvault.db
+"""
+
+import os
+import tempfile
+from contextlib import contextmanager
+from datetime import datetime, timedelta, time
+
+_test_dir = tempfile.mkdtemp(prefix='medvault-test-')
+os.environ.setdefault('MEDVAULT_DATABASE_URI', 'sqlite:///' + os.path.join(_test_dir, 'medvault.db'))
+os.environ.setdefault('MEDVAULT_SECURITY_STAMP', os.path.join(_test_dir, 'security.stamp'))
+os.environ.setdefault('MEDVAULT_SLOW_LOG', os.path.join(_test_dir, 'slow.log'))
+# Tests that need the preview pool start their own
+os.environ.setdefault('MEDVAULT_PREVIEW_WORKERS', '0')
+
+import pytest
+from sqlalchemy import event
+
+from app import (app as flask_app, db, init_db, user_security_cache, directory_cache, page_cache, page_hits,
+                 fragment_cache, User, Patient, Doctor, Hospital, Appointment, MedicalRecord, Notification)
+
+# test_app.py is a smoke script for a live server (python test_app.py)
+collect_ignore = ['test_app.py']
+
+# Templates live next to app.py in this checkout rather than in templates/
+if not os.path.isdir(os.path.join(flask_app.root_path, 'templates')):
+    flask_app.template_folder = flask_app.root_path
+
+
+@pytest.fixture
+def app():
+    flask_app.config.update(TESTING=True)
+    with flask_app.app_context():
+        db.drop_all()
+        init_db()
+        user_security_cache.clear()
+        directory_cache.clear()
+        # Fresh databases reuse ids and version numbers, so cached pages would match
+        page_cache.clear()
+        page_hits.clear()
+        fragment_cache.clear()
+        yield flask_app
+        db.session.remove()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+def login_as(client, user):
+    """Put a verified user into the test client's session"""
+    with client.session_transaction() as sess:
+        sess['user_id'] = user.id
+        sess['user_type'] = user.user_type
+        sess['email'] = user.email
+
+
+@contextmanager
+def captured_selects(selects_only=True):
+    """(statement, parameters) of each SELECT run while open; of every statement with selects_only=False"""
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if not selects_only or statement.lstrip().upper().startswith('SELECT'):
+            statements.append((statement, parameters))
+
+    event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+
+
+def make_user(email, user_type):
+    # Real password hashing costs ~0.3s per user; no test logs in by password
+    user = User(email=email, user_type=user_type, is_verified=True, password_hash='unused')
+    db.session.add(user)
+    db.session.flush()
+    return user
+
+
+@pytest.fixture
+def sample_data(app):
+    """One hospital with two doctors, three patients and some history"""
+    hospital = Hospital(user_id=make_user('hospital@test.com', 'hospital').id,
+                        name='City General Hospital', address='123 Medical Center Drive',
+                        phone='555-0100')
+    db.session.add(hospital)
+    db.session.flush()
+
+    doctors = []
+    for i, specialization in enumerate(['Cardiology', 'Dermatology']):
+        doctor = Doctor(user_id=make_user(f'doctor{i}@test.com', 'doctor').id,
+                        first_name=f'Doc{i}', last_name='Test', specialization=specialization,
+                        hospital_id=hospital.id, consultation_fee=100.0)
+        db.session.add(doctor)
+        doctors.append(doctor)
+
+    patients = []
+    for i in range(3):
+        patient = Patient(user_id=make_user(f'patient{i}@test.com', 'patient').id,
+                          first_name=f'Pat{i}', last_name='Test')
+        db.session.add(patient)
+        patients.append(patient)
+    db.session.flush()
+
+    today = datetime.utcnow().date()
+    for i in range(12):
+        patient = patients[i % len(patients)]
+        doctor = doctors[i % len(doctors)]
+        db.session.add(Appointment(patient_id=patient.id, doctor_id=doctor.id,
+                                   hospital_id=hospital.id,
+                                   appointment_date=today + timedelta(days=i - 6),
+                                   appointment_time=time(9 + i % 8, 0),
+                                   status='pending', reason='Checkup'))
+        db.session.add(MedicalRecord(patient_id=patient.id, record_type='lab_result',
+                                     title=f'Record {i}', uploaded_by=patient.user_id))
+        db.session.add(Notification(user_id=doctor.user_id, title='New Appointment',
+                                    message='Booked', notification_type='appointment'))
+    db.session.commit()
+
+    return {'hospital': hospital, 'doctors': doctors, 'patients': patients}
@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+"""
+MedVault Encryption at Rest
+Record files are encrypted in fixed-size chunks with AES-256-GCM, so they
+can be written while an upload streams in and read back from any offset
+(Range requests) with one chunk of memory.
+
+Every file gets its own random data key, stored in the file header wrapped
+(RFC 3394 key wrap) by a master key from MEDVAULT_ENCRYPTION_KEYS. That
+setting holds comma-separated base64 keys: the first wraps new files, the
+others are kept to read files written before a key rotation.
+
+File layout:
+    header   magic, master key id, wrapped data key, nonce prefix, chunk size
+    chunks   AES-GCM(chunk) + 16 byte tag, one per chunk_size plaintext bytes
+
+Chunk nonces are the file's random prefix plus the chunk number and a
+final-chunk flag, and the header is authenticated with every chunk, so
+chunks cannot be reordered, swapped between files or cut off at the end.
+
+Usage: python encryption.py genkey
+       python encryption.py encrypt     (encrypts files stored before encryption was turned on)
+       python encryption.py bench [size MB ...]
+"""
+
+import base64
+import functools
+import hashlib
+import io
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.keywrap import InvalidUnwrap, aes_key_unwrap, aes_key_wrap
+
+MAGIC = b'\x89MVENC\r\n'
+HEADER = struct.Struct('>8s8s40s7sI')  # magic, key id, wrapped key, nonce prefix, chunk size
+CHUNK_SIZE = 64 * 1024
+TAG_SIZE = 16
+
+
+class DecryptionError(Exception):
+    """A file cannot be decrypted: unknown master key or tampered content"""
+
+
+def key_id(master_key):
+    return hashlib.sha256(master_key).digest()[:8]
+
+
+class Keyring:
+    """Master keys by id; the first one wraps the data keys of new files"""
+
+    def __init__(self, master_keys):
+        if not master_keys or any(len(key) != 32 for key in master_keys):
+            raise ValueError('master keys must be 32 bytes')
+        self.keys = {key_id(key): key for key in master_keys}
+        self.current = key_id(master_keys[0])
+
+    def wrap(self, data_key):
+        return self.current, aes_key_wrap(self.keys[self.current], data_key)
+
+    def unwrap(self, master_key_id, wrapped):
+        master_key = self.keys.get(master_key_id)
+        if master_key is None:
+            raise DecryptionError(f'file was encrypted with unknown master key {master_key_id.hex()}')
+        try:
+            return aes_key_unwrap(master_key, wrapped)
+        except InvalidUnwrap:
+            raise DecryptionError('data key does not unwrap') from None
+
+
+@functools.lru_cache(maxsize=4)
+def keyring_from_config(value):
+    """MEDVAULT_ENCRYPTION_KEYS -> Keyring, or None when encryption is off"""
+    keys = [base64.urlsafe_b64decode(part.strip()) for part in (value or '').split(',') if part.strip()]
+    return Keyring(keys) if keys else None
+
+
+def _nonce(prefix, index, last):
+    return prefix + struct.pack('>IB', index, last)
+
+
+class EncryptingWriter:
+    """Encrypts what is written to it into `file`; call finish() after the last write"""
+
+    def __init__(self, file, keyring, chunk_size=CHUNK_SIZE):
+        self.file = file
+        self.chunk_size = chunk_size
+        data_key = AESGCM.generate_key(bit_length=256)
+        master_key_id, wrapped = keyring.wrap(data_key)
+        self.prefix = os.urandom(7)
+        self.header = HEADER.pack(MAGIC, master_key_id, wrapped, self.prefix, chunk_size)
+        self.aead = AESGCM(data_key)
+        self.buffer = bytearray()
+        self.index = 0
+        file.write(self.header)
+
+    def write(self, data):
+        self.buffer += data
+        # A full chunk is held back until more data arrives: the last chunk
+        # has to be sealed as the last one
+        while len(self.buffer) > self.chunk_size:
+            self._seal(bytes(self.buffer[:self.chunk_size]), last=False)
+            del self.buffer[:self.chunk_size]
+        return len(data)
+
+    def finish(self):
+        self._seal(bytes(self.buffer), last=True)
+        self.buffer = bytearray()
+
+    def _seal(self, chunk, last):
+        self.file.write(self.aead.encrypt(_nonce(self.prefix, self.index, last), chunk, self.header))
+        self.index += 1
+
+
+class DecryptingReader(io.RawIOBase):
+    """Seekable plaintext view of an encrypted file, holding one chunk at a time"""
+
+    def __init__(self, file, keyring):
+        super().__init__()
+        self.file = file
+        self.header = file.read(HEADER.size)
+        if len(self.header) < HEADER.size:
+            raise DecryptionError('file is too short')
+        magic, master_key_id, wrapped, self.prefix, self.chunk_size = HEADER.unpack(self.header)
+        if magic != MAGIC:
+            raise DecryptionError('file is not encrypted')
+        if keyring is None:
+            raise DecryptionError('encryption keys are not configured')
+        self.aead = AESGCM(keyring.unwrap(master_key_id, wrapped))
+
+        body = os.fstat(file.fileno()).st_size - HEADER.size
+        sealed = self.chunk_size + TAG_SIZE
+        self.chunks = max(1, -(-body // sealed))
+        self.size = body - self.chunks * TAG_SIZE
+        if self.size < 0:
+            raise DecryptionError('file is truncated')
+        self.position = 0
+        self._index = None
+        self._plain = b''
+        if self.size == 0:
+            self._chunk(0)  # Still authenticate an empty file
+
+    def _chunk(self, index):
+        if index != self._index:
+            self.file.seek(HEADER.size + index * (self.chunk_size + TAG_SIZE))
+            sealed = self.file.read(self.chunk_size + TAG_SIZE)
+            try:
+                self._plain = self.aead.decrypt(_nonce(self.prefix, index, index == self.chunks - 1), sealed,
+                                                self.header)
+            except InvalidTag:
+                raise DecryptionError(f'chunk {index} failed authentication') from None
+            self._index = index
+        return self._plain
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError('negative seek position')
+        self.position = offset
+        return offset
+
+    def readinto(self, buffer):
+        # Fills the whole buffer across chunks: image decoders expect full reads
+        view = memoryview(buffer).cast('B')
+        filled = 0
+        while filled < len(view) and self.position < self.size:
+            index, offset = divmod(self.position, self.chunk_size)
+            chunk = self._chunk(index)
+            count = min(len(view) - filled, len(chunk) - offset)
+            view[filled:filled + count] = chunk[offset:offset + count]
+            filled += count
+            self.position += count
+        return filled
+
+    def close(self):
+        if not self.closed:
+            self.file.close()
+        super().close()
+
+
+def is_encrypted(path):
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def open_file(path, keyring):
+    """Binary, seekable plaintext of a stored file, encrypted or not"""
+    file = open(path, 'rb')
+    try:
+        if file.read(len(MAGIC)) != MAGIC:
+            file.seek(0)
+            return file
+        file.seek(0)
+        return DecryptingReader(file, keyring)
+    except BaseException:
+        file.close()
+        raise
+
+
+def plaintext_size(path, keyring):
+    with open_file(path, keyring) as f:
+        return f.size if isinstance(f, DecryptingReader) else os.fstat(f.fileno()).st_size
+
+
+def encrypt_file(path, keyring):
+    """Encrypt a plaintext file in place (atomically). Returns False if it was already encrypted."""
+    if is_encrypted(path):
+        return False
+    fd, temporary = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with open(path, 'rb') as source, os.fdopen(fd, 'wb') as target:
+            writer = EncryptingWriter(target, keyring)
+            shutil.copyfileobj(source, writer, CHUNK_SIZE)
+            writer.finish()
+            target.flush()
+            os.fsync(target.fileno())
+        shutil.copystat(path, temporary)
+        os.replace(temporary, path)
+    except BaseException:
+        if os.path.exists(temporary):
+            os.unlink(temporary)
+        raise
+    return True
+
+
+def benchmark(sizes_mb, directory):
+    """Time plain copies against encrypting and decrypting copies of random files"""
+    keyring = Keyring([AESGCM.generate_key(bit_length=256)])
+    rows = []
+    for size_mb in sizes_mb:
+        source = os.path.join(directory, f'plain-{size_mb}')
+        with open(source, 'wb') as f:
+            for _ in range(size_mb * 16):
+                f.write(os.urandom(64 * 1024))
+        encrypted = os.path.join(directory, f'encrypted-{size_mb}')
+
+        def copy():
+            with open(source, 'rb') as src, open(os.path.join(directory, 'copy'), 'wb') as dst:
+                shutil.copyfileobj(src, dst, CHUNK_SIZE)
+
+        def encrypt():
+            with open(source, 'rb') as src, open(encrypted, 'wb') as dst:
+                writer = EncryptingWriter(dst, keyring)
+                shutil.copyfileobj(src, writer, CHUNK_SIZE)
+                writer.finish()
+
+        def decrypt():
+            with open_file(encrypted, keyring) as src, open(os.path.join(directory, 'copy'), 'wb') as dst:
+                shutil.copyfileobj(src, dst, CHUNK_SIZE)
+
+        row = {'size_mb': size_mb}
+        for name, run in (('plain', copy), ('encrypt', encrypt), ('decrypt', decrypt)):
+            tracemalloc.start()
+            started = time.perf_counter()
+            run()
+            row[name] = time.perf_counter() - started
+            row[name + '_peak_kb'] = tracemalloc.get_traced_memory()[1] / 1024
+            tracemalloc.stop()
+        rows.append(row)
+        os.unlink(source)
+        os.unlink(encrypted)
+    return rows
+
+
+if __name__ == '__main__':
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+
+    if command == 'genkey':
+        print(base64.urlsafe_b64encode(AESGCM.generate_key(bit_length=256)).decode())
+
+    elif command == 'encrypt':
+        from app import app, upload_store
+
+        store = upload_store()
+        if store.keyring is None:
+            print("MEDVAULT_ENCRYPTION_KEYS is not set")
+            sys.exit(1)
+        count = 0
+        for path in store.files():
+            count += encrypt_file(path, store.keyring)
+        print(f"✅ Encrypted {count} files")
+
+    elif command == 'bench':
+        sizes = [int(size) for size in sys.argv[2:]] or [1, 16, 128]
+        with tempfile.TemporaryDirectory() as directory:
+            rows = benchmark(sizes, directory)
+        print(f"{'size':>8} {'plain MB/s':>11} {'encrypt MB/s':>13} {'decrypt MB/s':>13} "
+              f"{'overhead':>9} {'peak KB':>8}")
+        for row in rows:
+            mb = row['size_mb']
+            overhead = (max(row['encrypt'], row['decrypt']) / row['plain'] - 1) * 100
+            peak = max(row['encrypt_peak_kb'], row['decrypt_peak_kb'])
+            print(f"{mb:>6}MB {mb / row['plain']:>11.0f} {mb / row['encrypt']:>13.0f} "
+                  f"{mb / row['decrypt']:>13.0f} {overhead:>8.0f}% {peak:>8.0f}")
+
+    else:
+        print(__doc__)
+        sys.exit(1)
@@ -0,0 +1,380 @@
+#!/usr/bin/env python3
+"""
+MedVault Live Events
+Pushes new notifications and appointment status changes to the pages a
+user has open, over Server-Sent Events.
+
+Events are fed on commit. A session hook in app.py adds a live_event row
+for each change, in the same transaction as the change. Once that
+transaction commits, the hook sends a UDP datagram to wake the event server.
+
+The event server is one asyncio process. Each wake-up reads the new rows
+with one query, however many clients are connected, and hands each row to
+that user's connections. An idle connection costs a socket and a small
+queue, not a thread. Each event carries its row id. A client that
+reconnects with Last-Event-ID is replayed what it missed, from the last
+RETENTION_SECONDS of events.
+
+Sessions are checked again every RECHECK_SECONDS, and at once when a
+worker bumps the security stamp (logout_all), in one query for all open
+streams; revoked ones are closed. No stream outlives MAX_STREAM_SECONDS,
+so every client re-authenticates at least that often.
+
+Run it next to the web workers and send /events to it, e.g. with nginx:
+    location /events { proxy_pass http://127.0.0.1:5002; proxy_buffering off; proxy_read_timeout 1h; }
+and set MEDVAULT_EVENTS_URL=/events for the web workers.
+
+Usage: python events.py [host:port]
+"""
+
+import asyncio
+import socket
+import sys
+from datetime import datetime, timedelta
+from http.cookies import CookieError, SimpleCookie
+from urllib.parse import parse_qs, urlsplit
+
+from itsdangerous import BadSignature
+from sqlalchemy import delete, func, select
+
+from cache import SharedStamp
+
+HEARTBEAT_SECONDS = 25
+RECHECK_SECONDS = 25  # how long a revoked session may keep its stream, at most
+MAX_STREAM_SECONDS = 3600
+POLL_SECONDS = 2.0  # fallback when a wake-up datagram is lost
+RETENTION_SECONDS = 3600
+PRUNE_SECONDS = 300
+TAIL_BATCH = 1000
+LOOKUP_CHUNK = 500  # user ids per IN (...) when rechecking sessions
+REPLAY_LIMIT = 500
+CLIENT_QUEUE = 100  # events a slow client may fall behind before it is dropped
+HEADER_TIMEOUT = 10
+RETRY_MS = 5000
+
+STREAM_HEADERS = (
+    b'HTTP/1.1 200 OK\r\n'
+    b'Content-Type: text/event-stream\r\n'
+    b'Cache-Control: no-cache\r\n'
+    b'Connection: keep-alive\r\n'
+    b'X-Accel-Buffering: no\r\n'
+    b'\r\n'
+)
+
+
+def parse_address(value, default_port=5002):
+    host, _, port = value.rpartition(':')
+    return (host or '127.0.0.1', int(port or default_port))
+
+
+def wake(address):
+    """Tell the event server at (host, port) that new events were committed"""
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.sendto(b'wake', address)
+    except OSError:
+        pass  # The server polls anyway
+
+
+def format_event(event_id, kind, payload):
+    return f'id: {event_id}\nevent: {kind}\ndata: {payload}\n\n'.encode()
+
+
+def session_allowed(session, row):
+    """Same test as app.check_user_verified, on the user's (is_verified, security_version) row"""
+    if row is None or not row.is_verified:
+        return False
+    if 'security_version' not in session:
+        return row.security_version == 1  # issued before any bump
+    return bool(session.get('verified')) and session['security_version'] == row.security_version
+
+
+def plain_response(status, body=''):
+    return (f'HTTP/1.1 {status}\r\nContent-Type: text/plain\r\nContent-Length: {len(body)}\r\n'
+            f'Connection: close\r\n\r\n{body}').encode()
+
+
+class WakeProtocol(asyncio.DatagramProtocol):
+    def __init__(self, event):
+        self.event = event
+
+    def datagram_received(self, data, addr):
+        self.event.set()
+
+
+class Client:
+    """One open /events connection"""
+
+    def __init__(self, session, reader, writer):
+        self.session = session
+        self.user_id = session['user_id']
+        self.reader = reader
+        self.writer = writer
+        self.queue = asyncio.Queue(CLIENT_QUEUE)
+
+    def push(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            # Let it reconnect and catch up from the table instead
+            self.close()
+
+    def close(self):
+        self.writer.transport.abort()
+
+
+class EventServer:
+    """Serves /events for every connected user from one asyncio loop"""
+
+    def __init__(self, app, db, model, user_model, host='127.0.0.1', port=5002,
+                 poll_seconds=POLL_SECONDS, retention_seconds=RETENTION_SECONDS,
+                 recheck_seconds=RECHECK_SECONDS, max_stream_seconds=MAX_STREAM_SECONDS):
+        self.app = app
+        self.db = db
+        self.table = model.__table__
+        self.users = user_model.__table__
+        self.host = host
+        self.port = port
+        self.poll_seconds = poll_seconds
+        self.retention_seconds = retention_seconds
+        self.recheck_seconds = recheck_seconds
+        self.max_stream_seconds = max_stream_seconds
+        # Bumped by app.bump_security_version in any worker
+        self.security_stamp = SharedStamp(app.config['SECURITY_STAMP_FILE'], check_interval=0)
+        self.clients = {}  # user id -> set of Client
+        self.last_id = 0
+        self._server = None
+        self._udp = None
+        self._tail = None
+        self._wake = None
+        self._handlers = set()
+
+    @property
+    def connections(self):
+        return sum(len(clients) for clients in self.clients.values())
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        self._wake = asyncio.Event()
+        self.last_id = await self.run(self.max_id)
+        self._server = await asyncio.start_server(self.handle, self.host, self.port, backlog=1024)
+        self.port = self._server.sockets[0].getsockname()[1]
+        self._udp, _ = await loop.create_datagram_endpoint(lambda: WakeProtocol(self._wake),
+                                                           local_addr=(self.host, self.port))
+        self._tail = asyncio.create_task(self.tail())
+
+    async def stop(self):
+        self._udp.close()
+        self._server.close()
+        self._tail.cancel()
+        for clients in self.clients.values():
+            for client in clients:
+                client.close()
+        await asyncio.gather(self._tail, *self._handlers, return_exceptions=True)
+        await self._server.wait_closed()
+
+    # ---------- database, on the executor's threads ----------
+
+    async def run(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(None, self._in_app_context, function, args)
+
+    def _in_app_context(self, function, args):
+        with self.app.app_context():
+            with self.db.engine.connect() as conn:
+                result = function(conn, *args)
+                conn.commit()
+                return result
+
+    def max_id(self, conn):
+        return conn.execute(select(func.max(self.table.c.id))).scalar() or 0
+
+    def events_after(self, conn, last_id, user_id=None, limit=TAIL_BATCH):
+        query = select(self.table.c.id, self.table.c.user_id, self.table.c.kind, self.table.c.payload).where(
+            self.table.c.id > last_id)
+        if user_id is not None:
+            query = query.where(self.table.c.user_id == user_id)
+        return conn.execute(query.order_by(self.table.c.id).limit(limit)).all()
+
+    def prune(self, conn):
+        cutoff = datetime.utcnow() - timedelta(seconds=self.retention_seconds)
+        return conn.execute(delete(self.table).where(self.table.c.created_at < cutoff)).rowcount
+
+    def security_states(self, conn, user_ids):
+        """{user id: (is_verified, security_version) row} for the users that still exist"""
+        user_ids, states = list(user_ids), {}
+        for start in range(0, len(user_ids), LOOKUP_CHUNK):
+            states.update((row.id, row) for row in conn.execute(
+                select(self.users.c.id, self.users.c.is_verified, self.users.c.security_version).where(
+                    self.users.c.id.in_(user_ids[start:start + LOOKUP_CHUNK]))))
+        return states
+
+    def user_allowed(self, conn, session):
+        return session_allowed(session, self.security_states(conn, [session['user_id']]).get(session['user_id']))
+
+    # ---------- fan-out ----------
+
+    async def tail(self):
+        loop = asyncio.get_running_loop()
+        next_prune = loop.time() + PRUNE_SECONDS
+        next_recheck = loop.time() + self.recheck_seconds
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.poll_seconds)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                if not self.clients:
+                    # Nobody to tell; reconnecting clients replay from the table
+                    self.last_id = await self.run(self.max_id)
+                else:
+                    # Revoked sessions go before they are sent anything new
+                    if self.security_stamp.changed() or loop.time() >= next_recheck:
+                        await self.recheck()
+                        next_recheck = loop.time() + self.recheck_seconds
+                    await self.dispatch()
+                if loop.time() >= next_prune:
+                    await self.run(self.prune)
+                    next_prune = loop.time() + PRUNE_SECONDS
+            except Exception as e:
+                print(f"Live event tail failed: {e}")
+
+    async def dispatch(self):
+        while True:
+            rows = await self.run(self.events_after, self.last_id)
+            for row in rows:
+                self.last_id = row.id
+                for client in list(self.clients.get(row.user_id, ())):
+                    client.push((row.id, row.kind, row.payload))
+            if len(rows) < TAIL_BATCH:
+                return
+
+    async def recheck(self):
+        """Close the streams of sessions that have been revoked since they connected"""
+        clients = [client for clients in self.clients.values() for client in clients]
+        states = await self.run(self.security_states, {client.user_id for client in clients})
+        for client in clients:
+            if not session_allowed(client.session, states.get(client.user_id)):
+                client.close()
+
+    # ---------- one connection ----------
+
+    def session_from(self, headers):
+        """The Flask session in the request's cookie, or None"""
+        try:
+            cookie = SimpleCookie(headers.get('cookie', ''))
+        except CookieError:
+            return None
+        morsel = cookie.get(self.app.config['SESSION_COOKIE_NAME'])
+        if morsel is None:
+            return None
+        serializer = self.app.session_interface.get_signing_serializer(self.app)
+        try:
+            session = serializer.loads(morsel.value,
+                                       max_age=int(self.app.permanent_session_lifetime.total_seconds()))
+        except BadSignature:
+            return None
+        return session if session.get('user_id') else None
+
+    async def handle(self, reader, writer):
+        task = asyncio.current_task()
+        self._handlers.add(task)
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), HEADER_TIMEOUT)
+            headers = {}
+            while True:
+                line = await asyncio.wait_for(reader.readline(), HEADER_TIMEOUT)
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+
+            method, target, _ = request_line.decode('latin-1').split(' ', 2)
+            url = urlsplit(target)
+            if method != 'GET' or url.path.rstrip('/') != '/events':
+                writer.write(plain_response('404 Not Found', 'Not found'))
+                return
+            session = self.session_from(headers)
+            if session is None or not await self.run(self.user_allowed, session):
+                writer.write(plain_response('401 Unauthorized', 'Log in first'))
+                return
+
+            last_event_id = headers.get('last-event-id') or parse_qs(url.query).get('last_event_id', [''])[0]
+            await self.stream(Client(session, reader, writer),
+                              int(last_event_id) if last_event_id.isdigit() else None)
+        except (ConnectionError, asyncio.TimeoutError, ValueError):
+            pass
+        finally:
+            writer.close()
+            self._handlers.discard(task)
+
+    async def stream(self, client, last_event_id):
+        self.clients.setdefault(client.user_id, set()).add(client)
+        try:
+            client.writer.write(STREAM_HEADERS + f'retry: {RETRY_MS}\n\n'.encode())
+            sent = last_event_id or 0
+            if last_event_id is not None:
+                for row in await self.run(self.events_after, last_event_id, client.user_id, REPLAY_LIMIT):
+                    client.writer.write(format_event(row.id, row.kind, row.payload))
+                    sent = row.id
+            await client.writer.drain()
+
+            # The client sends nothing more; end of input means it hung up
+            hung_up = asyncio.ensure_future(client.reader.read())
+            loop = asyncio.get_running_loop()
+            # Then it reconnects, and its session is checked again
+            ends_at = loop.time() + self.max_stream_seconds
+            try:
+                while not client.writer.is_closing():
+                    next_event = asyncio.ensure_future(client.queue.get())
+                    done, _ = await asyncio.wait({next_event, hung_up},
+                                                 timeout=min(HEARTBEAT_SECONDS, max(ends_at - loop.time(), 0)),
+                                                 return_when=asyncio.FIRST_COMPLETED)
+                    if next_event not in done:
+                        next_event.cancel()
+                        if hung_up in done or loop.time() >= ends_at:
+                            return
+                        client.writer.write(b': ping\n\n')
+                    else:
+                        event_id, kind, payload = next_event.result()
+                        if event_id <= sent:
+                            continue  # Already sent by the replay
+                        client.writer.write(format_event(event_id, kind, payload))
+                        sent = event_id
+                    await client.writer.drain()
+            finally:
+                hung_up.cancel()
+        finally:
+            clients = self.clients.get(client.user_id)
+            clients.discard(client)
+            if not clients:
+                del self.clients[client.user_id]
+
+
+def raise_open_file_limit():
+    """Each connection is a file descriptor; allow as many as the hard limit"""
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft != hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        return hard
+    except (ImportError, ValueError, OSError):
+        return None
+
+
+async def serve(server):
+    await server.start()
+    print(f"✅ Live events on http://{server.host}:{server.port}/events (wake-ups on udp/{server.port})")
+    await asyncio.Event().wait()
+
+
+if __name__ == '__main__':
+    from app import app, db, LiveEvent, User
+
+    host, port = parse_address(sys.argv[1] if len(sys.argv) > 1 else app.config['EVENTS_BIND'])
+    raise_open_file_limit()
+    try:
+        asyncio.run(serve(EventServer(app, db, LiveEvent, User, host, port)))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,355 @@
+#!/usr/bin/env python3
+"""
+MedVault Synthetic Data Generator
+Fills an empty database with a realistic, reproducible dataset for load
+tests and benchmarks: hospitals, doctors with weekly schedules, patients,
+two years of appointment history plus upcoming bookings, prescriptions,
+medical records with shares, and notifications.
+
+Scale 1 is about 150,000 rows; sizes grow linearly, so the 1x/10x/100x
+benchmark datasets hold roughly 150k/1.5M/15M rows. The same scale, seed
+and anchor date always give the same rows. Dates are laid out around the
+anchor date (today by default), so "upcoming" screens have data.
+
+Rows are written with plain executemany in id order. The big tables'
+secondary indexes are dropped for the load and rebuilt once at the end,
+which is much faster than keeping them up to date row by row.
+
+Every generated account has the password password123.
+
+Usage: python generate_data.py [scale] [seed] [anchor YYYY-MM-DD]
+       MEDVAULT_DATABASE_URI=sqlite:////tmp/bench-10x.db python generate_data.py 10
+"""
+
+import hashlib
+import json
+import random
+import string
+import sys
+import time
+from datetime import date, timedelta
+
+from app import (app, db, bump_cache_version, Appointment, Doctor, DoctorAvailability, Hospital, MedicalRecord,
+                 Notification, Patient, Prescription, RecordShare, User)
+
+# Rows per unit of scale
+HOSPITALS = 5
+DOCTORS_PER_HOSPITAL = 20
+PATIENTS = 10000
+APPOINTMENTS = 50000
+RECORDS = 10000
+
+HISTORY_DAYS = 730
+BOOKING_DAYS = 60
+SLOTS = [(hour, minute) for hour in range(9, 17) for minute in (0, 30)]  # Weekdays 09:00-17:00
+SATURDAY_SLOTS = SLOTS[:8]  # 09:00-13:00, for doctors who work Saturdays
+BATCH_SIZE = 10000
+PASSWORD = 'password123'
+
+FIRST_NAMES = ['James', 'Mary', 'Robert', 'Patricia', 'John', 'Jennifer', 'Michael', 'Linda', 'David', 'Elizabeth',
+               'William', 'Barbara', 'Richard', 'Susan', 'Joseph', 'Jessica', 'Thomas', 'Sarah', 'Priya', 'Wei',
+               'Aisha', 'Carlos', 'Fatima', 'Hiroshi', 'Olga', 'Kwame', 'Ana', 'Mohammed', 'Ingrid', 'Rahul']
+LAST_NAMES = ['Smith', 'Johnson', 'Williams', 'Brown', 'Jones', 'Garcia', 'Miller', 'Davis', 'Rodriguez', 'Martinez',
+              'Chen', 'Patel', 'Kim', 'Nguyen', 'Okafor', 'Schmidt', 'Rossi', 'Silva', 'Kowalski', 'Haddad']
+SPECIALIZATIONS = ['Cardiology', 'Neurology', 'Pediatrics', 'Orthopedics', 'Dermatology', 'Internal Medicine',
+                   'Gynecology', 'Ophthalmology', 'Psychiatry', 'General Surgery', 'ENT', 'Endocrinology']
+QUALIFICATIONS = ['MD', 'MD, PhD', 'MBBS', 'MBBS, MD', 'DO', 'MD, FACS']
+CITIES = [('Springfield', 39.78, -89.65), ('Riverside', 33.95, -117.40), ('Fairview', 40.81, -73.99),
+          ('Madison', 43.07, -89.40), ('Georgetown', 38.91, -77.07)]
+HOSPITAL_KINDS = ['General Hospital', 'Medical Center', 'Community Hospital', 'Clinic', "Children's Hospital"]
+BLOOD_GROUPS = [('O+', 38), ('A+', 34), ('B+', 9), ('AB+', 3), ('O-', 7), ('A-', 6), ('B-', 2), ('AB-', 1)]
+REASONS = ['Annual checkup', 'Follow-up visit', 'Chest pain', 'Headache', 'Skin rash', 'Back pain',
+           'Blood pressure review', 'Vaccination', 'Lab results discussion', 'Persistent cough']
+MEDICATIONS = [('Amoxicillin', '500mg'), ('Lisinopril', '10mg'), ('Metformin', '850mg'), ('Atorvastatin', '20mg'),
+               ('Ibuprofen', '400mg'), ('Omeprazole', '20mg'), ('Cetirizine', '10mg'), ('Sertraline', '50mg')]
+RECORD_TYPES = [('lab_result', 'Blood panel'), ('scan', 'X-ray'), ('report', 'Discharge summary'),
+                ('prescription', 'Prescription copy'), ('lab_result', 'Urinalysis'), ('scan', 'MRI')]
+
+
+def _date(day):
+    # The SQLAlchemy SQLite storage formats, written directly for speed
+    return day.isoformat()
+
+
+def _datetime(day, hour, minute):
+    return f'{day.isoformat()} {hour:02d}:{minute:02d}:00.000000'
+
+
+def _time(hour, minute):
+    return f'{hour:02d}:{minute:02d}:00.000000'
+
+
+class Generator:
+    """Produces the rows of every table for one scale and seed"""
+
+    def __init__(self, scale=1.0, seed=42, anchor=None):
+        self.random = random.Random(seed)
+        self.anchor = anchor or date.today()
+        self.hospitals = max(1, round(HOSPITALS * scale))
+        self.doctors = self.hospitals * DOCTORS_PER_HOSPITAL
+        self.patients = max(1, round(PATIENTS * scale))
+        self.appointments = max(1, round(APPOINTMENTS * scale))
+        self.records = max(1, round(RECORDS * scale))
+        self.password_hash = self.hash_password(PASSWORD)
+        self.created = _datetime(self.anchor - timedelta(days=HISTORY_DAYS + 30), 8, 0)
+        # Doctor i has user id doctor_user(i), patient j patient_user(j)
+        self.doctor_user = lambda i: self.hospitals + i
+        self.patient_user = lambda j: self.hospitals + self.doctors + j
+        self.saturday_doctors = set()
+
+    def hash_password(self, password, iterations=600000):
+        # werkzeug's pbkdf2 format, with a salt from the seed so reruns give identical rows
+        salt = ''.join(self.random.choice(string.ascii_letters + string.digits) for _ in range(16))
+        digest = hashlib.pbkdf2_hmac('sha256', password.encode(), salt.encode(), iterations).hex()
+        return f'pbkdf2:sha256:{iterations}${salt}${digest}'
+
+    def name(self):
+        return self.random.choice(FIRST_NAMES), self.random.choice(LAST_NAMES)
+
+    def users(self):
+        for kind, count in (('hospital', self.hospitals), ('doctor', self.doctors), ('patient', self.patients)):
+            for i in range(1, count + 1):
+                yield (f'{kind}{i}@medvault.test', self.password_hash, kind, 1, self.created, 1, 0, 0, 0, 0)
+
+    def hospital_rows(self):
+        for i in range(1, self.hospitals + 1):
+            city, latitude, longitude = CITIES[(i - 1) % len(CITIES)]
+            kind = HOSPITAL_KINDS[(i - 1) // len(CITIES) % len(HOSPITAL_KINDS)]
+            street = self.random.randint(1, 999)
+            yield (i, i, f'{city} {kind} {i}', f'{street} Health Avenue, {city}',
+                   f'+1 (555) {self.random.randint(100, 999)}-{self.random.randint(1000, 9999)}',
+                   f'https://hospital{i}.medvault.test', f'Multi-specialty care in {city}.', '+1 (555) 911-0000',
+                   round(latitude + self.random.uniform(-0.2, 0.2), 5),
+                   round(longitude + self.random.uniform(-0.2, 0.2), 5))
+
+    def doctor_rows(self):
+        for i in range(1, self.doctors + 1):
+            first, last = self.name()
+            specialization = self.random.choice(SPECIALIZATIONS)
+            experience = self.random.randint(1, 35)
+            yield (i, self.doctor_user(i), first, last, specialization, self.random.choice(QUALIFICATIONS),
+                   experience, f'+1 (555) {self.random.randint(100, 999)}-{self.random.randint(1000, 9999)}',
+                   (i - 1) // DOCTORS_PER_HOSPITAL + 1,
+                   f'{specialization} specialist with {experience} years of experience.',
+                   float(self.random.randrange(60, 260, 5)), int(self.random.random() < 0.95))
+
+    def availability_rows(self):
+        row_id = 0
+        for i in range(1, self.doctors + 1):
+            days = list(range(5))
+            if self.random.random() < 0.3:
+                days.append(5)
+                self.saturday_doctors.add(i)
+            for day in days:
+                row_id += 1
+                slots = SATURDAY_SLOTS if day == 5 else SLOTS
+                end_hour, end_minute = slots[-1][0], slots[-1][1] + 30
+                yield (row_id, i, day, _time(*slots[0]), _time(end_hour + end_minute // 60, end_minute % 60), 1)
+
+    def patient_rows(self):
+        genders = ['Male', 'Female', 'Other']
+        groups, weights = zip(*BLOOD_GROUPS)
+        for j in range(1, self.patients + 1):
+            first, last = self.name()
+            born = date(1940, 1, 1) + timedelta(days=self.random.randrange(80 * 365))
+            yield (j, self.patient_user(j), first, last, _date(born),
+                   self.random.choices(genders, (49, 49, 2))[0],
+                   f'+1 (555) {self.random.randint(100, 999)}-{self.random.randint(1000, 9999)}',
+                   f'{self.random.randint(1, 9999)} Elm Street', self.random.choices(groups, weights)[0],
+                   'Penicillin' if self.random.random() < 0.08 else None,
+                   f'{self.random.choice(FIRST_NAMES)} {last}')
+
+    def appointment_rows(self):
+        """Appointments in date order, plus the rows that hang off them.
+
+        Yields ('appointment' | 'prescription' | 'notification', row).
+        """
+        first_day = self.anchor - timedelta(days=HISTORY_DAYS)
+        days = [first_day + timedelta(days=offset) for offset in range(HISTORY_DAYS + BOOKING_DAYS)]
+        days = [day for day in days if day.weekday() != 6]  # Closed on Sundays
+        made = prescriptions = notifications = 0
+        for number, day in enumerate(days, 1):
+            slots = SATURDAY_SLOTS if day.weekday() == 5 else SLOTS
+            doctors = sorted(self.saturday_doctors) if day.weekday() == 5 else range(1, self.doctors + 1)
+            # Spread evenly over the open days, never more than the day has slots
+            count = min(round(self.appointments * number / len(days)) - made, len(doctors) * len(slots))
+            for pick in self.random.sample(range(len(doctors) * len(slots)), max(count, 0)):
+                doctor, slot = doctors[pick // len(slots)], slots[pick % len(slots)]
+                made += 1
+                # Some patients come back often, most only now and then
+                patient = int(self.random.random() ** 2 * self.patients) + 1
+                hospital = (doctor - 1) // DOCTORS_PER_HOSPITAL + 1
+                past = day < self.anchor
+                roll = self.random.random()
+                if past:
+                    status = 'completed' if roll < 0.82 else 'cancelled' if roll < 0.95 else 'confirmed'
+                else:
+                    status = 'pending' if roll < 0.45 else 'confirmed' if roll < 0.92 else 'cancelled'
+                booked_on = day - timedelta(days=self.random.randint(1, 30))
+                booked_at = _datetime(booked_on, self.random.randint(7, 21), self.random.randint(0, 59))
+                updated_at = _datetime(day, *slot) if past else booked_at
+                reason = self.random.choice(REASONS)
+                notes = 'Seen and treated.' if status == 'completed' else None
+                yield 'appointment', (made, patient, doctor, hospital, _date(day), _time(*slot), status, reason,
+                                      notes, booked_at, updated_at)
+
+                notifications += 1
+                yield 'notification', (notifications, self.doctor_user(doctor), 'New Appointment',
+                                       f'New appointment request on {day.isoformat()}', 'appointment',
+                                       int(past or self.random.random() < 0.5), booked_at)
+                if status == 'completed' and self.random.random() < 0.4:
+                    prescriptions += 1
+                    medications = [{'name': name, 'dosage': dose, 'frequency': 'twice daily'}
+                                   for name, dose in self.random.sample(MEDICATIONS, self.random.randint(1, 3))]
+                    yield 'prescription', (prescriptions, patient, doctor, made, json.dumps(medications),
+                                           reason, 'Take with food.', _date(day), _date(day + timedelta(days=30)),
+                                           updated_at)
+                if status in ('confirmed', 'cancelled'):
+                    notifications += 1
+                    yield 'notification', (notifications, self.patient_user(patient), f'Appointment {status}',
+                                           f'Your appointment on {day.isoformat()} was {status}', 'appointment',
+                                           int(past), updated_at)
+
+    def record_rows(self):
+        """('record' | 'share', row) for uploaded records and their shares with doctors"""
+        shares = 0
+        first_day = self.anchor - timedelta(days=HISTORY_DAYS)
+        for record in range(1, self.records + 1):
+            patient = int(self.random.random() ** 2 * self.patients) + 1
+            record_type, title = self.random.choice(RECORD_TYPES)
+            day = first_day + timedelta(days=record * HISTORY_DAYS // (self.records + 1))
+            created_at = _datetime(day, self.random.randint(7, 21), self.random.randint(0, 59))
+            shared = self.random.random() < 0.2
+            yield 'record', (record, patient, record_type, f'{title} {day.isoformat()}', None, _date(day),
+                             self.patient_user(patient), created_at, int(shared))
+            if shared:
+                for doctor in sorted(self.random.sample(range(1, self.doctors + 1), min(2, self.doctors))):
+                    shares += 1
+                    yield 'share', (shares, record, doctor, created_at, None)
+
+
+# Columns of each table in the order the generator yields them
+COLUMNS = {
+    User: ('email password_hash user_type is_verified created_at security_version unread_notifications '
+           'appointments_version records_version notifications_version'),
+    Hospital: 'id user_id name address phone website description emergency_number latitude longitude',
+    Doctor: ('id user_id first_name last_name specialization qualification experience phone hospital_id bio '
+             'consultation_fee is_available'),
+    DoctorAvailability: 'id doctor_id day_of_week start_time end_time is_available',
+    Patient: ('id user_id first_name last_name date_of_birth gender phone address blood_group allergies '
+              'emergency_contact'),
+    Appointment: ('id patient_id doctor_id hospital_id appointment_date appointment_time status reason notes '
+                  'created_at updated_at'),
+    Notification: 'id user_id title message notification_type is_read created_at',
+    Prescription: ('id patient_id doctor_id appointment_id medications diagnosis instructions prescribed_date '
+                   'valid_until created_at'),
+    MedicalRecord: 'id patient_id record_type title description record_date uploaded_by created_at is_shared',
+    RecordShare: 'id record_id doctor_id shared_at expires_at',
+}
+
+
+class Writer:
+    """Buffers rows per table and writes them with executemany"""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.buffers = {model: [] for model in COLUMNS}
+        self.counts = dict.fromkeys(COLUMNS, 0)
+        self.statements = {}
+        for model, columns in COLUMNS.items():
+            names = columns.split()
+            self.statements[model] = (f'INSERT INTO {model.__table__.name} ({", ".join(names)}) '
+                                      f'VALUES ({", ".join("?" * len(names))})')
+
+    def add(self, model, row):
+        buffer = self.buffers[model]
+        buffer.append(row)
+        if len(buffer) >= BATCH_SIZE:
+            self.flush(model)
+
+    def add_all(self, model, rows):
+        for row in rows:
+            self.add(model, row)
+
+    def flush(self, model=None):
+        for model in [model] if model else self.buffers:
+            if self.buffers[model]:
+                self.conn.exec_driver_sql(self.statements[model], self.buffers[model])
+                self.counts[model] += len(self.buffers[model])
+                self.buffers[model] = []
+
+
+def generate(scale=1.0, seed=42, anchor=None, progress=None):
+    """Fill the (empty) database. Returns {table name: rows written}."""
+    generator = Generator(scale, seed, anchor)
+    tables = [model.__table__ for model in COLUMNS]
+    with db.engine.connect() as conn:
+        if conn.exec_driver_sql('SELECT 1 FROM user LIMIT 1').first():
+            raise ValueError('the database already has users; generate into an empty database')
+        conn.commit()
+        # Generated data can always be generated again: skip the fsyncs
+        conn.exec_driver_sql('PRAGMA synchronous = OFF')
+        conn.commit()
+        try:
+            with conn.begin():
+                indexes = [index for table in tables for index in table.indexes]
+                for index in indexes:
+                    index.drop(conn)
+
+                writer = Writer(conn)
+                writer.add_all(User, generator.users())
+                writer.add_all(Hospital, generator.hospital_rows())
+                writer.add_all(Doctor, generator.doctor_rows())
+                writer.add_all(DoctorAvailability, generator.availability_rows())
+                writer.add_all(Patient, generator.patient_rows())
+                # Users must be in before their notifications, whose trigger counts them as unread
+                writer.flush()
+                models = {'appointment': Appointment, 'notification': Notification, 'prescription': Prescription,
+                          'record': MedicalRecord, 'share': RecordShare}
+                for kind, row in generator.appointment_rows():
+                    writer.add(models[kind], row)
+                    if progress and kind == 'appointment' and row[0] % 100000 == 0:
+                        progress(row[0], generator.appointments)
+                for kind, row in generator.record_rows():
+                    writer.add(models[kind], row)
+                writer.flush()
+
+                for index in indexes:
+                    index.create(conn)
+                bump_cache_version('directory', conn)
+            with conn.begin():
+                conn.exec_driver_sql('PRAGMA analysis_limit = 1000')
+                conn.exec_driver_sql('ANALYZE')
+            # Fold the load into the database file rather than leave it in a WAL as big as the database
+            conn.exec_driver_sql('PRAGMA wal_checkpoint(TRUNCATE)')
+            conn.commit()
+        finally:
+            conn.rollback()
+            conn.exec_driver_sql('PRAGMA synchronous = NORMAL')
+            conn.commit()
+    return {model.__table__.name: count for model, count in writer.counts.items()}
+
+
+if __name__ == '__main__':
+    scale = float(sys.argv[1]) if len(sys.argv) > 1 else 1.0
+    seed = int(sys.argv[2]) if len(sys.argv) > 2 else 42
+    anchor = date.fromisoformat(sys.argv[3]) if len(sys.argv) > 3 else None
+
+    def report(done, total):
+        print(f"\r   {done:,} of {total:,} appointments", end='', file=sys.stderr, flush=True)
+
+    started = time.perf_counter()
+    with app.app_context():
+        try:
+            counts = generate(scale, seed, anchor, report)
+        except ValueError as exc:
+            print(f"❌ Cannot generate: {exc}")
+            sys.exit(1)
+    print(file=sys.stderr)
+    seconds = time.perf_counter() - started
+    total = sum(counts.values())
+    print(f"✅ Generated {total:,} rows at scale {scale:g} (seed {seed}) in {seconds:.1f}s "
+          f"({total / seconds:,.0f} rows/s)")
+    for table, count in counts.items():
+        print(f"   - {table}: {count:,}")
+    print(f"\n📋 Login: doctor1@medvault.test, patient1@medvault.test, hospital1@medvault.test / {PASSWORD}")
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+MedVault Offline Hospital Geocoder
+Fills Hospital.latitude/longitude from the address using a local gazetteer
+file, so nearest-doctor search works without calling an online service.
+
+The gazetteer is either
+  - a GeoNames dump (cities15000.txt, allCountries.txt, ...: tab separated), or
+  - a CSV with a header row containing name, latitude, longitude and
+    optionally population.
+
+Addresses are matched on their comma-separated parts from the end
+("123 Main St, Springfield, IL 62704" finds "Springfield"), ignoring house
+numbers, postcodes and two-letter region codes. When a place
+name is ambiguous the most populous place wins.
+
+Usage: python geocode.py <gazetteer file> [--all]
+       (--all re-geocodes hospitals that already have coordinates)
+"""
+
+import csv
+import re
+import sys
+
+from sqlalchemy import bindparam, update
+
+# Column positions in the GeoNames "geoname" table
+GEONAMES_NAME, GEONAMES_ASCII, GEONAMES_ALTERNATES, GEONAMES_LAT, GEONAMES_LON = 1, 2, 3, 4, 5
+GEONAMES_POPULATION = 14
+
+
+def normalize(name):
+    """'Saint-Étienne ' -> 'saint etienne'; digits are dropped so postcodes and house numbers go away"""
+    return ' '.join(re.findall(r'[^\W\d_]+', name.lower()))
+
+
+def _add(places, name, latitude, longitude, population):
+    key = normalize(name)
+    if key and (key not in places or population > places[key][2]):
+        places[key] = (latitude, longitude, population)
+
+
+def load_gazetteer(path):
+    """Gazetteer file -> {normalized place name: (latitude, longitude, population)}"""
+    places = {}
+    with open(path, encoding='utf-8', newline='') as f:
+        first = f.readline()
+        f.seek(0)
+        if '\t' in first:
+            for row in csv.reader(f, delimiter='\t', quoting=csv.QUOTE_NONE):
+                if len(row) <= GEONAMES_POPULATION:
+                    continue
+                latitude, longitude = float(row[GEONAMES_LAT]), float(row[GEONAMES_LON])
+                population = int(row[GEONAMES_POPULATION] or 0)
+                names = [row[GEONAMES_NAME], row[GEONAMES_ASCII]] + row[GEONAMES_ALTERNATES].split(',')
+                for name in names:
+                    _add(places, name, latitude, longitude, population)
+        else:
+            for row in csv.DictReader(f):
+                _add(places, row['name'], float(row['latitude']), float(row['longitude']),
+                     int(row.get('population') or 0))
+    return places
+
+
+def geocode_address(address, places):
+    """(latitude, longitude) of the most specific place named in the address, or None"""
+    # Towns come after the street, so search from the end of the address
+    for part in reversed([normalize(part) for part in (address or '').split(',')]):
+        found = places.get(part) if len(part) > 2 else None
+        if found:
+            return found[0], found[1]
+        # "springfield il" -> "springfield": try shorter runs of words,
+        # skipping one- and two-letter region codes
+        words = [word for word in part.split() if len(word) > 2]
+        for length in range(len(words), 0, -1):
+            for start in range(len(words) - length + 1):
+                found = places.get(' '.join(words[start:start + length]))
+                if found:
+                    return found[0], found[1]
+    return None
+
+
+def geocode_hospitals(db, Hospital, places, only_missing=True, batch_size=1000):
+    """Geocode hospitals in batches. Returns (updated, unmatched addresses)."""
+    query = db.session.query(Hospital.id, Hospital.address).order_by(Hospital.id)
+    if only_missing:
+        query = query.filter(Hospital.latitude.is_(None))
+
+    statement = update(Hospital.__table__).where(Hospital.__table__.c.id == bindparam('hospital_id')).values(
+        latitude=bindparam('lat'), longitude=bindparam('lon'))
+
+    updated, unmatched, batch = 0, [], []
+    for hospital_id, address in query.all():
+        found = geocode_address(address, places)
+        if found is None:
+            unmatched.append(address)
+            continue
+        batch.append({'hospital_id': hospital_id, 'lat': found[0], 'lon': found[1]})
+        if len(batch) >= batch_size:
+            updated += len(batch)
+            db.session.execute(statement, batch)
+            batch = []
+    if batch:
+        updated += len(batch)
+        db.session.execute(statement, batch)
+    db.session.commit()
+    return updated, unmatched
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+
+    from app import app, db, Hospital
+
+    places = load_gazetteer(sys.argv[1])
+    print(f"📍 Loaded {len(places)} place names")
+    with app.app_context():
+        updated, unmatched = geocode_hospitals(db, Hospital, places, only_missing='--all' not in sys.argv)
+    print(f"✅ Geocoded {updated} hospitals")
+    for address in unmatched[:20]:
+        print(f"   No match: {address}")
+    if len(unmatched) > 20:
+        print(f"   ... and {len(unmatched) - 20} more")
@@ -0,0 +1,24 @@
+"""
+MedVault gunicorn settings
+Usage: PROMETHEUS_MULTIPROC_DIR=/tmp/medvault-metrics gunicorn app:app
+"""
+
+import os
+import shutil
+
+bind = os.environ.get('MEDVAULT_BIND', '0.0.0.0:5001')
+workers = int(os.environ.get('MEDVAULT_WORKERS', 4))
+
+
+def on_starting(server):
+    # Series left over from the previous run would be added to this one's
+    path = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+    if path:
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path, exist_ok=True)
+
+
+def child_exit(server, worker):
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,595 @@
+#!/usr/bin/env python3
+"""
+MedVault Bulk Importer
+Loads a hospital's existing doctors, schedules, patients and appointment
+history from CSV, JSON (an array of objects) or JSON Lines files.
+
+Rows are read and validated one at a time and written a batch at a time:
+foreign keys (given as email addresses) are looked up for the whole batch
+at once, and each batch goes in with executemany inside one transaction.
+Rows that fail validation or refer to unknown people are skipped and
+written to <file>.rejected.csv with their line number and the reason.
+
+Kind          Columns (* required)
+hospitals     email*, name*, address*, phone*, website, description, emergency_number, latitude, longitude
+doctors       email*, first_name*, last_name*, specialization*, hospital_email, qualification, experience,
+              phone, bio, consultation_fee, is_available
+availability  doctor_email*, day_of_week* (0-6 or mon-sun), start_time*, end_time*, is_available
+patients      email*, first_name*, last_name*, date_of_birth, gender, phone, address, blood_group,
+              allergies, emergency_contact
+appointments  patient_email*, doctor_email*, appointment_date*, appointment_time*, status, reason, notes
+
+Import them in that order. Accounts are created verified and without a
+password (people sign in with an emailed OTP); no emails are sent.
+
+Usage: python importer.py <kind> <file> [batch size]
+"""
+
+import csv
+import json
+import os
+import sys
+import time
+from datetime import date, datetime, time as time_of_day
+
+from sqlalchemy import Column, Date, Integer, MetaData, Table, Time, and_, insert, select, text
+
+from app import (app, db, bump_cache_version, Appointment, Doctor, DoctorAvailability, Hospital, Patient, User)
+
+BATCH_SIZE = 5000
+LOOKUP_CHUNK = 500  # Keys per IN (...) lookup
+PROGRESS_EVERY = 50000
+CACHE_KB = 256 * 1024  # SQLite page cache while importing
+
+# Imported accounts have no password; no password hash matches this
+NO_PASSWORD = '!imported'
+APPOINTMENT_STATUSES = ('pending', 'confirmed', 'completed', 'cancelled')
+WEEKDAYS = ('mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun')
+
+# Per-connection scratch table of the appointment slots in a batch
+import_slot = Table('import_slot', MetaData(), Column('doctor_id', Integer), Column('appointment_date', Date),
+                    Column('appointment_time', Time), prefixes=['TEMPORARY'])
+
+
+class RowError(ValueError):
+    """A row that cannot be imported; the message says why"""
+
+
+class UnreadableRow(RowError):
+    """Stands in for a line or item that could not be decoded; `text` is what was read"""
+
+    def __init__(self, reason, text):
+        super().__init__(reason)
+        self.text = text
+
+
+# ---------- reading ----------
+
+def _json_array(f, chunk_size=1 << 16):
+    """Objects of a top-level JSON array, decoded as the file is read.
+
+    A broken array cannot be read past; it ends with an UnreadableRow.
+    """
+    decoder = json.JSONDecoder()
+    buffer, position, opened = '', 0, False
+    while True:
+        chunk = f.read(chunk_size)
+        buffer, position = buffer[position:] + chunk, 0
+        while True:
+            # Skip whitespace and the separators between values
+            while position < len(buffer) and (buffer[position].isspace() or (opened and buffer[position] == ',')):
+                position += 1
+            if position == len(buffer):
+                break
+            if not opened:
+                if buffer[position] != '[':
+                    yield UnreadableRow('file is not a JSON array', buffer[position:position + 200])
+                    return
+                opened = True
+                position += 1
+            elif buffer[position] == ']':
+                return
+            else:
+                try:
+                    value, position = decoder.raw_decode(buffer, position)
+                except json.JSONDecodeError:
+                    if not chunk:
+                        yield UnreadableRow('file ends inside a JSON value', buffer[position:position + 200])
+                        return
+                    break  # The value continues in the next chunk
+                yield value
+        if not chunk:
+            if opened:
+                yield UnreadableRow('JSON array is not closed', '')
+                return
+            return
+
+
+def read_rows(path):
+    """(line or item number, row dict) for each row of a CSV, JSON or JSON Lines file"""
+    with open(path, encoding='utf-8-sig', newline='') as f:
+        if path.endswith('.jsonl'):
+            for number, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    row = json.loads(line)
+                except json.JSONDecodeError as exc:
+                    row = UnreadableRow(f'not JSON: {exc.msg}', line.rstrip('\r\n'))
+                yield number, row
+        elif path.endswith('.json'):
+            yield from enumerate(_json_array(f), 1)
+        else:
+            reader = csv.DictReader(f)
+            for row in reader:
+                yield reader.line_num, row
+
+
+# ---------- field parsers ----------
+
+def _blank(value):
+    return value is None or (isinstance(value, str) and not value.strip())
+
+
+def text_field(max_length=None):
+    def parse(value):
+        value = str(value).strip()
+        if max_length and len(value) > max_length:
+            raise RowError(f'longer than {max_length} characters')
+        return value
+    return parse
+
+
+def email_field(value):
+    # Kept as typed: the app stores and looks up emails case-sensitively
+    value = str(value).strip()
+    if '@' not in value or len(value) > 120:
+        raise RowError('not an email address')
+    return value
+
+
+def int_field(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise RowError('not a whole number') from None
+
+
+def float_field(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        raise RowError('not a number') from None
+
+
+def bool_field(value):
+    if isinstance(value, bool):
+        return value
+    value = str(value).strip().lower()
+    if value in ('1', 'true', 'yes', 'y'):
+        return True
+    if value in ('0', 'false', 'no', 'n'):
+        return False
+    raise RowError('not true/false')
+
+
+def date_field(value):
+    try:
+        return date.fromisoformat(str(value).strip())
+    except ValueError:
+        raise RowError('not a YYYY-MM-DD date') from None
+
+
+def time_field(value):
+    try:
+        return time_of_day.fromisoformat(str(value).strip())
+    except ValueError:
+        raise RowError('not an HH:MM time') from None
+
+
+def weekday_field(value):
+    value = str(value).strip().lower()
+    if value[:3] in WEEKDAYS:
+        return WEEKDAYS.index(value[:3])
+    day = int_field(value)
+    if not 0 <= day <= 6:
+        raise RowError('not a weekday (0=Monday .. 6=Sunday)')
+    return day
+
+
+def choice_field(choices):
+    def parse(value):
+        value = str(value).strip().lower()
+        if value not in choices:
+            raise RowError(f'not one of {", ".join(choices)}')
+        return value
+    return parse
+
+
+def chunked(values, size=LOOKUP_CHUNK):
+    values = list(values)
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+def bulk_insert(conn, table, rows):
+    """executemany of plain INSERTs straight on the driver.
+
+    Core's per-row parameter handling costs more than SQLite's insert at
+    this volume; each value only goes through its column's bind processor.
+    Column defaults are not applied, so rows must give every value they need.
+    """
+    if not rows:
+        return
+    columns = [table.c[name] for name in rows[0]]
+    processors = [(column.name, column.type.dialect_impl(conn.dialect).bind_processor(conn.dialect))
+                  for column in columns]
+    statement = (f'INSERT INTO {table.name} ({", ".join(column.name for column in columns)}) '
+                 f'VALUES ({", ".join("?" * len(columns))})')
+    conn.exec_driver_sql(statement, [
+        tuple(row[name] if process is None or row[name] is None else process(row[name])
+              for name, process in processors)
+        for row in rows
+    ])
+
+
+# ---------- importers ----------
+
+class Importer:
+    """Validates rows one at a time and writes them a batch at a time.
+
+    Subclasses list their `columns` ({name: (parser, required)}) and write
+    a batch in `write()`, returning {line: reason} for rows they reject.
+    """
+
+    kind = None
+    columns = {}
+    directory_change = False  # Doctor/hospital imports refresh the workers' directory caches
+
+    def __init__(self, batch_size=BATCH_SIZE, progress=None):
+        self.batch_size = batch_size
+        self.progress = progress
+        self.now = datetime.utcnow()
+        self.rows = self.imported = 0
+        self.rejected = []  # (line, reason, raw row)
+
+    def validate(self, raw):
+        if not isinstance(raw, dict):
+            raise RowError('not an object')
+        row = {}
+        for column, (parse, required) in self.columns.items():
+            value = raw.get(column)
+            if _blank(value):
+                if required:
+                    raise RowError(f'{column}: missing')
+                row[column] = None
+                continue
+            try:
+                row[column] = parse(value)
+            except RowError as exc:
+                raise RowError(f'{column}: {exc}') from None
+        return row
+
+    def run(self, rows):
+        started = time.perf_counter()
+        with db.engine.connect() as conn:
+            # Index pages of a big table stay cached between batches
+            default_cache = conn.exec_driver_sql('PRAGMA cache_size').scalar()
+            conn.exec_driver_sql(f'PRAGMA cache_size = -{CACHE_KB}')
+            conn.commit()
+            try:
+                batch = []
+                for line, raw in rows:
+                    self.rows += 1
+                    if isinstance(raw, UnreadableRow):
+                        self.rejected.append((line, str(raw), raw.text))
+                        continue
+                    try:
+                        batch.append((line, raw, self.validate(raw)))
+                    except RowError as exc:
+                        self.rejected.append((line, str(exc), raw))
+                    if len(batch) >= self.batch_size:
+                        self._flush(conn, batch)
+                        batch = []
+                    if self.progress and self.rows % PROGRESS_EVERY == 0:
+                        self.progress(self, time.perf_counter() - started)
+                if batch:
+                    self._flush(conn, batch)
+                if self.imported:
+                    with conn.begin():
+                        # Bulk loads change the shape of the data; refresh the planner statistics
+                        conn.exec_driver_sql('PRAGMA analysis_limit = 1000')
+                        conn.exec_driver_sql('ANALYZE')
+            finally:
+                conn.rollback()
+                conn.exec_driver_sql(f'PRAGMA cache_size = {default_cache}')
+                conn.commit()
+        return self
+
+    def _flush(self, conn, batch):
+        raw_rows = {line: raw for line, raw, _ in batch}
+        with conn.begin():
+            errors = self.write(conn, [(line, row) for line, _, row in batch])
+            if self.directory_change:
+                bump_cache_version('directory', conn)
+        self.imported += len(batch) - len(errors)
+        self.rejected.extend((line, reason, raw_rows[line]) for line, reason in errors.items())
+
+    def write(self, conn, batch):
+        raise NotImplementedError
+
+    # ---------- bulk lookups ----------
+
+    @staticmethod
+    def lookup(conn, statement, key_column, keys):
+        """{key: row} for the keys, queried LOOKUP_CHUNK at a time"""
+        found = {}
+        for chunk in chunked(set(keys)):
+            for row in conn.execute(statement.where(key_column.in_(chunk))):
+                found[row[0]] = row
+        return found
+
+    def new_accounts(self, conn, batch, user_type, errors):
+        """Create verified accounts for the batch's unused emails. Returns [(line, row, user id)]."""
+        users = User.__table__
+        taken = self.lookup(conn, select(users.c.email), users.c.email, [row['email'] for _, row in batch])
+        fresh = []
+        for line, row in batch:
+            if row['email'] in taken:
+                errors[line] = f'email: {row["email"]} is already registered'
+            else:
+                taken[row['email']] = None
+                fresh.append((line, row))
+        if not fresh:
+            return []
+        ids = conn.execute(
+            insert(users).returning(users.c.id, sort_by_parameter_order=True),
+            [{'email': row['email'], 'password_hash': NO_PASSWORD, 'user_type': user_type, 'is_verified': True,
+              'created_at': self.now, 'security_version': 1} for _, row in fresh],
+        ).scalars().all()
+        return [(line, row, user_id) for (line, row), user_id in zip(fresh, ids)]
+
+    def profiles_by_email(self, conn, model, emails, *columns):
+        """{email: (email, profile id, *columns)} for doctor/patient/hospital profiles"""
+        users, table = User.__table__, model.__table__
+        statement = select(users.c.email, table.c.id, *columns).join(table, table.c.user_id == users.c.id)
+        return self.lookup(conn, statement, users.c.email, emails)
+
+
+class HospitalImporter(Importer):
+    kind = 'hospitals'
+    directory_change = True
+    columns = {
+        'email': (email_field, True),
+        'name': (text_field(150), True),
+        'address': (text_field(), True),
+        'phone': (text_field(20), True),
+        'website': (text_field(200), False),
+        'description': (text_field(), False),
+        'emergency_number': (text_field(20), False),
+        'latitude': (float_field, False),
+        'longitude': (float_field, False),
+    }
+
+    def write(self, conn, batch):
+        errors = {}
+        accounts = self.new_accounts(conn, batch, 'hospital', errors)
+        if accounts:
+            conn.execute(insert(Hospital.__table__), [
+                {**{column: row[column] for column in self.columns if column != 'email'}, 'user_id': user_id}
+                for _, row, user_id in accounts
+            ])
+        return errors
+
+
+class DoctorImporter(Importer):
+    kind = 'doctors'
+    directory_change = True
+    columns = {
+        'email': (email_field, True),
+        'first_name': (text_field(50), True),
+        'last_name': (text_field(50), True),
+        'specialization': (text_field(100), True),
+        'hospital_email': (email_field, False),
+        'qualification': (text_field(100), False),
+        'experience': (int_field, False),
+        'phone': (text_field(20), False),
+        'bio': (text_field(), False),
+        'consultation_fee': (float_field, False),
+        'is_available': (bool_field, False),
+    }
+
+    def write(self, conn, batch):
+        errors = {}
+        hospitals = self.profiles_by_email(conn, Hospital, [row['hospital_email'] for _, row in batch
+                                                            if row['hospital_email']])
+        valid = []
+        for line, row in batch:
+            if row['hospital_email'] and row['hospital_email'] not in hospitals:
+                errors[line] = f'hospital_email: no hospital {row["hospital_email"]}'
+            else:
+                valid.append((line, row))
+        accounts = self.new_accounts(conn, valid, 'doctor', errors)
+        if accounts:
+            conn.execute(insert(Doctor.__table__), [{
+                'user_id': user_id, 'first_name': row['first_name'], 'last_name': row['last_name'],
+                'specialization': row['specialization'], 'qualification': row['qualification'],
+                'experience': row['experience'] or 0, 'phone': row['phone'], 'bio': row['bio'],
+                'consultation_fee': row['consultation_fee'] or 0.0,
+                'is_available': True if row['is_available'] is None else row['is_available'],
+                'hospital_id': hospitals[row['hospital_email']][1] if row['hospital_email'] else None,
+            } for _, row, user_id in accounts])
+        return errors
+
+
+class AvailabilityImporter(Importer):
+    kind = 'availability'
+    columns = {
+        'doctor_email': (email_field, True),
+        'day_of_week': (weekday_field, True),
+        'start_time': (time_field, True),
+        'end_time': (time_field, True),
+        'is_available': (bool_field, False),
+    }
+
+    def validate(self, raw):
+        row = super().validate(raw)
+        if row['end_time'] <= row['start_time']:
+            raise RowError('end_time: not after start_time')
+        return row
+
+    def write(self, conn, batch):
+        errors = {}
+        doctors = self.profiles_by_email(conn, Doctor, [row['doctor_email'] for _, row in batch])
+        rows = []
+        for line, row in batch:
+            if row['doctor_email'] not in doctors:
+                errors[line] = f'doctor_email: no doctor {row["doctor_email"]}'
+                continue
+            rows.append({'doctor_id': doctors[row['doctor_email']][1], 'day_of_week': row['day_of_week'],
+                         'start_time': row['start_time'], 'end_time': row['end_time'],
+                         'is_available': True if row['is_available'] is None else row['is_available']})
+        if rows:
+            bulk_insert(conn, DoctorAvailability.__table__, rows)
+        return errors
+
+
+class PatientImporter(Importer):
+    kind = 'patients'
+    columns = {
+        'email': (email_field, True),
+        'first_name': (text_field(50), True),
+        'last_name': (text_field(50), True),
+        'date_of_birth': (date_field, False),
+        'gender': (text_field(10), False),
+        'phone': (text_field(20), False),
+        'address': (text_field(), False),
+        'blood_group': (text_field(10), False),
+        'allergies': (text_field(), False),
+        'emergency_contact': (text_field(100), False),
+    }
+
+    def write(self, conn, batch):
+        errors = {}
+        accounts = self.new_accounts(conn, batch, 'patient', errors)
+        if accounts:
+            conn.execute(insert(Patient.__table__), [
+                {**{column: row[column] for column in self.columns if column != 'email'}, 'user_id': user_id}
+                for _, row, user_id in accounts
+            ])
+        return errors
+
+
+class AppointmentImporter(Importer):
+    kind = 'appointments'
+    columns = {
+        'patient_email': (email_field, True),
+        'doctor_email': (email_field, True),
+        'appointment_date': (date_field, True),
+        'appointment_time': (time_field, True),
+        'status': (choice_field(APPOINTMENT_STATUSES), False),
+        'reason': (text_field(), False),
+        'notes': (text_field(), False),
+    }
+
+    def write(self, conn, batch):
+        errors = {}
+        patients = self.profiles_by_email(conn, Patient, [row['patient_email'] for _, row in batch])
+        doctors = self.profiles_by_email(conn, Doctor, [row['doctor_email'] for _, row in batch],
+                                         Doctor.__table__.c.hospital_id)
+        rows, lines, slots = [], [], set()
+        for line, row in batch:
+            if row['patient_email'] not in patients:
+                errors[line] = f'patient_email: no patient {row["patient_email"]}'
+                continue
+            if row['doctor_email'] not in doctors:
+                errors[line] = f'doctor_email: no doctor {row["doctor_email"]}'
+                continue
+            _, doctor_id, hospital_id = doctors[row['doctor_email']]
+            status = row['status'] or 'completed'
+            slot = (doctor_id, row['appointment_date'], row['appointment_time'])
+            if status != 'cancelled':
+                if slot in slots:
+                    errors[line] = 'appointment_time: slot already taken earlier in the file'
+                    continue
+                slots.add(slot)
+            rows.append({'patient_id': patients[row['patient_email']][1], 'doctor_id': doctor_id,
+                         'hospital_id': hospital_id, 'appointment_date': row['appointment_date'],
+                         'appointment_time': row['appointment_time'], 'status': status,
+                         'reason': row['reason'], 'notes': row['notes'],
+                         'created_at': self.now, 'updated_at': self.now})
+            lines.append(line)
+
+        booked = self.booked_slots(conn, slots)
+        if booked:
+            keep = []
+            for line, row in zip(lines, rows):
+                if row['status'] != 'cancelled' and (row['doctor_id'], row['appointment_date'],
+                                                     row['appointment_time']) in booked:
+                    errors[line] = 'appointment_time: slot already booked'
+                else:
+                    keep.append(row)
+            rows = keep
+        if rows:
+            bulk_insert(conn, Appointment.__table__, rows)
+        return errors
+
+    @staticmethod
+    def booked_slots(conn, slots):
+        """The slots that already hold an active appointment, found through the unique slot index"""
+        if not slots:
+            return set()
+        conn.execute(text('CREATE TEMP TABLE IF NOT EXISTS import_slot '
+                          '(doctor_id INTEGER, appointment_date DATE, appointment_time TIME)'))
+        conn.execute(import_slot.delete())
+        bulk_insert(conn, import_slot, [
+            {'doctor_id': doctor_id, 'appointment_date': day, 'appointment_time': at} for doctor_id, day, at in slots
+        ])
+        # One index seek per slot; a row-value IN (...) would scan the whole index
+        appointments = Appointment.__table__
+        found = conn.execute(select(import_slot).join(appointments, and_(
+            appointments.c.doctor_id == import_slot.c.doctor_id,
+            appointments.c.appointment_date == import_slot.c.appointment_date,
+            appointments.c.appointment_time == import_slot.c.appointment_time,
+            appointments.c.status != 'cancelled',
+        )))
+        return {tuple(row) for row in found}
+
+
+IMPORTERS = {importer.kind: importer for importer in
+             (HospitalImporter, DoctorImporter, AvailabilityImporter, PatientImporter, AppointmentImporter)}
+
+
+def import_file(kind, path, batch_size=BATCH_SIZE, progress=None):
+    """Import one file. Returns the finished Importer (rows, imported, rejected)."""
+    with app.app_context():
+        return IMPORTERS[kind](batch_size, progress).run(read_rows(path))
+
+
+def write_rejected(path, rejected):
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['line', 'reason', 'row'])
+        for line, reason, raw in rejected:
+            writer.writerow([line, reason, json.dumps(raw, default=str)])
+
+
+def print_progress(importer, seconds):
+    print(f"\r   {importer.rows:,} rows read, {len(importer.rejected):,} rejected "
+          f"({importer.rows / seconds:,.0f} rows/s)", end='', file=sys.stderr, flush=True)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3 or sys.argv[1] not in IMPORTERS:
+        print(__doc__)
+        sys.exit(1)
+
+    kind, path = sys.argv[1], sys.argv[2]
+    started = time.perf_counter()
+    result = import_file(kind, path, int(sys.argv[3]) if len(sys.argv) > 3 else BATCH_SIZE, print_progress)
+    print(file=sys.stderr)
+    print(f"✅ Imported {result.imported:,} of {result.rows:,} {kind} rows in {time.perf_counter() - started:.1f}s")
+    if result.rejected:
+        rejected_path = os.path.splitext(path)[0] + '.rejected.csv'
+        write_rejected(rejected_path, result.rejected)
+        print(f"⚠️  {len(result.rejected):,} rows rejected, see {rejected_path}")
@@ -263,11 +263,45 @@ function togglePasswordVisibility(inputId) {
 // ==================== DASHBOARD HELPERS ====================
 
 /**
- * Update dashboard statistics
+ * Live updates: new notifications and appointment status changes arrive
+ * over Server-Sent Events (events.py) instead of reloading the page.
+ * EventSource reconnects by itself and resumes after the last event it saw.
  */
-function updateStats() {
-    // This can be extended to fetch fresh data
-    console.log('Updating dashboard stats...');
+function connectLiveEvents(url) {
+    if (!url || !window.EventSource) return null;
+    const source = new EventSource(url, { withCredentials: true });
+
+    source.addEventListener('notification', function(e) {
+        const notification = JSON.parse(e.data);
+        showNotification(`<strong>${escapeHtml(notification.title)}</strong><br>${escapeHtml(notification.message)}`, 'info');
+        document.querySelectorAll('.notification-btn').forEach(button => {
+            if (!button.querySelector('.notification-badge')) {
+                const badge = document.createElement('span');
+                badge.className = 'notification-badge';
+                button.appendChild(badge);
+            }
+        });
+    });
+
+    source.addEventListener('appointment', function(e) {
+        const appointment = JSON.parse(e.data);
+        const badges = document.querySelectorAll(`[data-appointment-id="${appointment.id}"]`);
+        badges.forEach(badge => {
+            badge.className = badge.className.replace(/\bstatus-\w+/, `status-${appointment.status}`);
+            badge.textContent = appointment.status.charAt(0).toUpperCase() + appointment.status.slice(1);
+        });
+        if (badges.length) {
+            showNotification(`Appointment on ${formatDate(appointment.date)} at ${appointment.time} is now ${appointment.status}`, 'info');
+        }
+    });
+
+    return source;
+}
+
+function escapeHtml(text) {
+    const div = document.createElement('div');
+    div.textContent = text;
+    return div.innerHTML;
 }
 
 /**
@@ -361,6 +395,9 @@ document.addEventListener('DOMContentLoaded', function() {
     // Initialize smooth scroll
     initializeSmoothScroll();
     
+    // Live notifications and appointment updates on dashboard pages
+    connectLiveEvents(document.body.dataset.eventsUrl);
+    
     console.log('MedVault initialized successfully');
 });
 
@@ -0,0 +1,98 @@
+"""
+MedVault Prometheus Metrics
+Request latency histograms, status counters and in-flight gauges per Flask
+endpoint, plus database pool, email and upload metrics, served at /metrics.
+
+Under gunicorn every worker keeps its own numbers. Set
+PROMETHEUS_MULTIPROC_DIR to an empty directory shared by the workers (and
+wipe it on deploy) so /metrics reports the sum across all of them;
+gunicorn.conf.py cleans up after workers that exit.
+"""
+
+import os
+import time
+
+from flask import Response, g, request
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram,
+                               generate_latest, multiprocess)
+from sqlalchemy import event
+from sqlalchemy.pool import Pool
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+REQUEST_LATENCY = Histogram(
+    'medvault_request_duration_seconds', 'Time to handle a request', ['endpoint', 'method'],
+    buckets=LATENCY_BUCKETS)
+REQUESTS = Counter(
+    'medvault_requests_total', 'Requests handled', ['endpoint', 'method', 'status'])
+IN_FLIGHT = Gauge(
+    'medvault_requests_in_flight', 'Requests being handled right now', ['endpoint'],
+    multiprocess_mode='livesum')
+
+DB_CHECKOUTS = Counter(
+    'medvault_db_pool_checkouts_total', 'Connections checked out of the database pool')
+DB_CHECKED_OUT = Gauge(
+    'medvault_db_pool_checked_out', 'Database connections currently checked out',
+    multiprocess_mode='livesum')
+
+EMAIL_SEND_LATENCY = Histogram(
+    'medvault_email_send_seconds', 'Time to hand one email to the SMTP server', ['outcome'],
+    buckets=LATENCY_BUCKETS)
+UPLOAD_BYTES = Counter(
+    'medvault_upload_bytes_total', 'Bytes of medical record files uploaded')
+
+
+def endpoint_label():
+    # Only routed endpoints become labels, so a URL scan cannot add series
+    return request.endpoint or 'unmatched'
+
+
+def _start_request():
+    g.metrics_started = time.perf_counter()
+    g.metrics_endpoint = endpoint_label()
+    IN_FLIGHT.labels(g.metrics_endpoint).inc()
+
+
+def _finish_request(response):
+    started = g.get('metrics_started')
+    if started is not None:
+        endpoint = g.metrics_endpoint
+        REQUEST_LATENCY.labels(endpoint, request.method).observe(time.perf_counter() - started)
+        REQUESTS.labels(endpoint, request.method, str(response.status_code)).inc()
+    return response
+
+
+def _teardown_request(exc):
+    endpoint = g.pop('metrics_endpoint', None)
+    if endpoint is not None:
+        IN_FLIGHT.labels(endpoint).dec()
+
+
+def _pool_checkout(dbapi_connection, connection_record, connection_proxy):
+    DB_CHECKOUTS.inc()
+    DB_CHECKED_OUT.inc()
+
+
+def _pool_checkin(dbapi_connection, connection_record):
+    DB_CHECKED_OUT.dec()
+
+
+def init_app(app):
+    """Time every request and count pool checkouts"""
+    # Registered first so the timing covers the app's own before_request hooks
+    app.before_request_funcs.setdefault(None, []).insert(0, _start_request)
+    app.after_request(_finish_request)
+    app.teardown_request(_teardown_request)
+    if not event.contains(Pool, 'checkout', _pool_checkout):
+        event.listen(Pool, 'checkout', _pool_checkout)
+        event.listen(Pool, 'checkin', _pool_checkin)
+
+
+def render():
+    """The /metrics response: all workers when multiprocess mode is on, else this process"""
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return Response(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
@@ -0,0 +1,430 @@
+#!/usr/bin/env python3
+"""
+MedVault Schema Migrations
+db.create_all() only creates tables that are missing, it never changes a table
+that already exists in an older medvault.db. The steps here bring such a
+database up to date and are safe to run on every startup.
+
+Usage: python migrations.py
+"""
+
+from sqlalchemy import inspect, text
+from sqlalchemy.exc import IntegrityError
+
+
+def ensure_indexes(db):
+    """Create model indexes that are missing from existing tables.
+
+    Returns the names of the indexes that were created.
+    """
+    inspector = inspect(db.engine)
+    existing_tables = set(inspector.get_table_names())
+    created = []
+
+    for table in db.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        existing_indexes = {ix['name'] for ix in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing_indexes:
+                try:
+                    index.create(bind=db.engine)
+                except IntegrityError:
+                    # Existing rows break a unique index (e.g. double-booked
+                    # slots); leave them for an admin to resolve
+                    print(f"WARNING: could not create unique index {index.name} on {table.name}: "
+                          f"existing rows contain duplicates")
+                    continue
+                created.append(index.name)
+                print(f"Created index {index.name} on {table.name}")
+
+    if created:
+        # Refresh planner statistics so SQLite picks up the new indexes
+        with db.engine.begin() as conn:
+            conn.execute(text('ANALYZE'))
+
+    return created
+
+
+def column_names(conn, table):
+    return {row[1] for row in conn.execute(text(f'PRAGMA table_info({table})'))}
+
+
+def ensure_columns(db):
+    """Add model columns that are missing from existing tables.
+
+    SQLite can only add a NOT NULL column together with a constant default,
+    so such columns need a scalar default on the model.
+    Returns the "table.column" names that were added.
+    """
+    existing_tables = set(inspect(db.engine).get_table_names())
+    added = []
+
+    with db.engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                continue
+            present = column_names(conn, table.name)
+            for column in table.columns:
+                if column.name in present:
+                    continue
+                ddl = f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(db.engine.dialect)}'
+                default = column.default.arg if column.default is not None and column.default.is_scalar else None
+                if default is not None:
+                    ddl += f' DEFAULT {int(default) if isinstance(default, bool) else repr(default)}'
+                if not column.nullable and default is not None:
+                    ddl += ' NOT NULL'
+                conn.execute(text(ddl))
+                added.append(f'{table.name}.{column.name}')
+                print(f"Added column {column.name} to {table.name}")
+
+    return added
+
+
+def migrate_shared_with(db):
+    """Move the old comma-separated medical_record.shared_with column into record_share.
+
+    The column is left in place but emptied, so this runs once per database.
+    Returns the number of shares created.
+    """
+    created = 0
+    with db.engine.begin() as conn:
+        if 'shared_with' not in column_names(conn, 'medical_record'):
+            return 0
+
+        rows = conn.execute(text(
+            "SELECT id, shared_with, created_at FROM medical_record "
+            "WHERE shared_with IS NOT NULL AND shared_with != ''"
+        )).fetchall()
+        doctor_ids = {row[0] for row in conn.execute(text('SELECT id FROM doctor'))}
+
+        shares = []
+        for record_id, shared_with, created_at in rows:
+            for part in shared_with.split(','):
+                part = part.strip()
+                if part.isdigit() and int(part) in doctor_ids:
+                    shares.append({'record_id': record_id, 'doctor_id': int(part), 'shared_at': created_at})
+
+        if shares:
+            created = conn.execute(text(
+                "INSERT OR IGNORE INTO record_share (record_id, doctor_id, shared_at) "
+                "VALUES (:record_id, :doctor_id, :shared_at)"
+            ), shares).rowcount
+            conn.execute(text(
+                "UPDATE medical_record SET is_shared = 1 "
+                "WHERE id IN (SELECT record_id FROM record_share)"
+            ))
+        conn.execute(text("UPDATE medical_record SET shared_with = NULL WHERE shared_with IS NOT NULL"))
+
+    if created:
+        print(f"Migrated {created} record shares out of medical_record.shared_with")
+    return created
+
+
+def drop_legacy_otp(db):
+    """Drop the old otp table, which kept a row for every code ever sent.
+
+    Live codes are now in otp_code (or another otpstore backend); anything in
+    the old table was single use and at most ten minutes from expiring, so
+    nothing is carried over. Returns the number of rows dropped.
+    """
+    if 'otp' not in inspect(db.engine).get_table_names():
+        return 0
+    with db.engine.begin() as conn:
+        dropped = conn.execute(text('SELECT COUNT(*) FROM otp')).scalar()
+        conn.execute(text('DROP TABLE otp'))
+    print(f"Dropped the old otp table ({dropped} rows)")
+    return dropped
+
+
+# Full-text index behind /search_doctors. rowid is the doctor id; the hospital
+# columns are copied in so one MATCH covers "cardio* near Springfield".
+DOCTOR_SEARCH_COLUMNS = ('name', 'specialization', 'qualification', 'bio', 'hospital_name', 'hospital_address')
+
+DOCTOR_SEARCH_ROW = """
+    SELECT d.id, d.first_name || ' ' || d.last_name, d.specialization, d.qualification, d.bio,
+           h.name, h.address
+    FROM doctor d LEFT JOIN hospital h ON h.id = d.hospital_id
+"""
+
+DOCTOR_SEARCH_DDL = [
+    f"""CREATE VIRTUAL TABLE IF NOT EXISTS doctor_search USING fts5(
+        {', '.join(DOCTOR_SEARCH_COLUMNS)},
+        tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3'
+    )""",
+    # Keep the index in step with every write to doctor and hospital, from any code path
+    f"""CREATE TRIGGER IF NOT EXISTS doctor_search_insert AFTER INSERT ON doctor BEGIN
+        INSERT INTO doctor_search (rowid, {', '.join(DOCTOR_SEARCH_COLUMNS)})
+        {DOCTOR_SEARCH_ROW} WHERE d.id = NEW.id;
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS doctor_search_update
+    AFTER UPDATE OF first_name, last_name, specialization, qualification, bio, hospital_id ON doctor BEGIN
+        DELETE FROM doctor_search WHERE rowid = OLD.id;
+        INSERT INTO doctor_search (rowid, {', '.join(DOCTOR_SEARCH_COLUMNS)})
+        {DOCTOR_SEARCH_ROW} WHERE d.id = NEW.id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS doctor_search_delete AFTER DELETE ON doctor BEGIN
+        DELETE FROM doctor_search WHERE rowid = OLD.id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS doctor_search_hospital_update AFTER UPDATE OF name, address ON hospital BEGIN
+        UPDATE doctor_search SET hospital_name = NEW.name, hospital_address = NEW.address
+        WHERE rowid IN (SELECT id FROM doctor WHERE hospital_id = NEW.id);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS doctor_search_hospital_delete AFTER DELETE ON hospital BEGIN
+        UPDATE doctor_search SET hospital_name = NULL, hospital_address = NULL
+        WHERE rowid IN (SELECT id FROM doctor WHERE hospital_id = OLD.id);
+    END""",
+]
+
+
+def ensure_doctor_search(db):
+    """Create the doctor full-text index and its triggers, rebuilding the index if it is out of step.
+
+    The triggers die with the doctor table, so a database recreated with
+    db.drop_all()/create_all() gets a stale index; row counts catch that.
+    Returns True if the index was rebuilt.
+    """
+    if db.engine.dialect.name != 'sqlite':
+        return False
+
+    with db.engine.begin() as conn:
+        for ddl in DOCTOR_SEARCH_DDL:
+            conn.execute(text(ddl))
+        in_step = conn.execute(text(
+            "SELECT (SELECT COUNT(*) FROM doctor) = (SELECT COUNT(*) FROM doctor_search)"
+        )).scalar()
+        if in_step:
+            return False
+        conn.execute(text("DELETE FROM doctor_search"))
+        conn.execute(text(f"INSERT INTO doctor_search (rowid, {', '.join(DOCTOR_SEARCH_COLUMNS)}) "
+                          f"{DOCTOR_SEARCH_ROW}"))
+        conn.execute(text("INSERT INTO doctor_search (doctor_search) VALUES ('optimize')"))
+
+    print("Rebuilt the doctor search index")
+    return True
+
+
+# Spatial index behind nearest-doctor search: one point per geocoded
+# hospital, keyed by hospital id
+HOSPITAL_LOCATION_DDL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS hospital_location USING rtree(
+        id, min_lat, max_lat, min_lon, max_lon
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS hospital_location_insert AFTER INSERT ON hospital
+    WHEN NEW.latitude IS NOT NULL AND NEW.longitude IS NOT NULL BEGIN
+        INSERT INTO hospital_location VALUES (NEW.id, NEW.latitude, NEW.latitude, NEW.longitude, NEW.longitude);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS hospital_location_update AFTER UPDATE OF latitude, longitude ON hospital BEGIN
+        DELETE FROM hospital_location WHERE id = OLD.id;
+        INSERT INTO hospital_location
+        SELECT NEW.id, NEW.latitude, NEW.latitude, NEW.longitude, NEW.longitude
+        WHERE NEW.latitude IS NOT NULL AND NEW.longitude IS NOT NULL;
+    END""",
+    # A new address makes the old coordinates wrong, unless new ones come
+    # with it; geocode.py fills them in again
+    """CREATE TRIGGER IF NOT EXISTS hospital_address_update AFTER UPDATE OF address ON hospital
+    WHEN NEW.address IS NOT OLD.address AND NEW.latitude IS OLD.latitude AND NEW.longitude IS OLD.longitude BEGIN
+        UPDATE hospital SET latitude = NULL, longitude = NULL WHERE id = NEW.id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS hospital_location_delete AFTER DELETE ON hospital BEGIN
+        DELETE FROM hospital_location WHERE id = OLD.id;
+    END""",
+]
+
+
+def ensure_hospital_locations(db):
+    """Create the hospital R*Tree and its triggers, rebuilding it if it is out of step.
+
+    Returns True if the index was rebuilt.
+    """
+    if db.engine.dialect.name != 'sqlite':
+        return False
+
+    with db.engine.begin() as conn:
+        for ddl in HOSPITAL_LOCATION_DDL:
+            conn.execute(text(ddl))
+        in_step = conn.execute(text(
+            "SELECT (SELECT COUNT(*) FROM hospital WHERE latitude IS NOT NULL AND longitude IS NOT NULL)"
+            " = (SELECT COUNT(*) FROM hospital_location)"
+        )).scalar()
+        if in_step:
+            return False
+        conn.execute(text("DELETE FROM hospital_location"))
+        conn.execute(text(
+            "INSERT INTO hospital_location SELECT id, latitude, latitude, longitude, longitude FROM hospital "
+            "WHERE latitude IS NOT NULL AND longitude IS NOT NULL"
+        ))
+
+    print("Rebuilt the hospital location index")
+    return True
+
+
+# user.unread_notifications counts the user's unread notifications, so
+# dashboards show the badge without counting them
+UNREAD_COUNT_DDL = [
+    """CREATE TRIGGER IF NOT EXISTS unread_count_insert AFTER INSERT ON notification
+    WHEN NOT NEW.is_read BEGIN
+        UPDATE user SET unread_notifications = unread_notifications + 1 WHERE id = NEW.user_id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS unread_count_update AFTER UPDATE OF is_read, user_id ON notification BEGIN
+        UPDATE user SET unread_notifications = unread_notifications - 1 WHERE id = OLD.user_id AND NOT OLD.is_read;
+        UPDATE user SET unread_notifications = unread_notifications + 1 WHERE id = NEW.user_id AND NOT NEW.is_read;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS unread_count_delete AFTER DELETE ON notification
+    WHEN NOT OLD.is_read BEGIN
+        UPDATE user SET unread_notifications = unread_notifications - 1 WHERE id = OLD.user_id;
+    END""",
+]
+
+
+def ensure_unread_counts(db):
+    """Create the unread-count triggers, recounting if the counters are out of step.
+
+    Like the search index triggers, these die with the notification table,
+    and a newly added column starts at zero.
+    Returns True if the counters were recounted.
+    """
+    if db.engine.dialect.name != 'sqlite':
+        return False
+
+    with db.engine.begin() as conn:
+        for ddl in UNREAD_COUNT_DDL:
+            conn.execute(text(ddl))
+        in_step = conn.execute(text(
+            "SELECT (SELECT COUNT(*) FROM notification WHERE NOT is_read) = "
+            "(SELECT COALESCE(SUM(unread_notifications), 0) FROM user)"
+        )).scalar()
+        if in_step:
+            return False
+        conn.execute(text(
+            "UPDATE user SET unread_notifications = "
+            "(SELECT COUNT(*) FROM notification n WHERE n.user_id = user.id AND NOT n.is_read)"
+        ))
+
+    print("Recounted unread notifications")
+    return True
+
+
+# user.*_version count every change to what a user's pages and /api/v1
+# collections show, so an unchanged collection is recognised from the user
+# row alone. Each trigger bumps everyone the row is shown to.
+APPOINTMENT_USERS = """
+    SELECT user_id FROM patient WHERE id = {row}.patient_id
+    UNION ALL SELECT user_id FROM doctor WHERE id = {row}.doctor_id
+    UNION ALL SELECT user_id FROM hospital WHERE id = {row}.hospital_id
+"""
+
+DATA_VERSION_DDL = [
+    f"""CREATE TRIGGER IF NOT EXISTS appointments_version_insert AFTER INSERT ON appointment BEGIN
+        UPDATE user SET appointments_version = appointments_version + 1
+        WHERE id IN ({APPOINTMENT_USERS.format(row='NEW')});
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS appointments_version_update AFTER UPDATE ON appointment BEGIN
+        UPDATE user SET appointments_version = appointments_version + 1
+        WHERE id IN ({APPOINTMENT_USERS.format(row='NEW')} UNION {APPOINTMENT_USERS.format(row='OLD')});
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS appointments_version_delete AFTER DELETE ON appointment BEGIN
+        UPDATE user SET appointments_version = appointments_version + 1
+        WHERE id IN ({APPOINTMENT_USERS.format(row='OLD')});
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS records_version_insert AFTER INSERT ON medical_record BEGIN
+        UPDATE user SET records_version = records_version + 1
+        WHERE id = (SELECT user_id FROM patient WHERE id = NEW.patient_id);
+    END""",
+    # Doctors the record is shared with see it too
+    """CREATE TRIGGER IF NOT EXISTS records_version_update AFTER UPDATE ON medical_record BEGIN
+        UPDATE user SET records_version = records_version + 1 WHERE id IN (
+            SELECT user_id FROM patient WHERE id IN (NEW.patient_id, OLD.patient_id)
+            UNION SELECT d.user_id FROM record_share s JOIN doctor d ON d.id = s.doctor_id WHERE s.record_id = NEW.id
+        );
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS records_version_delete AFTER DELETE ON medical_record BEGIN
+        UPDATE user SET records_version = records_version + 1
+        WHERE id = (SELECT user_id FROM patient WHERE id = OLD.patient_id);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS records_version_share_insert AFTER INSERT ON record_share BEGIN
+        UPDATE user SET records_version = records_version + 1
+        WHERE id = (SELECT user_id FROM doctor WHERE id = NEW.doctor_id);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS records_version_share_update AFTER UPDATE ON record_share BEGIN
+        UPDATE user SET records_version = records_version + 1
+        WHERE id IN (SELECT user_id FROM doctor WHERE id IN (NEW.doctor_id, OLD.doctor_id));
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS records_version_share_delete AFTER DELETE ON record_share BEGIN
+        UPDATE user SET records_version = records_version + 1
+        WHERE id = (SELECT user_id FROM doctor WHERE id = OLD.doctor_id);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS notifications_version_insert AFTER INSERT ON notification BEGIN
+        UPDATE user SET notifications_version = notifications_version + 1 WHERE id = NEW.user_id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS notifications_version_update AFTER UPDATE ON notification BEGIN
+        UPDATE user SET notifications_version = notifications_version + 1 WHERE id IN (NEW.user_id, OLD.user_id);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS notifications_version_delete AFTER DELETE ON notification BEGIN
+        UPDATE user SET notifications_version = notifications_version + 1 WHERE id = OLD.user_id;
+    END""",
+]
+
+
+def ensure_data_versions(db):
+    """Create the triggers that bump users' data versions.
+
+    Nothing is recounted: a version only has to change with the data, its
+    value means nothing.
+    """
+    if db.engine.dialect.name != 'sqlite':
+        return
+
+    with db.engine.begin() as conn:
+        for ddl in DATA_VERSION_DDL:
+            conn.execute(text(ddl))
+
+
+def ensure_statistics(db):
+    """ANALYZE a populated database that has no planner statistics yet.
+
+    Without sqlite_stat1 SQLite guesses that every index is selective, and
+    e.g. walks all available doctors instead of the few near a point.
+    Returns True if ANALYZE ran.
+    """
+    if db.engine.dialect.name != 'sqlite':
+        return False
+
+    with db.engine.begin() as conn:
+        analyzed = set()
+        if conn.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'")).first():
+            analyzed = {row[0] for row in conn.execute(text('SELECT DISTINCT tbl FROM sqlite_stat1'))}
+        missing = [
+            table.name for table in db.metadata.sorted_tables
+            if table.name not in analyzed and conn.execute(text(f'SELECT 1 FROM "{table.name}" LIMIT 1')).first()
+        ]
+        if not missing:
+            return False
+        # Sample rather than read every row, so startup stays quick on big databases
+        conn.execute(text('PRAGMA analysis_limit = 1000'))
+        conn.execute(text('ANALYZE'))
+
+    print(f"Collected planner statistics for {', '.join(missing)}")
+    return True
+
+
+def run_migrations(db):
+    """Bring the bound database up to date with the models"""
+    ensure_columns(db)
+    ensure_indexes(db)
+    migrate_shared_with(db)
+    drop_legacy_otp(db)
+    ensure_doctor_search(db)
+    ensure_hospital_locations(db)
+    ensure_unread_counts(db)
+    ensure_data_versions(db)
+    ensure_statistics(db)
+
+
+if __name__ == '__main__':
+    # Importing the app runs init_db(), which applies the migrations
+    from app import app, db
+
+    with app.app_context():
+        run_migrations(db)
+    print("✅ Database schema is up to date")
@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+"""
+MedVault One-Time Code Stores
+A user has at most one live code per purpose (login, registration). It is kept
+as a keyed hash with an expiry and an attempt counter, so checking a code is a
+single keyed lookup however often the user has logged in before. Sending a new
+code replaces the old one, a correct code is consumed by the same atomic step
+that checks it, and a code is burnt after max_attempts wrong guesses.
+
+Backends (OTP_STORE / MEDVAULT_OTP_STORE):
+- 'sql': the otp_code table, shared by every worker (default)
+- 'memory': a dict in this process, for a single worker
+- 'redis://[:password@]host[:port][/db]': any server speaking the Redis
+  protocol; it expires the keys itself
+
+The sql and memory stores drop expired codes from a sweeper thread started
+by each web worker. To sweep the sql store once on its own:
+
+Usage: python otpstore.py
+"""
+
+import hashlib
+import hmac
+import socket
+import threading
+import time
+from datetime import datetime, timedelta
+from urllib.parse import unquote, urlsplit
+
+from sqlalchemy import delete, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+
+class OTPStore:
+    """Base class: codes are compared as HMACs, in constant time"""
+
+    def __init__(self, secret, max_attempts=5):
+        self.secret = secret.encode() if isinstance(secret, str) else secret
+        self.max_attempts = max_attempts
+        self._sweeper = None
+        self._stop = threading.Event()
+
+    def digest(self, user_id, purpose, code):
+        return hmac.new(self.secret, f'{user_id}:{purpose}:{code}'.encode(), hashlib.sha256).hexdigest()
+
+    def issue(self, user_id, purpose, code, ttl):
+        """Make `code` the live code for (user_id, purpose) for `ttl` seconds"""
+        raise NotImplementedError
+
+    def verify(self, user_id, purpose, code):
+        """True, once, for the live code; every call counts as an attempt"""
+        raise NotImplementedError
+
+    def sweep(self):
+        """Drop expired codes, returning how many were dropped"""
+        return 0
+
+    # ---------- background sweeping ----------
+
+    @property
+    def sweeping(self):
+        return self._sweeper is not None and self._sweeper.is_alive()
+
+    def start_sweeper(self, interval):
+        if self.sweeping:
+            return
+        self._stop.clear()
+        self._sweeper = threading.Thread(target=self._sweep_loop, args=(interval,), name='otp-sweeper', daemon=True)
+        self._sweeper.start()
+
+    def stop_sweeper(self, timeout=10):
+        self._stop.set()
+        if self._sweeper is not None:
+            self._sweeper.join(timeout)
+        self._sweeper = None
+
+    def _sweep_loop(self, interval):
+        while not self._stop.wait(interval):
+            try:
+                self.sweep()
+            except Exception as e:
+                print(f"OTP sweep failed: {e}")
+
+
+class MemoryOTPStore(OTPStore):
+    """Codes in a dict of this process; only for a single worker"""
+
+    def __init__(self, secret, max_attempts=5):
+        super().__init__(secret, max_attempts)
+        self._codes = {}  # (user_id, purpose) -> [digest, attempts, expires]
+        self._lock = threading.Lock()
+
+    def issue(self, user_id, purpose, code, ttl):
+        with self._lock:
+            self._codes[(user_id, purpose)] = [self.digest(user_id, purpose, code), 0, time.monotonic() + ttl]
+
+    def verify(self, user_id, purpose, code):
+        digest = self.digest(user_id, purpose, code)
+        key = (user_id, purpose)
+        with self._lock:
+            entry = self._codes.get(key)
+            if entry is None or entry[2] <= time.monotonic():
+                return False
+            entry[1] += 1
+            ok = hmac.compare_digest(entry[0], digest)
+            if ok or entry[1] >= self.max_attempts:
+                del self._codes[key]
+            return ok
+
+    def sweep(self):
+        now = time.monotonic()
+        with self._lock:
+            expired = [key for key, entry in self._codes.items() if entry[2] <= now]
+            for key in expired:
+                del self._codes[key]
+        return len(expired)
+
+
+class SQLOTPStore(OTPStore):
+    """Codes in the otp_code table, keyed by (user_id, purpose).
+
+    Every call runs in its own short transaction rather than the request's
+    session, so a failed attempt is counted even though the request then
+    rolls back.
+    """
+
+    def __init__(self, app, db, model, secret, max_attempts=5):
+        super().__init__(secret, max_attempts)
+        self.app = app
+        self.db = db
+        self.table = model.__table__
+
+    def _key(self, user_id, purpose):
+        return (self.table.c.user_id == user_id) & (self.table.c.purpose == purpose)
+
+    def issue(self, user_id, purpose, code, ttl):
+        values = {'code_hash': self.digest(user_id, purpose, code), 'attempts': 0,
+                  'expires_at': datetime.utcnow() + timedelta(seconds=ttl)}
+        statement = sqlite_insert(self.table).values(user_id=user_id, purpose=purpose, **values)
+        with self.db.engine.begin() as conn:
+            conn.execute(statement.on_conflict_do_update(index_elements=['user_id', 'purpose'], set_=values))
+
+    def verify(self, user_id, purpose, code):
+        digest = self.digest(user_id, purpose, code)
+        table = self.table
+        with self.db.engine.begin() as conn:
+            # Counting the attempt first takes the write lock, so two requests
+            # racing with the same code cannot both consume it
+            row = conn.execute(
+                update(table).where(self._key(user_id, purpose), table.c.expires_at > datetime.utcnow())
+                .values(attempts=table.c.attempts + 1).returning(table.c.code_hash, table.c.attempts)
+            ).first()
+            if row is None:
+                return False
+            ok = row.attempts <= self.max_attempts and hmac.compare_digest(row.code_hash, digest)
+            if ok or row.attempts >= self.max_attempts:
+                conn.execute(delete(table).where(self._key(user_id, purpose)))
+            return ok
+
+    def sweep(self):
+        with self.app.app_context():
+            with self.db.engine.begin() as conn:
+                return conn.execute(delete(self.table).where(self.table.c.expires_at <= datetime.utcnow())).rowcount
+
+
+class RedisError(Exception):
+    """Error reply from the Redis server"""
+
+
+class RedisOTPStore(OTPStore):
+    """Codes as Redis hashes {hash, attempts} that expire with their TTL.
+
+    Speaks the Redis protocol directly over one connection per store. The
+    attempt is counted with HINCRBY and a correct code is only accepted by
+    whichever request's DEL actually removed the key.
+    """
+
+    def __init__(self, url, secret, max_attempts=5, prefix='medvault:otp:', timeout=5.0):
+        super().__init__(secret, max_attempts)
+        parts = urlsplit(url)
+        self.address = (parts.hostname or 'localhost', parts.port or 6379)
+        self.password = unquote(parts.password) if parts.password else None
+        self.database = int(parts.path.strip('/') or 0)
+        self.prefix = prefix
+        self.timeout = timeout
+        self._sock = None
+        self._reader = None
+        self._lock = threading.Lock()
+
+    def _key(self, user_id, purpose):
+        return f'{self.prefix}{purpose}:{user_id}'
+
+    def _connect(self):
+        self._sock = socket.create_connection(self.address, self.timeout)
+        self._reader = self._sock.makefile('rb')
+        if self.password:
+            self._send([('AUTH', self.password)])
+        if self.database:
+            self._send([('SELECT', self.database)])
+
+    def close(self):
+        if self._sock is not None:
+            self._reader.close()
+            self._sock.close()
+        self._sock = self._reader = None
+
+    def _send(self, commands):
+        out = bytearray()
+        for command in commands:
+            out += b'*%d\r\n' % len(command)
+            for arg in command:
+                arg = arg if isinstance(arg, bytes) else str(arg).encode()
+                out += b'$%d\r\n%s\r\n' % (len(arg), arg)
+        self._sock.sendall(out)
+        replies = [self._read() for _ in commands]
+        for reply in replies:
+            if isinstance(reply, RedisError):
+                raise reply
+        return replies
+
+    def _read(self):
+        line = self._reader.readline()
+        if not line.endswith(b'\r\n'):
+            raise ConnectionError('Redis connection closed')
+        kind, rest = line[:1], line[1:-2]
+        if kind == b'+':
+            return rest.decode()
+        if kind == b'-':
+            return RedisError(rest.decode())
+        if kind == b':':
+            return int(rest)
+        if kind == b'$':
+            length = int(rest)
+            return None if length < 0 else self._reader.read(length + 2)[:-2]
+        if kind == b'*':
+            length = int(rest)
+            return None if length < 0 else [self._read() for _ in range(length)]
+        raise ConnectionError(f'Unexpected Redis reply {line!r}')
+
+    def call(self, *commands):
+        """Send commands as one pipeline and return their replies"""
+        with self._lock:
+            try:
+                if self._sock is None:
+                    self._connect()
+                return self._send(commands)
+            except (OSError, ConnectionError):
+                self.close()
+                raise
+
+    def issue(self, user_id, purpose, code, ttl):
+        key = self._key(user_id, purpose)
+        self.call(('MULTI',), ('HSET', key, 'hash', self.digest(user_id, purpose, code), 'attempts', 0),
+                  ('PEXPIRE', key, int(ttl * 1000)), ('EXEC',))
+
+    def verify(self, user_id, purpose, code):
+        key = self._key(user_id, purpose)
+        attempts, stored = self.call(('HINCRBY', key, 'attempts', 1), ('HGET', key, 'hash'))
+        if stored is None or attempts > self.max_attempts:
+            # No live code; HINCRBY may just have created a bare counter
+            self.call(('DEL', key))
+            return False
+        if hmac.compare_digest(stored, self.digest(user_id, purpose, code).encode()):
+            return self.call(('DEL', key))[0] == 1
+        if attempts >= self.max_attempts:
+            self.call(('DEL', key))
+        return False
+
+
+def store_from_config(app, db, model):
+    """MEDVAULT_OTP_STORE -> the configured store"""
+    kind = app.config['OTP_STORE']
+    options = {'secret': app.secret_key, 'max_attempts': app.config['OTP_MAX_ATTEMPTS']}
+    if kind == 'sql':
+        return SQLOTPStore(app, db, model, **options)
+    if kind == 'memory':
+        return MemoryOTPStore(**options)
+    if kind.startswith('redis://'):
+        return RedisOTPStore(kind, **options)
+    raise ValueError(f'Unknown OTP store {kind!r}')
+
+
+if __name__ == '__main__':
+    from app import otp_store
+
+    print(f"✅ Dropped {otp_store.sweep()} expired one-time codes")
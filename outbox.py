@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+"""
+MedVault Email Outbox
+Requests never talk to the mail server. They add an EmailOutbox row in the
+same commit as the data it belongs to (OTP, notification), and OutboxSender
+threads deliver the rows in batches over SMTP connections that stay open
+between batches. Failed sends are retried with exponential backoff and
+dead-lettered (status 'dead') once they run out of attempts.
+
+Every web worker runs its own sender; rows are claimed with a token so a
+message is only picked up by one of them. To run a sender on its own:
+
+Usage: python outbox.py
+"""
+
+import smtplib
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from flask_mail import Message
+from sqlalchemy import select, update
+from sqlalchemy.exc import OperationalError
+
+from metrics import EMAIL_SEND_LATENCY
+
+
+class OutboxSender:
+    """Pool of threads draining the email outbox"""
+
+    def __init__(self, app, db, model, mail, workers=1, batch_size=50, max_attempts=6,
+                 retry_base_seconds=30, poll_interval=5.0, idle_close_seconds=30, lease_seconds=300):
+        self.app = app
+        self.db = db
+        self.model = model
+        self.mail = mail
+        self.workers = workers
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.retry_base_seconds = retry_base_seconds
+        self.poll_interval = poll_interval
+        self.idle_close_seconds = idle_close_seconds
+        self.lease_seconds = lease_seconds
+
+        self._threads = []
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+
+    @property
+    def running(self):
+        return any(thread.is_alive() for thread in self._threads)
+
+    def start(self):
+        if self.running:
+            return
+        self._stop.clear()
+        self._threads = [
+            threading.Thread(target=self._run, name=f'outbox-sender-{i}', daemon=True)
+            for i in range(self.workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self, timeout=10):
+        self._stop.set()
+        self._wake.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def wake(self):
+        """Deliver new messages now instead of at the next poll"""
+        self._wake.set()
+
+    # ---------- one batch ----------
+
+    def claim(self):
+        """Mark a batch of due messages as ours and return them"""
+        model, session = self.model, self.db.session
+        now = datetime.utcnow()
+        token = uuid.uuid4().hex
+
+        # Messages claimed by a sender that died are handed out again
+        session.execute(update(model).where(
+            model.status == 'sending',
+            model.claimed_at < now - timedelta(seconds=self.lease_seconds)
+        ).values(status='pending', claimed_by=None))
+
+        due = select(model.id).where(
+            model.status == 'pending', model.next_attempt_at <= now
+        ).order_by(model.next_attempt_at, model.id).limit(self.batch_size)
+        session.execute(update(model).where(model.id.in_(due)).values(
+            status='sending', claimed_by=token, claimed_at=now
+        ))
+        session.commit()
+
+        return model.query.filter_by(claimed_by=token).order_by(model.id).all()
+
+    def deliver(self, messages, connection=None):
+        """Send claimed messages, reusing `connection` if it is open.
+
+        Returns the connection to use for the next batch (None if it broke).
+        """
+        for outgoing in messages:
+            try:
+                if connection is None:
+                    connection = self._connect()
+                started = time.perf_counter()
+                connection.send(Message(outgoing.subject, recipients=[outgoing.recipient], body=outgoing.body))
+            except Exception as e:
+                if connection is not None:
+                    EMAIL_SEND_LATENCY.labels('failed').observe(time.perf_counter() - started)
+                self._record_failure(outgoing, e)
+                connection = self._close(connection)
+            else:
+                EMAIL_SEND_LATENCY.labels('sent').observe(time.perf_counter() - started)
+                outgoing.status = 'sent'
+                outgoing.sent_at = datetime.utcnow()
+                outgoing.claimed_by = None
+        self.db.session.commit()
+        return connection
+
+    def drain(self, connection=None):
+        """Claim and deliver one batch. Returns (number of messages, connection)."""
+        messages = self.claim()
+        if messages:
+            connection = self.deliver(messages, connection)
+        return len(messages), connection
+
+    def _record_failure(self, outgoing, error):
+        outgoing.attempts = (outgoing.attempts or 0) + 1
+        outgoing.last_error = f'{type(error).__name__}: {error}'[:500]
+        outgoing.claimed_by = None
+        if outgoing.attempts >= self.max_attempts:
+            outgoing.status = 'dead'
+            self.app.logger.error('Email %s to %s dead-lettered: %s',
+                                  outgoing.id, outgoing.recipient, outgoing.last_error)
+        else:
+            outgoing.status = 'pending'
+            delay = self.retry_base_seconds * (2 ** (outgoing.attempts - 1))
+            outgoing.next_attempt_at = datetime.utcnow() + timedelta(seconds=delay)
+
+    # ---------- SMTP connection ----------
+
+    def _connect(self):
+        connection = self.mail.connect()
+        connection.__enter__()
+        return connection
+
+    def _close(self, connection):
+        if connection is not None:
+            try:
+                connection.__exit__(None, None, None)
+            except (smtplib.SMTPException, OSError):
+                pass
+        return None
+
+    # ---------- worker loop ----------
+
+    def _run(self):
+        with self.app.app_context():
+            connection = None
+            idle_since = time.monotonic()
+            while not self._stop.is_set():
+                try:
+                    count, connection = self.drain(connection)
+                except OperationalError:
+                    # Database busy; try again on the next round
+                    self.db.session.rollback()
+                    count = 0
+                except Exception:
+                    self.app.logger.exception('Email outbox sender failed')
+                    self.db.session.rollback()
+                    count = 0
+
+                if count:
+                    idle_since = time.monotonic()
+                    continue
+                if connection is not None and time.monotonic() - idle_since > self.idle_close_seconds:
+                    connection = self._close(connection)
+
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
+
+            self._close(connection)
+            self.db.session.remove()
+
+
+if __name__ == '__main__':
+    from app import app, outbox_sender
+
+    outbox_sender.start()
+    print(f"📧 Email outbox sender running with {outbox_sender.workers} worker(s). Press CTRL+C to stop.")
+    try:
+        while outbox_sender.running:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        outbox_sender.stop()
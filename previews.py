@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+"""
+MedVault Record Previews
+JPEG thumbnails of uploaded images and of the first page of PDFs, rendered
+at a few fixed widths and kept next to the blob they show
+(blobs/ab/cd/<sha256>.preview-320.jpg).
+
+Rendering never happens in a web request: upload_record queues a job on a
+PreviewPool, a small process pool running at low CPU priority with a cap on
+queued jobs. Jobs over the cap are dropped and rendered when the preview is
+first asked for. PDFs need pdftoppm (poppler-utils); images need Pillow.
+Files that cannot be previewed get a .preview-none marker so they are not
+tried again. When uploads are encrypted, so are their previews.
+
+To render previews for everything stored so far:
+
+Usage: python previews.py
+"""
+
+import io
+import logging
+import multiprocessing
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from encryption import EncryptingWriter, open_file
+
+PDF_MAGIC = b'%PDF-'
+JPEG_QUALITY = 80
+PDF_RENDER_TIMEOUT = 60
+
+
+def _lower_priority(nice):
+    # Web workers keep the CPU while uploads are being previewed
+    os.nice(nice)
+
+
+def _open_pdf(file, width):
+    """First page of a PDF as a Pillow image, or None without pdftoppm"""
+    from PIL import Image
+
+    pdftoppm = shutil.which('pdftoppm')
+    if pdftoppm is None:
+        return None
+    with tempfile.TemporaryDirectory() as directory:
+        # The PDF goes in on stdin, so a decrypted copy is never written out
+        prefix = os.path.join(directory, 'page')
+        process = subprocess.Popen([pdftoppm, '-f', '1', '-l', '1', '-singlefile', '-scale-to', str(width),
+                                    '-jpeg', '-', prefix],
+                                   stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            shutil.copyfileobj(file, process.stdin)
+            process.stdin.close()
+        except BrokenPipeError:
+            pass  # pdftoppm gave up; its exit status says so
+        try:
+            returncode = process.wait(timeout=PDF_RENDER_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+            return None
+        if returncode != 0:
+            return None
+        with Image.open(prefix + '.jpg') as page:
+            page.load()
+            return page
+
+
+def _open_image(file, width):
+    from PIL import Image, ImageOps
+
+    try:
+        image = Image.open(file)
+        # JPEGs can be decoded straight at a fraction of their size
+        image.draft('RGB', (width, width))
+        image.load()
+    except (OSError, Image.DecompressionBombError):
+        # Not an image, or a truncated, corrupt or oversized one
+        return None
+    image = ImageOps.exif_transpose(image)
+    if image.mode in ('RGBA', 'LA', 'P'):
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, 'white')
+        background.paste(image, mask=image.getchannel('A'))
+        return background
+    return image.convert('RGB')
+
+
+def render_previews(source, targets, marker, keyring=None):
+    """Write a JPEG of `source` fitted into width x width for each {width: path} target.
+
+    Returns the widths written; when the file cannot be previewed an empty
+    `marker` file is written instead. With a keyring the source may be
+    encrypted and the previews are written encrypted.
+    """
+    largest = max(targets)
+    with open_file(source, keyring) as f:
+        is_pdf = f.read(len(PDF_MAGIC)) == PDF_MAGIC
+        f.seek(0)
+        if is_pdf:
+            image = _open_pdf(f, largest)
+        else:
+            image = _open_image(f, largest)
+    if image is None:
+        open(marker, 'wb').close()
+        return []
+
+    written = []
+    # Largest first, each one shrunk from the last
+    for width in sorted(targets, reverse=True):
+        image.thumbnail((width, width))
+        jpeg = io.BytesIO()
+        image.save(jpeg, 'JPEG', quality=JPEG_QUALITY, optimize=True, progressive=True)
+        fd, temporary = tempfile.mkstemp(dir=os.path.dirname(targets[width]), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            if keyring:
+                writer = EncryptingWriter(f, keyring)
+                writer.write(jpeg.getvalue())
+                writer.finish()
+            else:
+                f.write(jpeg.getvalue())
+        os.replace(temporary, targets[width])
+        written.append(width)
+    return written
+
+
+class PreviewPool:
+    """Low-priority worker processes rendering previews for one web worker"""
+
+    def __init__(self, workers=1, max_pending=50, nice=10):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.nice = nice
+        self.log = logging.getLogger('medvault.previews')
+        self._executor = None
+        self._pending = set()
+        self._lock = threading.Lock()
+
+    def submit(self, source, targets, marker, keyring=None):
+        """Queue a render_previews job. Returns its Future, or None when the
+        pool is disabled or full, or the source is already queued."""
+        if not self.workers:
+            return None
+        with self._lock:
+            if source in self._pending or len(self._pending) >= self.max_pending:
+                return None
+            if self._executor is None:
+                # Spawned, not forked: children get no copies of the
+                # worker's threads, sockets or database connections
+                self._executor = ProcessPoolExecutor(
+                    self.workers, mp_context=multiprocessing.get_context('spawn'),
+                    initializer=_lower_priority, initargs=(self.nice,))
+            self._pending.add(source)
+        future = self._executor.submit(render_previews, source, targets, marker, keyring)
+        future.add_done_callback(lambda done: self._finished(source, done))
+        return future
+
+    def _finished(self, source, future):
+        with self._lock:
+            self._pending.discard(source)
+        if not future.cancelled() and future.exception() is not None:
+            self.log.warning('Preview of %s failed: %r', source, future.exception())
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait, cancel_futures=not wait)
+
+
+if __name__ == '__main__':
+    from app import app, db, Blob, preview_targets, upload_store
+
+    store = upload_store()
+    rendered = skipped = 0
+    with app.app_context():
+        digests = db.session.execute(db.select(Blob.sha256).where(Blob.ref_count > 0)).scalars().all()
+    for digest in digests:
+        targets, marker = preview_targets(digest)
+        if os.path.exists(marker) or all(os.path.exists(path) for path in targets.values()):
+            continue
+        if render_previews(store.path(digest), targets, marker, store.keyring):
+            rendered += 1
+        else:
+            skipped += 1
+    print(f"✅ Rendered previews for {rendered} files ({skipped} could not be previewed)")
@@ -0,0 +1,139 @@
+"""
+MedVault Availability Slot Engine
+Turns each doctor's weekly DoctorAvailability windows into concrete bookable
+slots over a date range and removes the ones already taken by appointments.
+
+Times are handled as minutes since midnight so the hot loop never builds
+datetime objects. Everything here is plain Python; app.py loads the rows.
+"""
+
+from bisect import bisect_left, bisect_right
+from datetime import timedelta
+from functools import lru_cache
+
+SLOT_MINUTES = 30
+
+# Used for doctors that have not published any availability yet.
+# Matches the slots the booking page offered before the engine existed.
+DEFAULT_WEEKLY_WINDOWS = {day: [(9 * 60, 12 * 60), (14 * 60, 17 * 60)] for day in range(7)}
+
+
+def to_minutes(value):
+    """datetime.time -> minutes since midnight"""
+    return value.hour * 60 + value.minute
+
+
+def format_minutes(minutes):
+    return f'{minutes // 60:02d}:{minutes % 60:02d}'
+
+
+class BookedIntervals:
+    """Sorted, merged busy intervals [start, end) for one doctor on one day"""
+
+    __slots__ = ('starts', 'ends')
+
+    def __init__(self):
+        self.starts = []
+        self.ends = []
+
+    def add(self, start, end):
+        # Merge with every interval that touches [start, end)
+        lo = bisect_left(self.ends, start)
+        hi = bisect_right(self.starts, end)
+        if lo < hi:
+            start = min(start, self.starts[lo])
+            end = max(end, self.ends[hi - 1])
+        self.starts[lo:hi] = [start]
+        self.ends[lo:hi] = [end]
+
+    def overlaps(self, start, end):
+        i = bisect_right(self.ends, start)
+        return i < len(self.starts) and self.starts[i] < end
+
+    def __len__(self):
+        return len(self.starts)
+
+
+_LABELS = [format_minutes(m) for m in range(24 * 60)]
+
+
+class SlotTemplate:
+    """Slot start times for one weekday's availability windows"""
+
+    __slots__ = ('minutes', 'labels')
+
+    def __init__(self, windows, slot_minutes=SLOT_MINUTES):
+        minutes = set()
+        for start, end in windows:
+            t = start
+            while t + slot_minutes <= end:
+                minutes.add(t)
+                t += slot_minutes
+        self.minutes = sorted(minutes)
+        self.labels = [_LABELS[m] for m in self.minutes]
+
+
+@lru_cache(maxsize=1024)
+def _template(windows, slot_minutes):
+    # Most doctors keep the same hours, so templates are shared between them
+    return SlotTemplate(windows, slot_minutes)
+
+
+def build_templates(windows_by_doctor, slot_minutes=SLOT_MINUTES):
+    """{doctor_id: {weekday: [(start, end), ...]}} -> {doctor_id: {weekday: SlotTemplate}}"""
+    return {
+        doctor_id: {day: _template(tuple(sorted(windows)), slot_minutes) for day, windows in weekly.items()}
+        for doctor_id, weekly in windows_by_doctor.items()
+    }
+
+
+def build_booked(appointments, slot_minutes=SLOT_MINUTES):
+    """(doctor_id, date, time) rows -> {(doctor_id, date): BookedIntervals}"""
+    booked = {}
+    for doctor_id, day, at in appointments:
+        start = to_minutes(at)
+        intervals = booked.get((doctor_id, day))
+        if intervals is None:
+            intervals = booked[(doctor_id, day)] = BookedIntervals()
+        intervals.add(start, start + slot_minutes)
+    return booked
+
+
+def free_slots(templates, booked, start_date, days, slot_minutes=SLOT_MINUTES, now=None):
+    """Free slot labels per doctor and ISO date.
+
+    Returns {doctor_id: {'YYYY-MM-DD': ['09:00', ...]}}. Dates with no free
+    slot are left out. When `now` is given, slots that already started are
+    dropped.
+    """
+    dates = [start_date + timedelta(days=i) for i in range(days)]
+    iso_dates = [d.isoformat() for d in dates]
+    today = now.date() if now else None
+    now_minutes = now.hour * 60 + now.minute if now else None
+
+    result = {}
+    for doctor_id, weekly in templates.items():
+        per_day = {}
+        for day, iso in zip(dates, iso_dates):
+            template = weekly.get(day.weekday())
+            if template is None or not template.minutes:
+                continue
+            if today and day < today:
+                continue
+
+            busy = booked.get((doctor_id, day))
+            cutoff = now_minutes if day == today else None
+            if busy is None and cutoff is None:
+                # Common case: nothing booked, reuse the precomputed labels
+                per_day[iso] = template.labels
+                continue
+
+            labels = [
+                label for minutes, label in zip(template.minutes, template.labels)
+                if (cutoff is None or minutes > cutoff)
+                and (busy is None or not busy.overlaps(minutes, minutes + slot_minutes))
+            ]
+            if labels:
+                per_day[iso] = labels
+        result[doctor_id] = per_day
+    return result
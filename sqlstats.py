@@ -0,0 +1,154 @@
+"""
+MedVault Per-Request SQL Instrumentation
+Counts and times every statement a request sends to the database.
+
+- In debug mode the numbers are returned as X-SQL-* response headers.
+- Requests slower than SQL_SLOW_REQUEST_MS are written to the slow log
+  (app.log by default) with their slowest statements.
+- Totals per endpoint are kept in memory and served as JSON by the
+  /internal/sql-stats route, which needs the SQL_STATS_TOKEN.
+
+Statements run outside a request (the email outbox sender, scripts) are
+not counted.
+"""
+
+import logging
+import threading
+import time
+from logging.handlers import RotatingFileHandler
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+class RequestSQL:
+    """SQL issued while handling one request"""
+
+    __slots__ = ('started', 'queries', 'sql_seconds', 'statements')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.sql_seconds = 0.0
+        self.statements = []  # (seconds, statement)
+
+    def slowest(self, n):
+        return sorted(self.statements, key=lambda item: item[0], reverse=True)[:n]
+
+
+class SQLStats:
+    """Engine hooks plus the per-endpoint aggregate table"""
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        self._endpoints = {}
+        self.slow_log = logging.getLogger('medvault.slow_requests')
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('SQL_SLOW_REQUEST_MS', 500)
+        app.config.setdefault('SQL_SLOW_STATEMENTS', 5)
+        app.config.setdefault('SQL_SLOW_LOG', 'app.log')
+        app.config.setdefault('SQL_STATS_TOKEN', '')
+        self.app = app
+
+        if app.config['SQL_SLOW_LOG'] and not self.slow_log.handlers:
+            handler = RotatingFileHandler(app.config['SQL_SLOW_LOG'], maxBytes=5 * 1024 * 1024, backupCount=3,
+                                          delay=True)
+            handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+            self.slow_log.addHandler(handler)
+            self.slow_log.setLevel(logging.INFO)
+            self.slow_log.propagate = False
+
+        event.listen(Engine, 'before_cursor_execute', self._before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', self._after_cursor_execute)
+        app.before_request(self._start_request)
+        app.after_request(self._finish_request)
+
+    # ---------- engine events ----------
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        # A connection runs one statement at a time, so one slot is enough
+        conn.info['sqlstats_started'] = time.perf_counter()
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        started = conn.info.pop('sqlstats_started', None)
+        current = g.get('sql_stats') if has_request_context() else None
+        if started is None or current is None:
+            return
+        elapsed = time.perf_counter() - started
+        current.queries += 1
+        current.sql_seconds += elapsed
+        current.statements.append((elapsed, statement))
+
+    # ---------- request hooks ----------
+
+    def _start_request(self):
+        g.sql_stats = RequestSQL()
+
+    def _finish_request(self, response):
+        current = g.pop('sql_stats', None)
+        if current is None:
+            return response
+        request_ms = (time.perf_counter() - current.started) * 1000
+        sql_ms = current.sql_seconds * 1000
+        endpoint = request.endpoint or '<unmatched>'
+
+        if self.app.debug:
+            response.headers['X-SQL-Queries'] = str(current.queries)
+            response.headers['X-SQL-Time-ms'] = f'{sql_ms:.1f}'
+            response.headers['X-Request-Time-ms'] = f'{request_ms:.1f}'
+
+        slow = request_ms >= self.app.config['SQL_SLOW_REQUEST_MS']
+        if slow:
+            self._log_slow(endpoint, request_ms, sql_ms, current)
+        self._record(endpoint, request_ms, sql_ms, current, slow)
+        return response
+
+    def _log_slow(self, endpoint, request_ms, sql_ms, current):
+        lines = [f'Slow request {request.method} {request.path} ({endpoint}): {request_ms:.1f}ms total, '
+                 f'{current.queries} queries in {sql_ms:.1f}ms']
+        for seconds, statement in current.slowest(self.app.config['SQL_SLOW_STATEMENTS']):
+            lines.append(f'    {seconds * 1000:8.1f}ms  {" ".join(statement.split())[:500]}')
+        self.slow_log.warning('\n'.join(lines))
+
+    # ---------- aggregate table ----------
+
+    def _record(self, endpoint, request_ms, sql_ms, current, slow):
+        slowest = current.slowest(1)
+        with self._lock:
+            row = self._endpoints.get(endpoint)
+            if row is None:
+                row = self._endpoints[endpoint] = {
+                    'requests': 0, 'slow_requests': 0, 'queries': 0, 'max_queries': 0,
+                    'request_ms': 0.0, 'max_request_ms': 0.0, 'sql_ms': 0.0,
+                    'slowest_statement_ms': 0.0, 'slowest_statement': None,
+                }
+            row['requests'] += 1
+            row['slow_requests'] += slow
+            row['queries'] += current.queries
+            row['max_queries'] = max(row['max_queries'], current.queries)
+            row['request_ms'] += request_ms
+            row['max_request_ms'] = max(row['max_request_ms'], request_ms)
+            row['sql_ms'] += sql_ms
+            if slowest and slowest[0][0] * 1000 > row['slowest_statement_ms']:
+                row['slowest_statement_ms'] = slowest[0][0] * 1000
+                row['slowest_statement'] = ' '.join(slowest[0][1].split())[:500]
+
+    def snapshot(self):
+        """Per-endpoint totals and averages, busiest SQL time first"""
+        with self._lock:
+            rows = {endpoint: dict(row) for endpoint, row in self._endpoints.items()}
+        for row in rows.values():
+            row['avg_queries'] = round(row['queries'] / row['requests'], 2)
+            row['avg_request_ms'] = round(row['request_ms'] / row['requests'], 2)
+            row['avg_sql_ms'] = round(row['sql_ms'] / row['requests'], 2)
+            for key in ('request_ms', 'max_request_ms', 'sql_ms', 'slowest_statement_ms'):
+                row[key] = round(row[key], 2)
+        return dict(sorted(rows.items(), key=lambda item: item[1]['sql_ms'], reverse=True))
+
+    def reset(self):
+        with self._lock:
+            self._endpoints.clear()
@@ -0,0 +1,141 @@
+"""
+JSON API tests: field selection, cursors and conditional GET
+"""
+
+import time
+from datetime import datetime, timedelta
+
+from app import db, create_notification, share_records, Appointment, MedicalRecord
+from conftest import captured_selects, login_as
+
+
+def walk(client, path, **params):
+    """Every item of a collection, following next_cursor"""
+    items, cursor = [], None
+    while True:
+        body = client.get(path, query_string={**params, 'cursor': cursor}).get_json()
+        items += body['data']
+        cursor = body['next_cursor']
+        if not cursor:
+            return items
+
+
+def test_collections_need_a_login(client, sample_data):
+    for path in ('/api/v1/appointments', '/api/v1/records', '/api/v1/notifications',
+                 f"/api/v1/doctors/{sample_data['doctors'][0].id}/availability"):
+        assert client.get(path).status_code == 401
+
+
+def test_appointments_pick_fields_and_page_by_cursor(client, sample_data):
+    patient = sample_data['patients'][0]
+    login_as(client, patient.user)
+
+    body = client.get('/api/v1/appointments?fields=id,status,appointment_date').get_json()
+    assert len(body['data']) == 4 and body['next_cursor'] is None
+    assert all(list(item) == ['id', 'status', 'appointment_date'] for item in body['data'])
+    dates = [item['appointment_date'] for item in body['data']]
+    assert dates == sorted(dates, reverse=True)
+
+    items = walk(client, '/api/v1/appointments', limit=3)
+    assert len(items) == len({item['id'] for item in items}) == 4
+    assert {item['patient_id'] for item in items} == {patient.id}
+    assert items[0]['appointment_time'] and items[0]['created_at']
+
+    response = client.get('/api/v1/appointments?fields=id,password_hash')
+    assert response.status_code == 400 and 'password_hash' in response.get_json()['error']
+
+
+def test_unchanged_collections_answer_304_after_one_query(client, sample_data):
+    patient_user = sample_data['patients'][0].user
+    login_as(client, patient_user)
+    first = client.get('/api/v1/appointments')
+    etag = first.headers['ETag']
+    assert 'no-cache' in first.headers['Cache-Control'] and 'private' in first.headers['Cache-Control']
+
+    with captured_selects(selects_only=False) as statements:
+        response = client.get('/api/v1/appointments', headers={'If-None-Match': etag})
+    assert response.status_code == 304 and response.headers['ETag'] == etag
+    assert len(statements) == 1
+
+    # Other users' changes leave the tag alone, the patient's own change moves it
+    create_notification(patient_user.id, 'Reminder', 'Tomorrow')
+    other = Appointment.query.filter(Appointment.patient_id != sample_data['patients'][0].id).first()
+    other.status = 'confirmed'
+    db.session.commit()
+    assert client.get('/api/v1/appointments', headers={'If-None-Match': etag}).status_code == 304
+
+    mine = Appointment.query.filter_by(patient_id=sample_data['patients'][0].id).first()
+    mine.status = 'confirmed'
+    db.session.commit()
+    response = client.get('/api/v1/appointments', headers={'If-None-Match': etag})
+    assert response.status_code == 200 and response.headers['ETag'] != etag
+
+    # So does a different page or field selection
+    assert client.get('/api/v1/appointments?fields=id', headers={'If-None-Match': etag}).status_code == 200
+
+
+def test_records_follow_shares_and_their_expiry(client, sample_data):
+    patient, doctor = sample_data['patients'][0], sample_data['doctors'][0]
+    login_as(client, patient.user)
+    records = walk(client, '/api/v1/records', fields='id,title,is_shared')
+    assert len(records) == 4 and not any(record['is_shared'] for record in records)
+
+    login_as(client, doctor.user)
+    empty = client.get('/api/v1/records')
+    assert empty.get_json()['data'] == []
+
+    record_ids = [record['id'] for record in records[:2]]
+    share_records(record_ids[:1], [doctor.id])
+    share_records(record_ids[1:], [doctor.id], expires_at=datetime.utcnow() + timedelta(seconds=1))
+    db.session.commit()
+    shared = client.get('/api/v1/records', headers={'If-None-Match': empty.headers['ETag']})
+    assert shared.status_code == 200
+    assert sorted(record['id'] for record in shared.get_json()['data']) == sorted(record_ids)
+
+    # Renaming a shared record reaches the doctor's tag too
+    db.session.get(MedicalRecord, record_ids[0]).title = 'Renamed'
+    db.session.commit()
+    renamed = client.get('/api/v1/records', headers={'If-None-Match': shared.headers['ETag']})
+    assert renamed.status_code == 200
+
+    time.sleep(1)  # the second share runs out, with no write to announce it
+    expired = client.get('/api/v1/records', headers={'If-None-Match': renamed.headers['ETag']})
+    assert [record['id'] for record in expired.get_json()['data']] == record_ids[:1]
+
+
+def test_notifications_report_unread_and_change_tag_when_read(client, sample_data):
+    doctor_user = sample_data['doctors'][0].user
+    login_as(client, doctor_user)
+    body = client.get('/api/v1/notifications?unread=1&fields=id,title').get_json()
+    assert body['unread_count'] == 6 and len(body['data']) == 6
+
+    etag = client.get('/api/v1/notifications?unread=1').headers['ETag']
+    client.post('/notifications/read', data={'notification_id': body['data'][0]['id']})
+    response = client.get('/api/v1/notifications?unread=1', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.get_json()['unread_count'] == 5 and len(response.get_json()['data']) == 5
+
+
+def test_doctors_come_from_the_directory_without_queries(client, sample_data):
+    client.get('/api/v1/doctors')
+    with captured_selects(selects_only=False) as statements:
+        body = client.get('/api/v1/doctors?fields=id,last_name,hospital_name&specialization=cardiology').get_json()
+    assert statements == []
+    assert body['data'] == [{'id': sample_data['doctors'][0].id, 'last_name': 'Test',
+                             'hospital_name': 'City General Hospital'}]
+    assert len(walk(client, '/api/v1/doctors', limit=1)) == 2
+
+
+def test_availability_is_tagged_by_content(client, sample_data):
+    login_as(client, sample_data['patients'][0].user)
+    doctor = sample_data['doctors'][0]
+    path = f'/api/v1/doctors/{doctor.id}/availability?start=2030-01-07&days=2'
+    first = client.get(path)
+    assert first.get_json()['dates']['2030-01-07'][0] == '09:00'
+    assert client.get(path, headers={'If-None-Match': first.headers['ETag']}).status_code == 304
+
+    client.post('/book_appointment', data={'doctor_id': doctor.id, 'appointment_date': '2030-01-07',
+                                           'appointment_time': '09:00'})
+    assert client.get(path, headers={'If-None-Match': first.headers['ETag']}).status_code == 200
+    assert client.get('/api/v1/doctors/9999/availability').status_code == 404
+    assert client.get(f'/api/v1/doctors/{doctor.id}/availability?days=365').status_code == 400
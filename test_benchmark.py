@@ -0,0 +1,41 @@
+"""
+Benchmark harness tests
+"""
+
+from app import app as flask_app
+from benchmark import Benchmark, compare, percentile
+
+
+def test_percentile_is_nearest_rank():
+    values = list(range(1, 101))
+    assert [percentile(values, p) for p in (50, 95, 99, 100)] == [50, 95, 99, 100]
+    assert percentile([7.0], 99) == 7.0
+
+
+def test_every_scenario_runs_without_errors(client, sample_data, tmp_path, monkeypatch):
+    monkeypatch.setitem(flask_app.config, 'UPLOAD_FOLDER', str(tmp_path))
+    results = Benchmark(seed=1).run(requests=300, warmup=10)
+
+    assert {'/patient/dashboard', '/doctor/dashboard', '/hospital/dashboard', '/api/slots',
+            '/book_appointment POST', '/upload_record POST', '/download_record'} <= set(results)
+    assert all(row['errors'] == 0 for row in results.values()), results
+    dashboard = results['/patient/dashboard']
+    assert dashboard['p50'] <= dashboard['p95'] <= dashboard['p99'] and dashboard['queries'] >= 1
+    assert compare(results, {'routes': results}) == []
+
+
+def test_regressions_fail_their_budget():
+    baseline = {'routes': {
+        '/appointments': {'p95': 10.0, 'queries': 2.0},
+        '/records': {'p95': 10.0, 'queries': 2.0, 'budget_p95_ms': 40.0},
+    }}
+    row = {'requests': 100, 'p95': 12.0, 'queries': 2.4, 'errors': 0}
+    assert compare({'/appointments': row, '/records': row, '/new': row}, baseline) == []
+
+    failures = compare({'/appointments': {**row, 'p95': 20.0, 'queries': 12.0},
+                        '/records': {**row, 'p95': 39.0, 'errors': 3}}, baseline)
+    assert failures == [
+        '/appointments: p95 20.0ms is over its 14.5ms budget (baseline 10.0ms)',
+        '/appointments: 12.0 queries per request is over its 2.7 budget (baseline 2.0)',
+        '/records: 3 of 100 requests failed',
+    ]
@@ -0,0 +1,111 @@
+"""
+Content-addressed upload storage tests
+"""
+
+import hashlib
+import io
+import os
+import time
+from datetime import timedelta
+
+import pytest
+
+from app import app as flask_app, db, upload_store, Blob, MedicalRecord
+from blobstore import BLOB_DIR, BlobStore, collect_garbage
+from conftest import login_as
+
+
+@pytest.fixture
+def uploads(app, tmp_path, monkeypatch):
+    monkeypatch.setitem(flask_app.config, 'UPLOAD_FOLDER', str(tmp_path))
+    return tmp_path
+
+
+def upload(client, content, filename, title='Scan'):
+    return client.post('/upload_record', data={'title': title, 'record_type': 'scan',
+                                               'file': (io.BytesIO(content), filename)})
+
+
+def blob_files(root):
+    return sorted(path for path in (root / BLOB_DIR).rglob('*') if path.is_file())
+
+
+def test_duplicate_uploads_share_one_blob(client, sample_data, uploads):
+    login_as(client, sample_data['patients'][0].user)
+    content = os.urandom(300 * 1024)
+    digest = hashlib.sha256(content).hexdigest()
+
+    upload(client, content, 'mri.pdf', 'First')
+    upload(client, content, 'mri copy.pdf', 'Second')
+
+    records = MedicalRecord.query.filter(MedicalRecord.title.in_(['First', 'Second'])).all()
+    assert {record.file_path for record in records} == {os.path.join(BLOB_DIR, digest[:2], digest[2:4], digest)}
+    assert {record.file_name for record in records} == {'mri.pdf', 'mri_copy.pdf'}
+    assert blob_files(uploads) == [uploads / BLOB_DIR / digest[:2] / digest[2:4] / digest]
+    assert (uploads / records[0].file_path).read_bytes() == content
+
+    blob = db.session.get(Blob, digest)
+    assert (blob.size, blob.ref_count) == (len(content), 2)
+
+    response = client.get(f'/download_record/{records[1].id}')
+    assert response.data == content
+    assert 'mri_copy.pdf' in response.headers['Content-Disposition']
+
+
+def test_unused_blobs_are_collected_after_the_grace_period(client, sample_data, uploads):
+    login_as(client, sample_data['patients'][0].user)
+    upload(client, b'shared', 'a.txt', 'Keep')
+    upload(client, b'shared', 'b.txt', 'Drop')
+    upload(client, b'alone', 'c.txt', 'Gone')
+
+    for record in MedicalRecord.query.filter(MedicalRecord.title.in_(['Drop', 'Gone'])):
+        db.session.delete(record)
+    db.session.commit()
+    assert [blob.ref_count for blob in Blob.query.order_by(Blob.ref_count)] == [0, 1]
+
+    store = upload_store()
+    assert collect_garbage(db, Blob, store) == 0  # Still within the grace period
+
+    old = time.time() - 7200
+    for path in blob_files(uploads):
+        os.utime(path, (old, old))
+    Blob.query.update({'updated_at': Blob.updated_at - timedelta(hours=2)})
+    db.session.commit()
+    assert collect_garbage(db, Blob, store) == 1
+    assert [path.read_bytes() for path in blob_files(uploads)] == [b'shared']
+    assert Blob.query.count() == 1
+
+
+def test_collection_spares_a_blob_touched_by_an_upload(app, uploads):
+    store = BlobStore(str(uploads))
+    digest, size, created = store.store(io.BytesIO(b'report'))
+    assert (size, created) == (6, True)
+    db.session.add(Blob(sha256=digest, size=size, ref_count=0))
+    db.session.commit()
+    Blob.query.update({'updated_at': Blob.updated_at - timedelta(hours=2)})
+    db.session.commit()
+
+    # Same content arriving again refreshes the file
+    assert store.store(io.BytesIO(b'report')) == (digest, 6, False)
+    assert collect_garbage(db, Blob, store) == 0
+    assert os.path.exists(store.path(digest))
+
+
+def test_spool_files_never_outlive_the_request(client, sample_data, uploads):
+    login_as(client, sample_data['patients'][0].user)
+    upload(client, b'x' * (2 * 1024 * 1024), 'big.bin')
+    upload(client, b'x' * (2 * 1024 * 1024), 'again.bin')
+    assert os.listdir(uploads / BLOB_DIR / 'tmp') == []
+    assert len(blob_files(uploads)) == 1
+
+
+def test_files_stored_before_blobs_still_download(client, sample_data, uploads):
+    (uploads / '1_20240101_old.pdf').write_bytes(b'legacy')
+    patient = sample_data['patients'][0]
+    record = MedicalRecord(patient_id=patient.id, record_type='scan', title='Old', file_path='1_20240101_old.pdf')
+    db.session.add(record)
+    db.session.commit()
+    assert Blob.query.count() == 0
+
+    login_as(client, patient.user)
+    assert client.get(f'/download_record/{record.id}').data == b'legacy'
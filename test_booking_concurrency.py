@@ -0,0 +1,149 @@
+"""
+Concurrent booking tests
+The stress test runs several processes, each with its own copy of the app,
+against one SQLite file, the way gunicorn workers share medvault.db.
+Scale it up with MEDVAULT_STRESS_WORKERS / MEDVAULT_STRESS_BOOKINGS.
+"""
+
+import multiprocessing
+import os
+import random
+import sqlite3
+import tempfile
+from datetime import date, time
+
+import pytest
+
+from app import db, Appointment, Notification, SlotTaken, book_slot
+from conftest import login_as
+
+SLOT_DATE = date(2030, 1, 7)
+SLOT_TIMES = ['09:00', '09:30', '10:00', '10:30', '11:00', '11:30']
+DOCTORS = 4
+PATIENTS = 20
+
+
+def test_second_claim_of_a_slot_fails(sample_data):
+    doctor = sample_data['doctors'][0]
+    first, second = sample_data['patients'][:2]
+    notifications = Notification.query.filter_by(user_id=doctor.user_id).count()
+
+    book_slot(first, doctor, SLOT_DATE, time(9, 0))
+    with pytest.raises(SlotTaken):
+        book_slot(second, doctor, SLOT_DATE, time(9, 0))
+
+    # The losing claim left nothing behind, not even the notification
+    assert Appointment.query.filter_by(appointment_date=SLOT_DATE).count() == 1
+    assert Notification.query.filter_by(user_id=doctor.user_id).count() == notifications + 1
+
+
+def test_cancelled_slot_can_be_rebooked(sample_data):
+    doctor = sample_data['doctors'][0]
+    first, second = sample_data['patients'][:2]
+
+    appointment = book_slot(first, doctor, SLOT_DATE, time(9, 0))
+    appointment.status = 'cancelled'
+    db.session.commit()
+
+    book_slot(second, doctor, SLOT_DATE, time(9, 0))
+    assert Appointment.query.filter_by(appointment_date=SLOT_DATE).count() == 2
+
+
+def test_rebooked_slot_cannot_be_reactivated(client, sample_data):
+    doctor = sample_data['doctors'][0]
+    first, second = sample_data['patients'][:2]
+    cancelled = book_slot(first, doctor, SLOT_DATE, time(9, 0))
+    cancelled.status = 'cancelled'
+    db.session.commit()
+    book_slot(second, doctor, SLOT_DATE, time(9, 0))
+
+    login_as(client, doctor.user)
+    response = client.get(f'/appointment/action/{cancelled.id}/accept', follow_redirects=True)
+    assert response.status_code == 200 and 'already been taken' in response.get_data(as_text=True)
+    db.session.expire_all()
+    assert db.session.get(Appointment, cancelled.id).status == 'cancelled'
+
+
+def _setup_database():
+    from app import app, db, User, Patient, Doctor
+
+    with app.app_context():
+        for i in range(DOCTORS):
+            user = User(email=f'doctor{i}@stress.test', user_type='doctor', is_verified=True, password_hash='-')
+            db.session.add(user)
+            db.session.flush()
+            db.session.add(Doctor(user_id=user.id, first_name='Doc', last_name=str(i), specialization='General'))
+        for i in range(PATIENTS):
+            user = User(email=f'patient{i}@stress.test', user_type='patient', is_verified=True, password_hash='-')
+            db.session.add(user)
+            db.session.flush()
+            db.session.add(Patient(user_id=user.id, first_name='Pat', last_name=str(i)))
+        db.session.commit()
+
+
+def _book_worker(worker, bookings):
+    from app import app, outbox_sender, otp_store, Patient, Doctor
+
+    rng = random.Random(worker)
+    with app.app_context():
+        patient_users = [p.user_id for p in Patient.query.all()]
+        doctor_ids = [d.id for d in Doctor.query.all()]
+
+    client = app.test_client()
+    statuses = []
+    for _ in range(bookings):
+        with client.session_transaction() as sess:
+            sess['user_id'] = rng.choice(patient_users)
+            sess['user_type'] = 'patient'
+        response = client.post('/book_appointment', data={
+            'doctor_id': rng.choice(doctor_ids),
+            'appointment_date': SLOT_DATE.isoformat(),
+            'appointment_time': rng.choice(SLOT_TIMES),
+            'reason': f'stress {worker}',
+        })
+        statuses.append(response.status_code)
+    assert not outbox_sender.running and not otp_store.sweeping
+    return statuses
+
+
+def test_concurrent_bookings_never_double_book():
+    workers = int(os.environ.get('MEDVAULT_STRESS_WORKERS', 8))
+    bookings = int(os.environ.get('MEDVAULT_STRESS_BOOKINGS', 250))
+    path = os.path.join(tempfile.mkdtemp(prefix='medvault-stress-'), 'medvault.db')
+    uri = 'sqlite:///' + path
+
+    # Spawned workers import app (through this module) with the environment
+    # they inherit, so point them at the stress database before starting,
+    # and keep them from sending mail or sweeping codes in the background
+    ctx = multiprocessing.get_context('spawn')
+    worker_env = {'MEDVAULT_DATABASE_URI': uri, 'MEDVAULT_OUTBOX_WORKERS': '0', 'MEDVAULT_OTP_SWEEP_INTERVAL': '0'}
+    saved_env = {name: os.environ.get(name) for name in worker_env}
+    os.environ.update(worker_env)
+    try:
+        with ctx.Pool(1) as pool:
+            pool.apply(_setup_database)
+        with ctx.Pool(workers) as pool:
+            results = pool.starmap(_book_worker, [(w, bookings) for w in range(workers)])
+    finally:
+        for name, value in saved_env.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+    statuses = [status for worker_statuses in results for status in worker_statuses]
+    assert len(statuses) == workers * bookings
+    assert set(statuses) == {302}, 'every request ends in a redirect, never a 500'
+
+    conn = sqlite3.connect(path)
+    doubles = conn.execute(
+        "SELECT doctor_id, appointment_date, appointment_time, COUNT(*) FROM appointment "
+        "WHERE status != 'cancelled' GROUP BY 1, 2, 3 HAVING COUNT(*) > 1"
+    ).fetchall()
+    booked = conn.execute('SELECT COUNT(*) FROM appointment').fetchone()[0]
+    notified = conn.execute("SELECT COUNT(*) FROM notification WHERE title = 'New Appointment'").fetchone()[0]
+    conn.close()
+
+    assert doubles == []
+    assert booked == DOCTORS * len(SLOT_TIMES)
+    assert notified == booked
@@ -0,0 +1,82 @@
+"""
+Doctor directory cache tests
+"""
+
+from app import db, cache_version, directory_cache, load_directory, Doctor
+from cache import VersionedCache
+from conftest import captured_selects, login_as
+
+
+def other_worker():
+    """A second worker's copy of the directory cache, checking the version on every read"""
+    return VersionedCache(load_directory, lambda: cache_version('directory'), check_interval=0)
+
+
+def test_reads_between_checks_do_not_touch_the_database(app, sample_data):
+    directory = directory_cache.get()
+    assert [doctor.first_name for doctor in directory.available_doctors] == ['Doc0', 'Doc1']
+    assert directory.available_doctors[0].hospital.name == 'City General Hospital'
+    assert directory.doctors_by_hospital[sample_data['hospital'].id] == directory.doctors
+    assert directory.doctors_by_id[directory.doctors[1].id] is directory.doctors[1]
+
+    with captured_selects() as statements:
+        for _ in range(5):
+            assert directory_cache.get() is directory
+    assert statements == []
+
+
+def test_profile_write_reaches_other_workers(client, sample_data, monkeypatch):
+    monkeypatch.setattr(directory_cache, 'check_interval', 60)
+    worker = other_worker()
+    assert worker.get().available_doctors[0].specialization == 'Cardiology'
+    directory_cache.get()
+
+    doctor = sample_data['doctors'][0]
+    login_as(client, doctor.user)
+    client.post('/complete_doctor_profile', data={
+        'first_name': 'Doc0', 'last_name': 'Test', 'specialization': 'Neurology',
+        'hospital_id': str(sample_data['hospital'].id), 'consultation_fee': '120'})
+
+    assert cache_version('directory') == 1
+    assert worker.get().available_doctors[0].specialization == 'Neurology'
+    # The writing worker does not wait for its check interval
+    assert directory_cache.get().available_doctors[0].specialization == 'Neurology'
+    login_as(client, sample_data['patients'][0].user)
+    assert 'Neurology' in client.get('/book_appointment').get_data(as_text=True)
+
+
+def test_unannounced_writes_wait_for_a_version_bump(client, sample_data):
+    worker = other_worker()
+    worker.get()
+
+    Doctor.query.filter_by(first_name='Doc1').update({'is_available': False})
+    db.session.commit()
+    assert len(worker.get().available_doctors) == 2
+
+    login_as(client, sample_data['hospital'].user)
+    client.post('/complete_hospital_profile', data={
+        'name': 'City General Hospital', 'address': '123 Medical Center Drive', 'phone': '555-0100'})
+    assert [doctor.first_name for doctor in worker.get().available_doctors] == ['Doc0']
+
+
+def test_booking_and_plain_search_pages_come_from_the_cache(client, sample_data):
+    login_as(client, sample_data['patients'][0].user)
+    client.get('/book_appointment')
+
+    for path in ('/book_appointment', '/search_doctors'):
+        with captured_selects() as statements:
+            page = client.get(path).get_data(as_text=True)
+        assert 'Doc0' in page and 'Doc1' in page
+        assert not any('FROM doctor' in statement for statement, _ in statements)
+
+
+def test_value_and_version_are_read_together():
+    versions = iter([1, 2])
+    loads = []
+    cache = VersionedCache(lambda: loads.append(None) or f'load {len(loads)}', lambda: next(versions),
+                           check_interval=60)
+    assert cache.get_versioned() == ('load 1', 1)
+    assert cache.get() == 'load 1'
+
+    cache.invalidate()
+    assert cache.get_versioned() == ('load 2', 2)
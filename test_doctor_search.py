@@ -0,0 +1,105 @@
+"""
+Full-text doctor search tests
+"""
+
+from sqlalchemy import text
+
+from app import db, Doctor, Hospital, search_doctors_query
+from conftest import make_user
+from migrations import ensure_doctor_search
+
+
+def add_doctor(first_name, specialization, hospital=None, bio=None, fee=100.0, experience=5, available=True):
+    doctor = Doctor(user_id=make_user(f'{first_name.lower()}@search.test', 'doctor').id, first_name=first_name,
+                    last_name='Search', specialization=specialization, bio=bio, consultation_fee=fee,
+                    experience=experience, is_available=available, hospital_id=hospital.id if hospital else None)
+    db.session.add(doctor)
+    db.session.commit()
+    return doctor
+
+
+def names(**search):
+    return [doctor.first_name for doctor in search_doctors_query(**search)]
+
+
+def test_prefix_match_ranks_specialization_above_bio(app):
+    add_doctor('Bio', 'General Medicine', bio='Trained alongside the cardiology team')
+    add_doctor('Heart', 'Cardiology')
+    add_doctor('Skin', 'Dermatology')
+    add_doctor('Away', 'Cardiology', available=False)
+
+    assert names(terms='cardio') == ['Heart', 'Bio']
+    assert names(terms='heart card') == ['Heart']
+    assert names(terms='zzz') == []
+
+
+def test_location_matches_only_the_hospital(app):
+    north = Hospital(user_id=make_user('north@search.test', 'hospital').id, name='Northside Clinic',
+                     address='1 Elm Street, Springfield', phone='555-0101')
+    south = Hospital(user_id=make_user('south@search.test', 'hospital').id, name='South General',
+                     address='9 Oak Road, Shelbyville', phone='555-0102')
+    db.session.add_all([north, south])
+    db.session.commit()
+    add_doctor('Spring', 'Cardiology', north)
+    add_doctor('Shelby', 'Cardiology', south, bio='Grew up in Springfield')
+
+    assert names(terms='cardiology', location='springfield') == ['Spring']
+    assert names(location='south gen') == ['Shelby']
+
+    # Hospital edits reach the index through the triggers
+    north.address = '1 Elm Street, Capital City'
+    db.session.commit()
+    assert names(location='springfield') == []
+    assert names(location='capital') == ['Spring']
+
+
+def test_profile_writes_keep_the_index_in_step(app):
+    doctor = add_doctor('Change', 'Dermatology')
+    assert names(terms='derma') == ['Change']
+
+    doctor.specialization = 'Neurology'
+    db.session.commit()
+    assert names(terms='derma') == []
+    assert names(terms='neuro') == ['Change']
+
+    db.session.delete(doctor)
+    db.session.commit()
+    assert names(terms='neuro') == []
+
+
+def test_fee_experience_and_hospital_filters(app):
+    hospital = Hospital(user_id=make_user('filters@search.test', 'hospital').id, name='Filter Hospital',
+                        address='5 Filter Lane', phone='555-0103')
+    db.session.add(hospital)
+    db.session.commit()
+    add_doctor('Cheap', 'Cardiology', fee=50, experience=2)
+    add_doctor('Senior', 'Cardiology', hospital, fee=150, experience=20)
+
+    assert names(terms='cardiology', max_fee=100) == ['Cheap']
+    assert names(terms='cardiology', min_fee=100) == ['Senior']
+    assert names(min_experience=10) == ['Senior']
+    assert names(hospital_id=hospital.id) == ['Senior']
+
+
+def test_query_syntax_in_input_is_treated_as_words(app):
+    add_doctor('Quote', 'Cardiology')
+    assert names(terms='"cardio*) (quote:') == ['Quote']
+    assert names(terms='  --  ') == ['Quote']
+
+
+def test_stale_index_is_rebuilt(app):
+    add_doctor('Stale', 'Pediatrics')
+    with db.engine.begin() as conn:
+        conn.execute(text('DELETE FROM doctor_search'))
+    assert names(terms='pediatrics') == []
+
+    assert ensure_doctor_search(db)
+    assert names(terms='pediatrics') == ['Stale']
+    assert not ensure_doctor_search(db)
+
+
+def test_search_page_uses_location(client, sample_data):
+    page = client.get('/search_doctors?specialization=derm&location=city+general').get_data(as_text=True)
+    assert 'Doc1' in page and 'Doc0' not in page
+    page = client.get('/search_doctors?location=nowhere').get_data(as_text=True)
+    assert 'No Doctors Found' in page
@@ -0,0 +1,96 @@
+"""
+Record download tests: ETags, byte ranges and proxy offload
+"""
+
+import hashlib
+import io
+import os
+from datetime import datetime, timedelta
+
+import pytest
+
+from app import app as flask_app, db, share_records, MedicalRecord
+from conftest import login_as
+
+CONTENT = bytes(range(256)) * 4096  # 1 MiB
+
+
+@pytest.fixture
+def record(client, sample_data, tmp_path, monkeypatch):
+    monkeypatch.setitem(flask_app.config, 'UPLOAD_FOLDER', str(tmp_path))
+    login_as(client, sample_data['patients'][0].user)
+    client.post('/upload_record', data={'title': 'CT', 'record_type': 'scan',
+                                        'file': (io.BytesIO(CONTENT), 'chest.dcm')})
+    return MedicalRecord.query.filter_by(title='CT').one()
+
+
+def test_strong_etag_and_revalidation(client, record):
+    etag = '"%s"' % hashlib.sha256(CONTENT).hexdigest()
+    response = client.get(f'/download_record/{record.id}')
+    assert response.status_code == 200
+    assert response.headers['ETag'] == etag
+    assert response.headers['Accept-Ranges'] == 'bytes'
+    assert 'private' in response.headers['Cache-Control']
+    assert response.data == CONTENT
+
+    response = client.get(f'/download_record/{record.id}', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.data == b''
+
+
+def test_range_requests_return_partial_content(client, record):
+    response = client.get(f'/download_record/{record.id}', headers={'Range': 'bytes=1000-1999'})
+    assert response.status_code == 206
+    assert response.headers['Content-Range'] == f'bytes 1000-1999/{len(CONTENT)}'
+    assert response.data == CONTENT[1000:2000]
+
+    # A changed file (different ETag) is sent whole
+    response = client.get(f'/download_record/{record.id}', headers={'Range': 'bytes=0-9', 'If-Range': '"stale"'})
+    assert response.status_code == 200 and len(response.data) == len(CONTENT)
+
+    response = client.get(f'/download_record/{record.id}', headers={'Range': f'bytes={len(CONTENT)}-'})
+    assert response.status_code == 416
+
+
+def test_nginx_sends_the_file(client, record, monkeypatch):
+    monkeypatch.setitem(flask_app.config, 'DOWNLOAD_OFFLOAD', 'x-accel-redirect')
+    response = client.get(f'/download_record/{record.id}', headers={'Range': 'bytes=0-9'})
+    assert response.status_code == 200
+    assert response.headers['X-Accel-Redirect'] == '/_protected_uploads/' + record.file_path.replace(os.sep, '/')
+    assert 'X-Sendfile' not in response.headers
+    assert 'chest.dcm' in response.headers['Content-Disposition']
+    assert response.data == b''
+
+    etag = response.headers['ETag']
+    response = client.get(f'/download_record/{record.id}', headers={'If-None-Match': etag})
+    assert response.status_code == 304 and 'X-Accel-Redirect' not in response.headers
+
+
+def test_x_sendfile_mode(client, record, monkeypatch):
+    monkeypatch.setitem(flask_app.config, 'DOWNLOAD_OFFLOAD', 'x-sendfile')
+    response = client.get(f'/download_record/{record.id}')
+    assert response.headers['X-Sendfile'] == os.path.join(flask_app.config['UPLOAD_FOLDER'], record.file_path)
+    assert response.data == b''
+
+
+def test_missing_records_and_files(client, record, tmp_path):
+    assert client.get('/download_record/9999').status_code == 404
+    os.remove(tmp_path / record.file_path)
+    assert client.get(f'/download_record/{record.id}').status_code == 404
+
+
+def test_only_the_patient_and_shared_doctors_may_download(client, sample_data, record):
+    doctor, other = sample_data['doctors'][0], sample_data['patients'][1]
+    login_as(client, other.user)
+    assert client.get(f'/download_record/{record.id}').status_code == 404
+    login_as(client, doctor.user)
+    assert client.get(f'/download_record/{record.id}').status_code == 404
+
+    share_records([record.id], [doctor.id], expires_at=datetime.utcnow() + timedelta(days=1))
+    db.session.commit()
+    assert client.get(f'/download_record/{record.id}').status_code == 200
+
+    share_records([record.id], [sample_data['doctors'][1].id], expires_at=datetime.utcnow() - timedelta(days=1))
+    db.session.commit()
+    login_as(client, sample_data['doctors'][1].user)
+    assert client.get(f'/download_record/{record.id}').status_code == 404
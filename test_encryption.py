@@ -0,0 +1,157 @@
+"""
+Encryption at rest tests
+"""
+
+import base64
+import io
+import os
+import tracemalloc
+
+import pytest
+from PIL import Image
+
+from app import app as flask_app, db, upload_store, Blob, MedicalRecord
+from blobstore import BlobStore
+from conftest import login_as
+from encryption import (DecryptingReader, DecryptionError, EncryptingWriter, Keyring, MAGIC, benchmark,
+                        encrypt_file, open_file)
+from previews import render_previews
+
+KEY = bytes(range(32))
+OLD_KEY = bytes(range(32, 64))
+
+
+def encrypt(data, keyring, chunk_size=16, writes=7):
+    buffer = io.BytesIO()
+    writer = EncryptingWriter(buffer, keyring, chunk_size)
+    for start in range(0, len(data), writes):
+        writer.write(data[start:start + writes])
+    writer.finish()
+    return buffer.getvalue()
+
+
+def reader(tmp_path, sealed, keyring):
+    path = tmp_path / 'sealed'
+    path.write_bytes(sealed)
+    return DecryptingReader(open(path, 'rb'), keyring)
+
+
+@pytest.mark.parametrize('size', [0, 1, 15, 16, 17, 48, 100])
+def test_round_trip_and_random_access(tmp_path, size):
+    keyring = Keyring([KEY])
+    data = os.urandom(size)
+    with reader(tmp_path, encrypt(data, keyring), keyring) as f:
+        assert f.size == size
+        assert f.read() == data
+        for offset in (0, 5, 16, 33, size - 1):
+            if 0 <= offset < size:
+                f.seek(offset)
+                assert f.read(20) == data[offset:offset + 20]
+
+
+def test_tampering_is_detected(tmp_path):
+    keyring = Keyring([KEY])
+    sealed = encrypt(b'x' * 100, keyring)
+
+    flipped = bytearray(sealed)
+    flipped[-40] ^= 1
+    with pytest.raises(DecryptionError):
+        reader(tmp_path, bytes(flipped), keyring).read()
+
+    # Dropping whole trailing chunks leaves a last chunk not sealed as last
+    with pytest.raises(DecryptionError):
+        reader(tmp_path, sealed[:-(16 + 16)], keyring).read()
+
+    with pytest.raises(DecryptionError, match='unknown master key'):
+        reader(tmp_path, sealed, Keyring([OLD_KEY]))
+
+
+def test_old_master_keys_still_read(tmp_path):
+    sealed = encrypt(b'before rotation', Keyring([OLD_KEY]))
+    with reader(tmp_path, sealed, Keyring([KEY, OLD_KEY])) as f:
+        assert f.read() == b'before rotation'
+
+
+def test_memory_stays_at_one_chunk(tmp_path):
+    keyring = Keyring([KEY])
+    path = tmp_path / 'big'
+    tracemalloc.start()
+    with open(path, 'wb') as f:
+        writer = EncryptingWriter(f, keyring)
+        for _ in range(128):
+            writer.write(b'\0' * 32 * 1024)  # 4 MiB in all
+        writer.finish()
+    with open_file(str(path), keyring) as f:
+        while f.read(8192):
+            pass
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    assert peak < 512 * 1024
+
+
+@pytest.fixture
+def encrypted_uploads(client, sample_data, tmp_path, monkeypatch):
+    monkeypatch.setitem(flask_app.config, 'UPLOAD_FOLDER', str(tmp_path))
+    monkeypatch.setitem(flask_app.config, 'ENCRYPTION_KEYS', base64.urlsafe_b64encode(KEY).decode())
+    login_as(client, sample_data['patients'][0].user)
+    return tmp_path
+
+
+def test_uploads_are_encrypted_on_disk(client, encrypted_uploads):
+    content = os.urandom(200 * 1024)
+    for title in ('One', 'Two'):
+        client.post('/upload_record', data={'title': title, 'record_type': 'scan',
+                                            'file': (io.BytesIO(content), 'scan.dcm')})
+    one, two = MedicalRecord.query.filter(MedicalRecord.title.in_(['One', 'Two'])).order_by(MedicalRecord.id)
+    assert one.file_path == two.file_path
+
+    stored = (encrypted_uploads / one.file_path).read_bytes()
+    assert stored.startswith(MAGIC) and content[:64] not in stored
+    assert db.session.get(Blob, BlobStore.digest_of(one.file_path)).size == len(content)
+
+    response = client.get(f'/download_record/{one.id}')
+    assert response.data == content
+    assert response.headers['Content-Length'] == str(len(content))
+    etag = response.headers['ETag']
+
+    response = client.get(f'/download_record/{one.id}', headers={'Range': 'bytes=70000-140000'})
+    assert response.status_code == 206
+    assert response.data == content[70000:140001]
+    assert client.get(f'/download_record/{one.id}', headers={'If-None-Match': etag}).status_code == 304
+
+
+def test_previews_of_encrypted_uploads_are_encrypted(client, encrypted_uploads):
+    image = io.BytesIO()
+    Image.new('RGB', (400, 200), 'blue').save(image, 'PNG')
+    client.post('/upload_record', data={'title': 'Photo', 'record_type': 'scan',
+                                        'file': (io.BytesIO(image.getvalue()), 'rash.png')})
+    record = MedicalRecord.query.filter_by(title='Photo').one()
+    store = upload_store()
+    digest = BlobStore.digest_of(record.file_path)
+    targets = {320: store.preview_path(digest, 320)}
+
+    assert render_previews(store.path(digest), targets, store.preview_path(digest, None), store.keyring) == [320]
+    with open(targets[320], 'rb') as f:
+        assert f.read(len(MAGIC)) == MAGIC
+    response = client.get(f'/record_preview/{record.id}/small')
+    assert Image.open(io.BytesIO(response.data)).size == (320, 160)
+
+
+def test_existing_files_can_be_encrypted_in_place(client, sample_data, tmp_path, monkeypatch):
+    monkeypatch.setitem(flask_app.config, 'UPLOAD_FOLDER', str(tmp_path))
+    login_as(client, sample_data['patients'][0].user)
+    client.post('/upload_record', data={'title': 'Plain', 'record_type': 'scan',
+                                        'file': (io.BytesIO(b'plain text report'), 'report.txt')})
+    record = MedicalRecord.query.filter_by(title='Plain').one()
+
+    monkeypatch.setitem(flask_app.config, 'ENCRYPTION_KEYS', base64.urlsafe_b64encode(KEY).decode())
+    store = upload_store()
+    assert [encrypt_file(path, store.keyring) for path in store.files()] == [True]
+    assert not any(encrypt_file(path, store.keyring) for path in store.files())
+    assert client.get(f'/download_record/{record.id}').data == b'plain text report'
+
+
+def test_benchmark_reports_each_size(tmp_path):
+    rows = benchmark([1], str(tmp_path))
+    assert rows[0]['size_mb'] == 1
+    assert all(rows[0][name] > 0 for name in ('plain', 'encrypt', 'decrypt'))
@@ -0,0 +1,210 @@
+"""
+Live event tests: recording on commit, and the SSE server's fan-out
+"""
+
+import asyncio
+import json
+import socket
+import threading
+import time
+
+import pytest
+
+from app import app as flask_app, db, bump_security_version, create_notification, Appointment, LiveEvent, User
+from conftest import login_as
+from events import EventServer, wake
+
+
+@pytest.fixture
+def events_on(app, monkeypatch):
+    monkeypatch.setitem(app.config, 'EVENTS_URL', '/events')
+
+
+@pytest.fixture
+def event_server(app, events_on, monkeypatch):
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    # A long poll interval: events must arrive through the commit wake-up
+    server = EventServer(app, db, LiveEvent, User, port=0, poll_seconds=30)
+    asyncio.run_coroutine_threadsafe(server.start(), loop).result(5)
+    monkeypatch.setitem(app.config, 'EVENTS_BIND', f'127.0.0.1:{server.port}')
+    yield server
+    asyncio.run_coroutine_threadsafe(server.stop(), loop).result(5)
+    asyncio.run_coroutine_threadsafe(loop.shutdown_default_executor(), loop).result(5)
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join(5)
+    loop.close()
+
+
+def session_cookie(user):
+    serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+    value = serializer.dumps({'user_id': user.id, 'user_type': user.user_type, 'email': user.email})
+    return f"{flask_app.config['SESSION_COOKIE_NAME']}={value}"
+
+
+def open_stream(server, user=None, last_event_id=None):
+    sock = socket.create_connection(('127.0.0.1', server.port), timeout=5)
+    headers = ['GET /events HTTP/1.1', 'Host: localhost', 'Accept: text/event-stream']
+    if user is not None:
+        headers.append(f'Cookie: {session_cookie(user)}')
+    if last_event_id is not None:
+        headers.append(f'Last-Event-ID: {last_event_id}')
+    sock.sendall(('\r\n'.join(headers) + '\r\n\r\n').encode())
+    reader = sock.makefile('rb')
+    status = reader.readline().decode()
+    while reader.readline() not in (b'\r\n', b''):
+        pass
+    return sock, reader, status
+
+
+def read_event(reader):
+    fields = {}
+    while True:
+        line = reader.readline().decode()
+        if not line:
+            raise ConnectionError('stream closed')
+        line = line.rstrip('\n')
+        if not line:
+            if 'data' in fields:
+                return fields
+            continue
+        if not line.startswith(':'):
+            name, _, value = line.partition(': ')
+            fields[name] = value
+
+
+def events_for(user_id):
+    rows = LiveEvent.query.filter_by(user_id=user_id).order_by(LiveEvent.id)
+    return [(row.kind, json.loads(row.payload)) for row in rows]
+
+
+def test_nothing_is_recorded_while_live_events_are_off(client, sample_data):
+    login_as(client, sample_data['patients'][0].user)
+    client.post('/book_appointment', data={'doctor_id': sample_data['doctors'][0].id,
+                                           'appointment_date': '2030-01-07', 'appointment_time': '09:00'})
+    assert Appointment.query.filter_by(reason=None, doctor_id=sample_data['doctors'][0].id).count() == 1
+    assert LiveEvent.query.count() == 0
+
+
+def test_bookings_and_status_changes_are_recorded_on_commit(client, sample_data, events_on):
+    patient_user = sample_data['patients'][0].user
+    doctor = sample_data['doctors'][0]
+    login_as(client, patient_user)
+    client.post('/book_appointment', data={'doctor_id': doctor.id, 'appointment_date': '2030-01-07',
+                                           'appointment_time': '09:00'})
+
+    doctor_events = events_for(doctor.user_id)
+    assert [kind for kind, _ in doctor_events] == ['notification', 'appointment']
+    assert doctor_events[0][1]['title'] == 'New Appointment'
+    appointment_id = doctor_events[1][1]['id']
+    assert events_for(patient_user.id) == [('appointment', doctor_events[1][1])]
+    assert doctor_events[1][1]['status'] == 'pending'
+
+    login_as(client, doctor.user)
+    client.get(f'/appointment/action/{appointment_id}/accept')
+    assert events_for(patient_user.id)[-1][1]['status'] == 'confirmed'
+
+    # Rolled back changes are not announced
+    db.session.get(Appointment, appointment_id).status = 'cancelled'
+    db.session.flush()
+    db.session.rollback()
+    assert events_for(patient_user.id)[-1][1]['status'] == 'confirmed'
+
+
+def test_committed_events_are_pushed_to_the_user(event_server, sample_data):
+    doctor_user = sample_data['doctors'][0].user
+    sock, reader, status = open_stream(event_server, doctor_user)
+    try:
+        assert status.startswith('HTTP/1.1 200')
+        deadline = time.monotonic() + 5
+        while not event_server.connections and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        create_notification(sample_data['doctors'][1].user_id, 'Not for you', 'Someone else')
+        create_notification(doctor_user.id, 'Lab results', 'Results are in')
+        db.session.commit()
+
+        event = read_event(reader)
+        assert event['event'] == 'notification'
+        assert json.loads(event['data'])['title'] == 'Lab results'
+    finally:
+        sock.close()
+
+
+def test_reconnecting_clients_replay_missed_events(event_server, sample_data):
+    doctor_user = sample_data['doctors'][0].user
+    for i in range(3):
+        create_notification(doctor_user.id, f'Missed {i}', 'While offline')
+    db.session.commit()
+    first_id = LiveEvent.query.filter(LiveEvent.user_id == doctor_user.id,
+                                      LiveEvent.payload.contains('Missed 0')).one().id
+
+    sock, reader, _ = open_stream(event_server, doctor_user, last_event_id=first_id)
+    try:
+        titles = [json.loads(read_event(reader)['data'])['title'] for _ in range(2)]
+        assert titles == ['Missed 1', 'Missed 2']
+    finally:
+        sock.close()
+
+
+def wait_for_connections(server, count):
+    deadline = time.monotonic() + 5
+    while server.connections != count and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return server.connections
+
+
+def test_logout_all_closes_open_streams(event_server, sample_data):
+    doctor_user, patient_user = sample_data['doctors'][0].user, sample_data['patients'][0].user
+    revoked, _, _ = open_stream(event_server, doctor_user)
+    kept, _, _ = open_stream(event_server, patient_user)
+    try:
+        assert wait_for_connections(event_server, 2) == 2
+        bump_security_version(doctor_user)
+        wake(('127.0.0.1', event_server.port))
+        assert wait_for_connections(event_server, 1) == 1
+        assert {client.user_id for clients in event_server.clients.values() for client in clients} == {
+            patient_user.id}
+    finally:
+        revoked.close()
+        kept.close()
+
+
+def test_streams_end_after_their_lifetime(event_server, sample_data):
+    event_server.max_stream_seconds = 0.2
+    sock, reader, _ = open_stream(event_server, sample_data['patients'][0].user)
+    try:
+        reader.readline()  # retry: ...
+        reader.readline()
+        assert reader.readline() == b''  # closed by the server; the browser reconnects
+    finally:
+        sock.close()
+
+
+def test_streams_need_a_logged_in_user(event_server, sample_data):
+    sock, _, status = open_stream(event_server)
+    sock.close()
+    assert status.startswith('HTTP/1.1 401')
+
+
+def test_idle_connections_do_not_take_threads(event_server, sample_data):
+    users = [sample_data['patients'][0].user, sample_data['doctors'][0].user]
+    open_stream(event_server, users[0])[0].close()  # start the executor threads
+    deadline = time.monotonic() + 5
+    while event_server.connections and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert event_server.connections == 0  # the hang-up is noticed without a heartbeat
+    threads_before = threading.active_count()
+
+    streams = [open_stream(event_server, users[i % 2]) for i in range(200)]
+    try:
+        assert all(status.startswith('HTTP/1.1 200') for _, _, status in streams)
+        deadline = time.monotonic() + 5
+        while event_server.connections < 200 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert event_server.connections == 200
+        assert threading.active_count() - threads_before < 40
+    finally:
+        for sock, _, _ in streams:
+            sock.close()
@@ -0,0 +1,58 @@
+"""
+Synthetic data generator tests
+"""
+
+from datetime import date, time
+
+import pytest
+from sqlalchemy import inspect
+
+from app import db, Appointment, Doctor, MedicalRecord, Notification, Patient, Prescription, User
+from generate_data import Generator, generate
+
+ANCHOR = date(2026, 3, 2)
+
+
+def rows(generator):
+    return (list(generator.users()), list(generator.doctor_rows()), list(generator.availability_rows()),
+            list(generator.patient_rows()), list(generator.appointment_rows()), list(generator.record_rows()))
+
+
+def test_same_seed_same_rows():
+    assert rows(Generator(0.02, seed=3, anchor=ANCHOR)) == rows(Generator(0.02, seed=3, anchor=ANCHOR))
+    assert rows(Generator(0.02, seed=3, anchor=ANCHOR)) != rows(Generator(0.02, seed=4, anchor=ANCHOR))
+
+
+def test_generated_rows_load_through_the_models(app):
+    counts = generate(0.02, seed=1, anchor=ANCHOR)
+    assert counts['appointment'] == Appointment.query.count() == 1000
+    assert counts['patient'] == Patient.query.count() == 200
+    assert counts['user'] == User.query.count() == 1 + 20 + 200
+
+    patient = db.session.get(Patient, 1)
+    assert patient.user.email == 'patient1@medvault.test' and patient.user.check_password('password123')
+    assert isinstance(patient.date_of_birth, date)
+
+    appointments = Appointment.query.all()
+    assert all(isinstance(a.appointment_time, time) and a.appointment_date.weekday() != 6 for a in appointments)
+    past = {a.status for a in appointments if a.appointment_date < ANCHOR}
+    upcoming = {a.status for a in appointments if a.appointment_date >= ANCHOR}
+    assert 'completed' in past and 'pending' not in past
+    assert {'pending', 'confirmed'} <= upcoming and 'completed' not in upcoming
+    assert all(a.hospital_id == a.doctor.hospital_id for a in appointments[:50])
+
+    prescription = Prescription.query.first()
+    assert prescription.appointment_id and db.session.get(Appointment, prescription.appointment_id).status == 'completed'
+    assert MedicalRecord.query.filter_by(is_shared=True).first().shares
+    doctor_user = db.session.get(Doctor, 1).user
+    unread = Notification.query.filter_by(user_id=doctor_user.id, is_read=False).count()
+    assert doctor_user.unread_notifications == unread > 0
+
+
+def test_indexes_are_rebuilt_and_the_database_must_be_empty(app):
+    generate(0.02, seed=1, anchor=ANCHOR)
+    names = {index['name'] for index in inspect(db.engine).get_indexes('appointment')}
+    assert {'uq_appointment_active_slot', 'ix_appointment_patient_date'} <= names
+
+    with pytest.raises(ValueError, match='empty database'):
+        generate(0.02, seed=1, anchor=ANCHOR)
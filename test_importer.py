@@ -0,0 +1,142 @@
+"""
+Bulk importer tests
+"""
+
+import csv
+import json
+from datetime import date, time
+
+from app import db, cache_version, Appointment, Doctor, DoctorAvailability, Hospital, Patient, User
+from importer import AppointmentImporter, import_file, read_rows, write_rejected
+
+
+def write_csv(path, rows):
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+    return str(path)
+
+
+def test_rows_stream_from_csv_json_and_json_lines(tmp_path):
+    rows = [{'email': 'a@x.org', 'name': 'A'}, {'email': 'b@x.org', 'name': 'B, "the second"'}]
+    write_csv(tmp_path / 'h.csv', rows)
+    (tmp_path / 'h.json').write_text(' [\n' + ',\n'.join(json.dumps(row) for row in rows) + '\n]\n')
+    (tmp_path / 'h.jsonl').write_text(''.join(json.dumps(row) + '\n' for row in rows) + '\n')
+
+    assert list(read_rows(str(tmp_path / 'h.csv'))) == [(2, rows[0]), (3, rows[1])]
+    assert list(read_rows(str(tmp_path / 'h.json'))) == [(1, rows[0]), (2, rows[1])]
+    assert list(read_rows(str(tmp_path / 'h.jsonl'))) == [(1, rows[0]), (2, rows[1])]
+    (tmp_path / 'empty.json').write_text('[]')
+    assert list(read_rows(str(tmp_path / 'empty.json'))) == []
+
+
+def test_undecodable_rows_are_rejected_not_fatal(app, sample_data, tmp_path):
+    patient = {'email': 'new@x.org', 'first_name': 'New', 'last_name': 'Patient'}
+    lines = tmp_path / 'patients.jsonl'
+    lines.write_text('{bad\n' + json.dumps(patient) + '\n')
+    result = import_file('patients', str(lines))
+    assert result.imported == 1
+    assert [(line, raw) for line, _, raw in result.rejected] == [(1, '{bad')]
+    assert result.rejected[0][1].startswith('not JSON')
+
+    array = tmp_path / 'patients.json'
+    array.write_text('[' + json.dumps({**patient, 'email': 'other@x.org'}) + ', {bad]')
+    result = import_file('patients', str(array))
+    assert result.imported == 1 and result.rejected[0][:2] == (2, 'file ends inside a JSON value')
+
+
+def test_hospitals_doctors_and_schedules(app, sample_data, tmp_path):
+    hospitals = write_csv(tmp_path / 'hospitals.csv', [
+        {'email': 'North@Clinic.org', 'name': 'North Clinic', 'address': '1 North Rd', 'phone': '555-0200',
+         'latitude': '51.5', 'longitude': '-0.1'},
+        {'email': 'hospital@test.com', 'name': 'Taken', 'address': 'x', 'phone': '1',
+         'latitude': '', 'longitude': ''},
+    ])
+    result = import_file('hospitals', hospitals)
+    assert (result.imported, [line for line, _, _ in result.rejected]) == (1, [3])
+    assert 'already registered' in result.rejected[0][1]
+    assert cache_version('directory') == 1
+    assert User.query.filter_by(email='North@Clinic.org').count() == 1  # as typed, like registration
+
+    doctors = tmp_path / 'doctors.jsonl'
+    doctors.write_text('\n'.join(json.dumps(row) for row in [
+        {'email': 'ann@clinic.org', 'first_name': 'Ann', 'last_name': 'Lee', 'specialization': 'Oncology',
+         'hospital_email': 'North@Clinic.org', 'experience': 12, 'is_available': 'yes'},
+        {'email': 'bob@clinic.org', 'first_name': 'Bob', 'last_name': 'Ray', 'specialization': 'Oncology',
+         'hospital_email': 'nowhere@clinic.org'},
+        {'email': 'ann@clinic.org', 'first_name': 'Ann', 'last_name': 'Again', 'specialization': 'Oncology'},
+        {'email': 'cal@clinic.org', 'first_name': 'Cal', 'last_name': 'Ng', 'specialization': 'Oncology',
+         'experience': 'ten'},
+    ]))
+    result = import_file('doctors', str(doctors), batch_size=2)
+    assert result.imported == 1
+    assert sorted((line, reason.split(':')[0]) for line, reason, _ in result.rejected) == [
+        (2, 'hospital_email'), (3, 'email'), (4, 'experience')]
+    assert cache_version('directory') == 3  # One bump per batch
+
+    ann = Doctor.query.join(User).filter(User.email == 'ann@clinic.org').one()
+    assert (ann.hospital.name, ann.experience, ann.user.is_verified) == ('North Clinic', 12, True)
+    assert not ann.user.check_password('')
+
+    availability = write_csv(tmp_path / 'availability.csv', [
+        {'doctor_email': 'ann@clinic.org', 'day_of_week': 'Tuesday', 'start_time': '09:00', 'end_time': '12:30'},
+        {'doctor_email': 'ann@clinic.org', 'day_of_week': '4', 'start_time': '14:00', 'end_time': '13:00'},
+    ])
+    result = import_file('availability', availability)
+    assert result.imported == 1 and 'end_time' in result.rejected[0][1]
+    slot = DoctorAvailability.query.filter_by(doctor_id=ann.id).one()
+    assert (slot.day_of_week, slot.start_time, slot.end_time) == (1, time(9), time(12, 30))
+
+
+def test_patients_and_appointment_history(app, sample_data, tmp_path):
+    patients = write_csv(tmp_path / 'patients.csv', [
+        {'email': 'eve@mail.org', 'first_name': 'Eve', 'last_name': 'Park', 'date_of_birth': '1980-02-29'},
+        {'email': 'max@mail.org', 'first_name': 'Max', 'last_name': 'Park', 'date_of_birth': '29/02/1980'},
+    ])
+    result = import_file('patients', patients)
+    assert result.imported == 1 and result.rejected[0][1].startswith('date_of_birth')
+    assert Patient.query.join(User).filter(User.email == 'eve@mail.org').one().date_of_birth == date(1980, 2, 29)
+
+    booked = Appointment.query.first()
+    doctor_email = booked.doctor.user.email
+    appointment = {'patient_email': 'eve@mail.org', 'doctor_email': doctor_email,
+                   'appointment_date': '2020-05-04', 'appointment_time': '10:00', 'status': '',
+                   'reason': 'Follow-up'}
+    appointments = write_csv(tmp_path / 'appointments.csv', [
+        appointment,
+        {**appointment, 'status': 'cancelled'},
+        {**appointment, 'reason': 'Same slot twice'},
+        {**appointment, 'appointment_date': booked.appointment_date.isoformat(),
+         'appointment_time': booked.appointment_time.strftime('%H:%M')},
+        {**appointment, 'patient_email': 'nobody@mail.org'},
+        {**appointment, 'status': 'lost'},
+    ])
+    result = import_file('appointments', appointments)
+    assert result.imported == 2
+    assert [(line, reason) for line, reason, _ in result.rejected] == [
+        (7, 'status: not one of pending, confirmed, completed, cancelled'),
+        (4, 'appointment_time: slot already taken earlier in the file'),
+        (6, 'patient_email: no patient nobody@mail.org'),
+        (5, 'appointment_time: slot already booked'),
+    ]
+    imported = Appointment.query.filter_by(appointment_date=date(2020, 5, 4)).order_by(Appointment.id).all()
+    assert [a.status for a in imported] == ['completed', 'cancelled']
+    assert imported[0].hospital_id == booked.doctor.hospital_id
+
+    write_rejected(str(tmp_path / 'rejected.csv'), result.rejected)
+    with open(tmp_path / 'rejected.csv') as f:
+        rejected = list(csv.DictReader(f))
+    assert json.loads(rejected[0]['row'])['status'] == 'lost'
+
+
+def test_booked_slots_are_found_through_the_slot_index(app, sample_data):
+    booked = Appointment.query.first()
+    slot = (booked.doctor_id, booked.appointment_date, booked.appointment_time)
+    with db.engine.begin() as conn:
+        assert AppointmentImporter.booked_slots(conn, {slot, (booked.doctor_id, date(2001, 1, 1), time(9))}) == {slot}
+        plan = ' '.join(row[-1] for row in conn.exec_driver_sql(
+            'EXPLAIN QUERY PLAN SELECT 1 FROM import_slot s JOIN appointment a ON a.doctor_id = s.doctor_id '
+            "AND a.appointment_date = s.appointment_date AND a.appointment_time = s.appointment_time "
+            "AND a.status != 'cancelled'"))
+    assert 'SEARCH a USING' in plan and 'SCAN a' not in plan
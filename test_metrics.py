@@ -0,0 +1,86 @@
+"""
+Prometheus metrics tests
+"""
+
+import io
+import os
+import subprocess
+import sys
+
+from prometheus_client import REGISTRY
+
+from conftest import login_as
+
+WORKER_SCRIPT = """
+from app import app, init_db
+with app.app_context():
+    init_db()
+client = app.test_client()
+for _ in range({requests}):
+    client.get('/api/slots')
+"""
+
+SCRAPE_SCRIPT = """
+from app import app
+print(app.test_client().get('/metrics').get_data(as_text=True))
+"""
+
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+def test_requests_are_timed_and_counted_per_endpoint(client):
+    before = sample('medvault_request_duration_seconds_count', endpoint='about', method='GET')
+    ok = sample('medvault_requests_total', endpoint='about', method='GET', status='200')
+    missing = sample('medvault_requests_total', endpoint='unmatched', method='GET', status='404')
+
+    for _ in range(3):
+        client.get('/about')
+    client.get('/no/such/page')
+
+    assert sample('medvault_request_duration_seconds_count', endpoint='about', method='GET') == before + 3
+    assert sample('medvault_requests_total', endpoint='about', method='GET', status='200') == ok + 3
+    assert sample('medvault_requests_total', endpoint='unmatched', method='GET', status='404') == missing + 1
+    assert sample('medvault_requests_in_flight', endpoint='about') == 0
+
+    body = client.get('/metrics').get_data(as_text=True)
+    assert 'medvault_request_duration_seconds_bucket{endpoint="about"' in body
+    assert 'medvault_db_pool_checkouts_total' in body
+
+
+def test_upload_bytes_are_counted(client, sample_data, tmp_path, monkeypatch):
+    from app import app
+    monkeypatch.setitem(app.config, 'UPLOAD_FOLDER', str(tmp_path))
+    login_as(client, sample_data['patients'][0].user)
+    before = sample('medvault_upload_bytes_total')
+
+    client.post('/upload_record', data={'title': 'Scan', 'record_type': 'scan',
+                                        'file': (io.BytesIO(b'x' * 1234), 'scan.pdf')})
+    assert sample('medvault_upload_bytes_total') == before + 1234
+
+
+def test_metrics_token(client, monkeypatch):
+    from app import app
+    monkeypatch.setitem(app.config, 'METRICS_TOKEN', 'scrape-me')
+    assert client.get('/metrics').status_code == 403
+    assert client.get('/metrics', headers={'Authorization': 'Bearer scrape-me'}).status_code == 200
+
+
+def test_workers_are_summed_in_multiprocess_mode(tmp_path):
+    env = dict(os.environ,
+               PROMETHEUS_MULTIPROC_DIR=str(tmp_path / 'metrics'),
+               MEDVAULT_DATABASE_URI='sqlite:///' + str(tmp_path / 'medvault.db'),
+               MEDVAULT_OUTBOX_WORKERS='0')
+    os.makedirs(env['PROMETHEUS_MULTIPROC_DIR'])
+
+    def run(script):
+        return subprocess.run([sys.executable, '-c', script], env=env, cwd=os.path.dirname(__file__),
+                              capture_output=True, text=True, check=True).stdout
+
+    run(WORKER_SCRIPT.format(requests=2))
+    run(WORKER_SCRIPT.format(requests=3))
+    body = run(SCRAPE_SCRIPT)
+
+    assert 'medvault_requests_total{endpoint="available_slots",method="GET",status="401"} 5.0' in body
+    assert 'medvault_request_duration_seconds_count{endpoint="available_slots",method="GET"} 5.0' in body
@@ -0,0 +1,155 @@
+"""
+Nearest-doctor search and offline geocoding tests
+"""
+
+import math
+import sqlite3
+
+from sqlalchemy import text
+
+from app import db, add_sqlite_math, Doctor, Hospital, bounding_box, nearest_doctors, search_doctors_query
+from conftest import make_user
+from geocode import geocode_address, geocode_hospitals, load_gazetteer
+from migrations import ensure_hospital_locations
+
+GAZETTEER = """name,latitude,longitude,population
+Springfield,39.7817,-89.6501,114000
+Springfield,37.2090,-93.2923,169000
+Chatham,39.6761,-89.7040,14000
+Decatur,39.8403,-88.9548,70000
+Chicago,41.8781,-87.6298,2700000
+"""
+
+# Illinois towns, roughly 13, 60 and 290 km from Springfield IL
+CHATHAM, DECATUR, CHICAGO = (39.6761, -89.7040), (39.8403, -88.9548), (41.8781, -87.6298)
+SPRINGFIELD_IL = (39.7817, -89.6501)
+
+
+def add_hospital(name, position=None, address='1 Main St'):
+    hospital = Hospital(user_id=make_user(f'{name.lower()}@near.test', 'hospital').id, name=name,
+                        address=address, phone='555-0100')
+    if position:
+        hospital.latitude, hospital.longitude = position
+    db.session.add(hospital)
+    db.session.flush()
+    return hospital
+
+
+def add_doctor(name, hospital, specialization='Cardiology'):
+    doctor = Doctor(user_id=make_user(f'{name.lower()}@near.test', 'doctor').id, first_name=name, last_name='Near',
+                    specialization=specialization, hospital_id=hospital.id)
+    db.session.add(doctor)
+    return doctor
+
+
+def nearest(terms=None, radius_km=100, limit=10, point=SPRINGFIELD_IL):
+    return [(doctor.first_name, round(km)) for doctor, km in
+            nearest_doctors(search_doctors_query(terms=terms, ranked=False), *point, radius_km, limit)]
+
+
+def test_nearest_within_radius_sorted_by_distance(app):
+    add_doctor('Decatur', add_hospital('DecaturMemorial', DECATUR))
+    add_doctor('Chicago', add_hospital('Northwestern', CHICAGO))
+    chatham = add_hospital('ChathamClinic', CHATHAM)
+    add_doctor('Chatham', chatham)
+    add_doctor('Skin', chatham, specialization='Dermatology')
+    add_doctor('Nowhere', add_hospital('Unmapped'))
+    db.session.commit()
+
+    assert nearest('cardio') == [('Chatham', 13), ('Decatur', 60)]
+    assert nearest('cardio', limit=1) == [('Chatham', 13)]
+    assert nearest('cardio', radius_km=500) == [('Chatham', 13), ('Decatur', 60), ('Chicago', 288)]
+    assert nearest('derm', radius_km=5) == []
+
+
+def test_location_index_follows_hospital_writes(app):
+    hospital = add_hospital('Moving', CHICAGO)
+    add_doctor('Mover', hospital)
+    db.session.commit()
+    assert nearest() == []
+
+    hospital.latitude, hospital.longitude = CHATHAM
+    db.session.commit()
+    assert nearest() == [('Mover', 13)]
+
+    with db.engine.begin() as conn:
+        conn.execute(text('DELETE FROM hospital_location'))
+    assert nearest() == []
+    assert ensure_hospital_locations(db)
+    assert nearest() == [('Mover', 13)]
+
+
+def test_new_address_drops_old_coordinates(app):
+    hospital = add_hospital('Relocated', CHATHAM, address='1 Main St, Chatham, IL')
+    add_doctor('Relocator', hospital)
+    db.session.commit()
+    assert nearest() == [('Relocator', 13)]
+
+    hospital.address = '1 Main St, Chicago, IL'
+    db.session.commit()
+    assert (hospital.latitude, hospital.longitude) == (None, None)
+    assert nearest(radius_km=500) == []
+
+    # Coordinates given along with the address are kept
+    hospital.address, (hospital.latitude, hospital.longitude) = '2 Main St, Chatham, IL', CHATHAM
+    db.session.commit()
+    assert nearest() == [('Relocator', 13)]
+
+
+def test_python_math_functions_match_sqlite():
+    conn = sqlite3.connect(':memory:')
+    add_sqlite_math(conn)
+    row = conn.execute('SELECT acos(-1), cos(0), radians(180), sin(0), acos(2), sin(NULL)').fetchone()
+    assert row == (math.pi, 1.0, math.pi, 0.0, None, None)
+
+
+def test_bounding_box_covers_the_radius():
+    box = bounding_box(60.0, 10.0, 100)
+    # 100 km east at 60N is about 1.8 degrees of longitude
+    assert box['east'] - 10.0 > 100 / (111.32 * math.cos(math.radians(60)))
+    assert bounding_box(0.0, 179.9, 50)['west'] == -180.0
+    assert bounding_box(89.9, 0.0, 50)['north'] == 90.0
+
+
+def test_geocoder_matches_towns_from_the_end_of_the_address(tmp_path):
+    path = tmp_path / 'places.csv'
+    path.write_text(GAZETTEER)
+    places = load_gazetteer(str(path))
+
+    # Ambiguous names go to the bigger place
+    assert geocode_address('12 Oak Ave, Springfield', places) == (37.2090, -93.2923)
+    assert geocode_address('800 E Carpenter St, Decatur, IL 62521', places) == (39.8403, -88.9548)
+    assert geocode_address('1 Chatham Road, Chicago IL 60601', places) == CHICAGO
+    assert geocode_address('Somewhere else', places) is None
+
+
+def test_geonames_dump_is_supported(tmp_path):
+    path = tmp_path / 'cities.txt'
+    path.write_text('\t'.join(['4250542', 'Springfield', 'Springfield', 'Springfild,SPI', '39.80172', '-89.64371',
+                               'P', 'PPLA', 'US', '', 'IL', '167', '', '', '116565', '', '180', 'America/Chicago',
+                               '2017-05-23']) + '\n')
+    places = load_gazetteer(str(path))
+    assert places['spi'][:2] == (39.80172, -89.64371)
+
+
+def test_geocode_hospitals_feeds_nearest_search(app, tmp_path):
+    path = tmp_path / 'places.csv'
+    path.write_text(GAZETTEER)
+    add_doctor('Geo', add_hospital('GeoClinic', address='4 Main St, Chatham, IL'))
+    add_hospital('Lost', address='Unknown Road')
+    db.session.commit()
+
+    updated, unmatched = geocode_hospitals(db, Hospital, load_gazetteer(str(path)))
+    assert (updated, unmatched) == (1, ['Unknown Road'])
+    assert nearest() == [('Geo', 13)]
+
+
+def test_search_page_near_me(client, sample_data):
+    hospital = sample_data['hospital']
+    hospital.latitude, hospital.longitude = CHATHAM
+    db.session.commit()
+
+    page = client.get('/search_doctors?specialization=cardio&lat=39.7817&lon=-89.6501').get_data(as_text=True)
+    assert 'Doc0' in page and '12.6 km away' in page
+    page = client.get('/search_doctors?lat=0&lon=0&radius=5').get_data(as_text=True)
+    assert 'No Doctors Found' in page
@@ -0,0 +1,101 @@
+"""
+Notification feed and unread counter tests
+"""
+
+import re
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from app import db, create_notification, notification_feed, unread_notification_count, Notification, User
+from conftest import login_as
+from migrations import ensure_unread_counts
+
+
+def unread_in_table(user_id):
+    return Notification.query.filter_by(user_id=user_id, is_read=False).count()
+
+
+def test_booking_commits_once_and_counts_the_notification(client, sample_data):
+    doctor = sample_data['doctors'][0]
+    before = unread_notification_count(doctor.user_id)
+    commits = []
+    listener = lambda session: commits.append(session)
+    event.listen(Session, 'after_commit', listener)
+    try:
+        login_as(client, sample_data['patients'][0].user)
+        client.post('/book_appointment', data={'doctor_id': doctor.id, 'appointment_date': '2030-01-07',
+                                               'appointment_time': '09:00'})
+    finally:
+        event.remove(Session, 'after_commit', listener)
+
+    assert len(commits) == 1
+    assert unread_notification_count(doctor.user_id) == before + 1 == unread_in_table(doctor.user_id)
+
+
+def test_counter_follows_mark_read(client, sample_data):
+    doctor_user = sample_data['doctors'][0].user
+    other_user = sample_data['doctors'][1].user
+    other_unread = unread_notification_count(other_user.id)
+    login_as(client, doctor_user)
+
+    first = Notification.query.filter_by(user_id=doctor_user.id).first()
+    client.post('/notifications/read', data={'notification_id': first.id})
+    client.post('/notifications/read', data={'notification_id': first.id})
+    assert unread_notification_count(doctor_user.id) == 5 == unread_in_table(doctor_user.id)
+
+    # Another user's notification ids are ignored
+    theirs = Notification.query.filter_by(user_id=other_user.id).first()
+    client.post('/notifications/read', data={'notification_id': theirs.id})
+    assert unread_notification_count(other_user.id) == other_unread
+
+    client.post('/notifications/read')
+    assert unread_notification_count(doctor_user.id) == 0 == unread_in_table(doctor_user.id)
+
+    db.session.delete(theirs)
+    db.session.commit()
+    assert unread_notification_count(other_user.id) == other_unread - 1
+
+
+def test_dashboard_feed_is_capped(client, sample_data):
+    doctor_user = sample_data['doctors'][0].user
+    for i in range(30):
+        create_notification(doctor_user.id, f'Alert {i}', 'Something happened')
+    db.session.commit()
+
+    unread, notifications = notification_feed(doctor_user.id)
+    assert unread == 36 and len(notifications) == 10
+
+    login_as(client, doctor_user)
+    page = client.get('/doctor/dashboard').get_data(as_text=True)
+    assert 'View all 36 unread' in page
+
+
+def test_notifications_page_is_paginated(client, sample_data):
+    doctor_user = sample_data['doctors'][0].user
+    login_as(client, doctor_user)
+    client.post('/notifications/read', data={'notification_id': Notification.query.filter_by(
+        user_id=doctor_user.id).first().id})
+
+    seen, cursor = [], None
+    while True:
+        response = client.get('/notifications', query_string={'limit': 4, 'cursor': cursor, 'unread': 1})
+        page = response.get_data(as_text=True)
+        seen += re.findall(r'name="notification_id" value="(\d+)"', page)
+        match = re.search(r'cursor=([\w-]+)', page)
+        if not match:
+            break
+        cursor = match.group(1)
+    assert len(seen) == len(set(seen)) == 5
+
+    page = client.get('/notifications').get_data(as_text=True)
+    assert page.count('<h5') == 6 and '5 unread' in page
+
+
+def test_migration_recounts_drifted_counters(app, sample_data):
+    doctor_user = sample_data['doctors'][0].user
+    db.session.execute(db.update(User).values(unread_notifications=0))
+    db.session.commit()
+    assert ensure_unread_counts(db)
+    assert unread_notification_count(doctor_user.id) == 6
+    assert not ensure_unread_counts(db)
@@ -0,0 +1,230 @@
+"""
+One-time code store tests; the Redis backend runs against a local stand-in
+"""
+
+import socketserver
+import threading
+import time
+
+import pytest
+
+from app import db, OTPCode
+from migrations import drop_legacy_otp
+from otpstore import MemoryOTPStore, RedisOTPStore, SQLOTPStore
+
+
+class RedisStandIn(socketserver.ThreadingTCPServer):
+    """Just enough of the Redis protocol for RedisOTPStore, with key expiry"""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), RedisHandler)
+        self.hashes = {}
+        self.deadlines = {}
+        self.lock = threading.Lock()
+
+    def live(self, key):
+        if key in self.deadlines and self.deadlines[key] <= time.monotonic():
+            self.hashes.pop(key, None)
+            del self.deadlines[key]
+        return self.hashes.get(key)
+
+    def execute(self, name, args):
+        if name in ('PING', 'AUTH', 'SELECT'):
+            return 'OK'
+        key = args[0]
+        fields = self.live(key)
+        if name == 'HSET':
+            fields = self.hashes.setdefault(key, {})
+            pairs = dict(zip(args[1::2], args[2::2]))
+            fields.update(pairs)
+            return len(pairs)
+        if name == 'HGET':
+            return (fields or {}).get(args[1])
+        if name == 'HINCRBY':
+            fields = self.hashes.setdefault(key, {})
+            fields[args[1]] = str(int(fields.get(args[1], b'0')) + int(args[2])).encode()
+            return int(fields[args[1]])
+        if name == 'PEXPIRE':
+            if fields is None:
+                return 0
+            self.deadlines[key] = time.monotonic() + int(args[1]) / 1000
+            return 1
+        if name == 'DEL':
+            self.deadlines.pop(key, None)
+            return int(self.hashes.pop(key, None) is not None)
+        raise ValueError(f'unknown command {name}')
+
+
+class RedisHandler(socketserver.StreamRequestHandler):
+    def read_command(self):
+        header = self.rfile.readline()
+        if not header:
+            return None
+        args = []
+        for _ in range(int(header[1:])):
+            length = int(self.rfile.readline()[1:])
+            args.append(self.rfile.read(length + 2)[:-2])
+        return args[0].decode().upper(), args[1:]
+
+    def reply(self, value):
+        if isinstance(value, int):
+            self.wfile.write(b':%d\r\n' % value)
+        elif isinstance(value, str):
+            self.wfile.write(b'+%s\r\n' % value.encode())
+        elif isinstance(value, list):
+            self.wfile.write(b'*%d\r\n' % len(value))
+            for item in value:
+                self.reply(item)
+        elif value is None:
+            self.wfile.write(b'$-1\r\n')
+        else:
+            self.wfile.write(b'$%d\r\n%s\r\n' % (len(value), value))
+
+    def handle(self):
+        queued = None
+        while (command := self.read_command()) is not None:
+            name, args = command
+            if name == 'MULTI':
+                queued = []
+                self.reply('OK')
+            elif queued is not None and name != 'EXEC':
+                queued.append((name, args))
+                self.reply('QUEUED')
+            else:
+                with self.server.lock:
+                    if name == 'EXEC':
+                        results = [self.server.execute(*queued_command) for queued_command in queued]
+                        queued = None
+                        self.reply(results)
+                    else:
+                        self.reply(self.server.execute(name, args))
+
+
+@pytest.fixture
+def redis_server():
+    server = RedisStandIn()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(params=['memory', 'sql', 'redis'])
+def store(request, app):
+    if request.param == 'memory':
+        yield MemoryOTPStore('secret', max_attempts=3)
+    elif request.param == 'sql':
+        yield SQLOTPStore(app, db, OTPCode, 'secret', max_attempts=3)
+    else:
+        server = request.getfixturevalue('redis_server')
+        host, port = server.server_address
+        store = RedisOTPStore(f'redis://:pw@{host}:{port}/2', 'secret', max_attempts=3)
+        yield store
+        store.close()
+
+
+def test_a_code_is_consumed_by_its_first_successful_check(store):
+    store.issue(7, 'login', '123456', 600)
+    assert not store.verify(7, 'registration', '123456')
+    assert not store.verify(8, 'login', '123456')
+    assert store.verify(7, 'login', '123456')
+    assert not store.verify(7, 'login', '123456')
+
+
+def test_a_new_code_replaces_the_old_one(store):
+    store.issue(7, 'login', '111111', 600)
+    store.issue(7, 'login', '222222', 600)
+    assert not store.verify(7, 'login', '111111')
+    assert store.verify(7, 'login', '222222')
+
+
+def test_wrong_guesses_burn_the_code(store):
+    store.issue(7, 'login', '123456', 600)
+    assert not store.verify(7, 'login', '000000')
+    assert not store.verify(7, 'login', '000001')
+    assert store.verify(7, 'login', '123456')
+
+    store.issue(7, 'login', '123456', 600)
+    for guess in ('000000', '000001', '000002'):
+        assert not store.verify(7, 'login', guess)
+    assert not store.verify(7, 'login', '123456')
+
+
+def test_expired_codes_fail_and_are_swept(store):
+    store.issue(7, 'login', '123456', 0)
+    store.issue(8, 'login', '654321', 600)
+    assert not store.verify(7, 'login', '123456')
+    if not isinstance(store, RedisOTPStore):
+        assert store.sweep() == 1
+    assert store.verify(8, 'login', '654321')
+
+
+def test_sql_store_keeps_one_row_per_user_and_purpose(app):
+    store = SQLOTPStore(app, db, OTPCode, 'secret')
+    for _ in range(3):
+        store.issue(7, 'login', '123456', 600)
+    store.issue(7, 'registration', '123456', 600)
+    assert OTPCode.query.count() == 2
+    assert '123456' not in {row.code_hash for row in OTPCode.query}
+
+    store.verify(7, 'login', '123456')
+    assert [row.purpose for row in OTPCode.query] == ['registration']
+
+
+def test_racing_checks_consume_a_code_once(app):
+    store = SQLOTPStore(app, db, OTPCode, 'secret', max_attempts=10)
+    store.issue(7, 'login', '123456', 600)
+    results = []
+
+    def check():
+        with app.app_context():
+            results.append(store.verify(7, 'login', '123456'))
+
+    threads = [threading.Thread(target=check) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(results) == [False] * 7 + [True]
+
+
+def test_sweeper_thread_drops_expired_codes():
+    store = MemoryOTPStore('secret')
+    store.issue(7, 'login', '123456', 0.05)
+    store.start_sweeper(0.02)
+    try:
+        deadline = time.monotonic() + 5
+        while store._codes and time.monotonic() < deadline:
+            time.sleep(0.02)
+        assert not store._codes
+    finally:
+        store.stop_sweeper()
+    assert not store.sweeping
+
+
+def test_login_checks_the_emailed_code(client, sample_data):
+    user = sample_data['patients'][0].user
+    client.post('/login', data={'action': 'send_otp', 'email': user.email})
+    with client.session_transaction() as sess:
+        otp_code = sess['demo_otp']
+
+    wrong = '000000' if otp_code != '000000' else '111111'
+    response = client.post('/verify_otp', data={'otp': wrong})
+    assert response.headers['Location'].endswith('/verify_otp')
+    response = client.post('/verify_otp', data={'otp': otp_code})
+    assert response.headers['Location'].endswith('/patient/dashboard')
+    with client.session_transaction() as sess:
+        assert sess['user_id'] == user.id
+    assert OTPCode.query.count() == 0
+
+
+def test_old_otp_table_is_dropped(app):
+    with db.engine.begin() as conn:
+        conn.exec_driver_sql('CREATE TABLE otp (id INTEGER PRIMARY KEY, otp_code VARCHAR(6))')
+        conn.exec_driver_sql("INSERT INTO otp (otp_code) VALUES ('123456'), ('654321')")
+    assert drop_legacy_otp(db) == 2
+    assert drop_legacy_otp(db) == 0
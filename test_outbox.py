@@ -0,0 +1,186 @@
+"""
+Email outbox tests, run against a local SMTP stand-in
+"""
+
+import socket
+import socketserver
+import threading
+import time
+from datetime import datetime
+
+import pytest
+from prometheus_client import REGISTRY
+
+from app import app as flask_app, db, EmailOutbox, enqueue_email
+from conftest import login_as
+from outbox import OutboxSender
+
+
+class SMTPStandIn(socketserver.ThreadingTCPServer):
+    """Just enough SMTP for smtplib: records every message and connection"""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), SMTPHandler)
+        self.messages = []
+        self.connections = 0
+        self.lock = threading.Lock()
+
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self):
+        with self.server.lock:
+            self.server.connections += 1
+        self.reply('220 stand-in ready')
+        recipients = []
+        while True:
+            line = self.rfile.readline().decode().strip()
+            if not line:
+                return
+            command = line[:4].upper()
+            if command in ('EHLO', 'HELO'):
+                self.reply('250 stand-in')
+            elif command == 'MAIL':
+                recipients = []
+                self.reply('250 OK')
+            elif command == 'RCPT':
+                recipients.append(line.split(':', 1)[1].strip('<> '))
+                self.reply('250 OK')
+            elif command == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                data = []
+                while (chunk := self.rfile.readline()) not in (b'.\r\n', b''):
+                    data.append(chunk)
+                with self.server.lock:
+                    self.server.messages.append((recipients, b''.join(data)))
+                self.reply('250 OK queued')
+            elif command == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('250 OK')
+
+
+@pytest.fixture
+def smtp_server(app):
+    server = SMTPStandIn()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    state = app.extensions['mail']
+    saved = (state.server, state.port, state.use_tls, state.use_ssl, state.username, state.suppress)
+    state.server, state.port = server.server_address
+    state.use_tls = state.use_ssl = False
+    state.username = ''
+    state.suppress = False
+    yield server
+    state.server, state.port, state.use_tls, state.use_ssl, state.username, state.suppress = saved
+    server.shutdown()
+    server.server_close()
+
+
+def closed_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def make_sender(**options):
+    options.setdefault('workers', 1)
+    return OutboxSender(flask_app, db, EmailOutbox, flask_app.extensions['mail'], **options)
+
+
+def test_login_queues_otp_without_contacting_smtp(client, sample_data, smtp_server):
+    email = sample_data['patients'][0].user.email
+    response = client.post('/login', data={'action': 'send_otp', 'email': email})
+
+    assert response.status_code == 302
+    queued = EmailOutbox.query.one()
+    assert (queued.recipient, queued.status) == (email, 'pending')
+    assert smtp_server.connections == 0
+
+
+def test_booking_emails_the_doctor_in_the_same_commit(client, sample_data):
+    doctor = sample_data['doctors'][0]
+    login_as(client, sample_data['patients'][0].user)
+    client.post('/book_appointment', data={'doctor_id': doctor.id, 'appointment_date': '2030-01-07',
+                                           'appointment_time': '09:00'})
+    assert EmailOutbox.query.filter_by(recipient=doctor.user.email).count() == 1
+
+
+def test_batch_is_sent_over_one_connection(app, smtp_server):
+    for i in range(10):
+        enqueue_email(f'user{i}@test.com', 'Hello', f'Message {i}')
+    db.session.commit()
+
+    sent_before = REGISTRY.get_sample_value('medvault_email_send_seconds_count', {'outcome': 'sent'}) or 0
+    sender = make_sender(batch_size=25)
+    count, connection = sender.drain()
+    assert count == 10
+    assert REGISTRY.get_sample_value('medvault_email_send_seconds_count', {'outcome': 'sent'}) == sent_before + 10
+
+    # The connection stays open for the next batch
+    enqueue_email('late@test.com', 'Hello', 'Late message')
+    db.session.commit()
+    count, connection = sender.drain(connection)
+    sender._close(connection)
+
+    assert count == 1
+    assert smtp_server.connections == 1
+    assert len(smtp_server.messages) == 11
+    assert EmailOutbox.query.filter_by(status='sent').count() == 11
+
+
+def test_failures_back_off_then_dead_letter(app):
+    state = app.extensions['mail']
+    saved = (state.server, state.port, state.use_tls, state.suppress)
+    state.server, state.port, state.use_tls, state.suppress = '127.0.0.1', closed_port(), False, False
+    try:
+        enqueue_email('user@test.com', 'Hello', 'Body')
+        db.session.commit()
+        sender = make_sender(max_attempts=3, retry_base_seconds=60)
+
+        sender.drain()
+        queued = EmailOutbox.query.one()
+        assert (queued.status, queued.attempts) == ('pending', 1)
+        assert queued.next_attempt_at > datetime.utcnow()
+        assert 'ConnectionRefused' in queued.last_error
+
+        # Not due yet: nothing is claimed
+        assert sender.drain()[0] == 0
+
+        for _ in range(2):
+            queued.next_attempt_at = datetime.utcnow()
+            db.session.commit()
+            sender.drain()
+        assert (queued.status, queued.attempts) == ('dead', 3)
+    finally:
+        state.server, state.port, state.use_tls, state.suppress = saved
+
+
+def test_background_pool_delivers_each_message_once(app, smtp_server):
+    for i in range(40):
+        enqueue_email(f'user{i}@test.com', 'Hello', f'Message {i}')
+    db.session.commit()
+
+    sender = make_sender(workers=3, batch_size=5, poll_interval=0.05)
+    sender.start()
+    try:
+        deadline = time.monotonic() + 10
+        while len(smtp_server.messages) < 40 and time.monotonic() < deadline:
+            time.sleep(0.05)
+    finally:
+        sender.stop()
+
+    recipients = sorted(r for rcpts, _ in smtp_server.messages for r in rcpts)
+    assert recipients == sorted(f'user{i}@test.com' for i in range(40))
+    db.session.expire_all()
+    assert EmailOutbox.query.filter_by(status='sent').count() == 40
+    assert smtp_server.connections <= 3
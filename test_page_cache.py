@@ -0,0 +1,86 @@
+"""
+Page and fragment cache tests: public pages, popular searches and the
+{% cache %} blocks of the dashboards
+"""
+
+from contextlib import contextmanager
+
+from flask import template_rendered
+
+from app import db, create_notification, MedicalRecord
+from conftest import captured_selects, login_as
+
+
+@contextmanager
+def rendered_templates(app):
+    names = []
+    listener = lambda sender, template, context, **extra: names.append(template.name)
+    template_rendered.connect(listener, app)
+    try:
+        yield names
+    finally:
+        template_rendered.disconnect(listener, app)
+
+
+def test_public_pages_render_once(app, client):
+    with rendered_templates(app) as names:
+        first = client.get('/about').get_data()
+        assert client.get('/about').get_data() == first
+    assert names == ['about.html']
+
+    # A visitor with a message waiting gets it, on a page of their own
+    with client.session_transaction() as sess:
+        sess['_flashes'] = [('success', 'Message sent')]
+    with rendered_templates(app) as names:
+        assert 'Message sent' in client.get('/about').get_data(as_text=True)
+    assert names == ['about.html']
+    assert 'Message sent' not in client.get('/about').get_data(as_text=True)
+
+
+def test_searches_are_kept_once_popular(app, client, sample_data):
+    with rendered_templates(app) as names:
+        for _ in range(3):
+            assert 'Doc0' in client.get('/search_doctors?specialization=cardiology').get_data(as_text=True)
+        client.get('/search_doctors?specialization=neurology')
+    assert len(names) == 3  # twice before it was kept, once for the other search
+
+    # A profile change moves the directory version and so the key
+    login_as(client, sample_data['doctors'][0].user)
+    client.post('/complete_doctor_profile', data={
+        'first_name': 'Renamed', 'last_name': 'Test', 'specialization': 'Cardiology',
+        'hospital_id': str(sample_data['hospital'].id), 'consultation_fee': '120'})
+    page = client.get('/search_doctors?specialization=cardiology').get_data(as_text=True)
+    assert 'Renamed' in page and 'Doc0' not in page
+
+
+def test_dashboard_fragments_skip_their_queries(client, sample_data):
+    login_as(client, sample_data['doctors'][0].user)
+    first = client.get('/doctor/dashboard').get_data(as_text=True)
+    with captured_selects() as statements:
+        assert client.get('/doctor/dashboard').get_data(as_text=True) == first
+    assert len(statements) == 1  # the profile and its versions
+
+
+def test_dashboard_fragments_follow_the_users_data(client, sample_data):
+    doctor, patient = sample_data['doctors'][0], sample_data['patients'][0]
+    login_as(client, doctor.user)
+    client.get('/doctor/dashboard')
+
+    create_notification(doctor.user_id, 'Lab results', 'Results are in')
+    db.session.commit()
+    assert 'Lab results' in client.get('/doctor/dashboard').get_data(as_text=True)
+
+    login_as(client, patient.user)
+    assert 'Blood Test' not in client.get('/patient/dashboard').get_data(as_text=True)
+    record = MedicalRecord.query.filter_by(patient_id=patient.id).first()
+    record.title = 'Blood Test'
+    db.session.commit()
+    assert 'Blood Test' in client.get('/patient/dashboard').get_data(as_text=True)
+
+    # Someone else's change leaves the cached fragments alone
+    other = MedicalRecord.query.filter(MedicalRecord.patient_id != patient.id).first()
+    other.title = 'Not yours'
+    db.session.commit()
+    with captured_selects() as statements:
+        client.get('/patient/dashboard')
+    assert len(statements) == 1
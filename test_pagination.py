@@ -0,0 +1,99 @@
+"""
+Keyset pagination tests
+"""
+
+import html
+import re
+from datetime import date, datetime, time
+
+import app as app_module
+from app import db, Appointment, MedicalRecord, decode_cursor, encode_cursor, keyset_page, share_records
+from conftest import login_as
+from test_query_plans import assert_indexed
+
+LOAD_MORE = re.compile(r'<a href="([^"]*cursor=[^"]*)"')
+
+
+def walk(client, path, marker):
+    """Follow "Load more" links from `path`; returns the item count of each page"""
+    pages = []
+    while path:
+        page = client.get(path).get_data(as_text=True)
+        pages.append(page.count(marker))
+        match = LOAD_MORE.search(page)
+        path = html.unescape(match.group(1)) if match else None
+    return pages
+
+
+def test_cursor_round_trip():
+    cursor = encode_cursor(date(2030, 1, 7), 42)
+    assert decode_cursor(cursor, date, int) == (date(2030, 1, 7), 42)
+    assert decode_cursor('not-a-cursor', date, int) is None
+    assert decode_cursor(encode_cursor(1, 2, 3), date, int) is None
+
+
+def test_pages_are_stable_across_ties(sample_data):
+    patient, doctor = sample_data['patients'][0], sample_data['doctors'][0]
+    # Many appointments on the same day, so the id tie-breaker matters
+    for hour in range(8, 18):
+        db.session.add(Appointment(patient_id=patient.id, doctor_id=doctor.id, appointment_date=date(2030, 1, 7),
+                                   appointment_time=time(hour, 0)))
+    db.session.commit()
+
+    query = Appointment.query.filter_by(patient_id=patient.id)
+    expected = [a.id for a in query.order_by(Appointment.appointment_date.desc(), Appointment.id.desc())]
+
+    seen, cursor = [], None
+    while True:
+        rows, cursor = keyset_page(query, Appointment.appointment_date, Appointment.id, cursor, limit=3)
+        seen.extend(row.id for row in rows)
+        if cursor is None:
+            break
+    assert seen == expected
+
+
+def test_appointments_page_through_every_row(client, sample_data):
+    hospital = sample_data['hospital']
+    login_as(client, hospital.user)
+    pages = walk(client, '/appointments?limit=5', 'class="appointment-item"')
+    assert pages == [5, 5, 2]
+
+
+def test_limit_is_clamped_and_bad_cursor_ignored(client, sample_data, monkeypatch):
+    patient = sample_data['patients'][0]
+    for day in range(1, 29):
+        db.session.add(MedicalRecord(patient_id=patient.id, record_type='other', title=f'Bulk {day}',
+                                     record_date=date(2029, 2, day), uploaded_by=patient.user_id))
+    db.session.commit()
+    login_as(client, patient.user)
+    monkeypatch.setattr(app_module, 'PAGE_SIZE_MAX', 10)
+
+    page = client.get('/records?limit=1000').get_data(as_text=True)
+    assert page.count('class="record-card"') == 10
+
+    page = client.get('/records?limit=1000&cursor=garbage').get_data(as_text=True)
+    assert page.count('class="record-card"') == 10
+
+
+def test_shared_records_page_by_share_time(client, sample_data):
+    doctor = sample_data['doctors'][0]
+    share_records([r.id for r in MedicalRecord.query], [doctor.id])
+    db.session.commit()
+
+    login_as(client, doctor.user)
+    assert walk(client, '/records?limit=5', 'class="record-card"') == [5, 5, 2]
+
+
+def test_patient_rosters_page_by_patient(client, sample_data):
+    login_as(client, sample_data['hospital'].user)
+    assert sum(walk(client, '/hospital/patients?limit=2', 'class="patient-card"')) == 3
+
+    login_as(client, sample_data['doctors'][0].user)
+    assert sum(walk(client, '/doctor/patients?limit=1', 'class="patient-card"')) == 3
+
+
+def test_later_pages_seek_with_an_index(client, sample_data):
+    login_as(client, sample_data['patients'][0].user)
+    cursor = encode_cursor(date.today(), 10**6)
+    assert_indexed(client, f'/appointments?limit=2&cursor={cursor}')
+    assert_indexed(client, f'/records?limit=2&cursor={encode_cursor(datetime.utcnow(), 10**6)}')
@@ -0,0 +1,130 @@
+"""
+Record preview tests
+"""
+
+import io
+import os
+import shutil
+
+import pytest
+from PIL import Image
+
+import app as app_module
+from app import app as flask_app, MedicalRecord, PREVIEW_SIZES, preview_targets
+from blobstore import BlobStore
+from conftest import login_as
+from previews import PreviewPool, render_previews
+
+
+@pytest.fixture
+def pool(app, tmp_path, monkeypatch):
+    monkeypatch.setitem(flask_app.config, 'UPLOAD_FOLDER', str(tmp_path))
+    pool = PreviewPool(workers=1, max_pending=5)
+    monkeypatch.setattr(app_module, 'preview_pool', pool)
+    yield pool
+    pool.shutdown()
+
+
+def png(width, height, color='red'):
+    buffer = io.BytesIO()
+    Image.new('RGBA', (width, height), color).save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+def upload(client, content, filename):
+    client.post('/upload_record', data={'title': filename, 'record_type': 'scan',
+                                        'file': (io.BytesIO(content), filename)})
+    record = MedicalRecord.query.filter_by(title=filename).one()
+    return record, BlobStore.digest_of(record.file_path)
+
+
+def test_upload_queues_previews_outside_the_request(client, sample_data, pool):
+    login_as(client, sample_data['patients'][0].user)
+    record, digest = upload(client, png(2000, 1000), 'xray.png')
+    pool.shutdown()  # Waits for the queued job
+
+    response = client.get(f'/record_preview/{record.id}/small')
+    assert response.status_code == 200
+    assert response.mimetype == 'image/jpeg'
+    assert 'immutable' in response.headers['Cache-Control'] and 'private' in response.headers['Cache-Control']
+    assert 'public' not in response.headers['Cache-Control']
+    assert Image.open(io.BytesIO(response.data)).size == (320, 160)
+
+    targets, _ = preview_targets(digest)
+    assert Image.open(targets[PREVIEW_SIZES['large']]).size == (1280, 640)
+    assert client.get(f'/record_preview/{record.id}/huge').status_code == 404
+
+    # Not to another patient, though the preview exists
+    login_as(client, sample_data['patients'][1].user)
+    assert client.get(f'/record_preview/{record.id}/small').status_code == 404
+
+
+def test_missing_previews_are_queued_when_viewed(client, sample_data, pool, monkeypatch):
+    monkeypatch.setattr(pool, 'workers', 0)  # Upload job dropped, as when the pool is full
+    login_as(client, sample_data['patients'][0].user)
+    record, _ = upload(client, png(100, 100), 'mole.png')
+    assert client.get(f'/record_preview/{record.id}/medium').status_code == 404
+
+    monkeypatch.setattr(pool, 'workers', 1)
+    assert client.get(f'/record_preview/{record.id}/medium').status_code == 404
+    pool.shutdown()
+    assert client.get(f'/record_preview/{record.id}/medium').status_code == 200
+
+
+def test_pool_is_capped_and_deduplicated(tmp_path):
+    pool = PreviewPool(workers=1, max_pending=1)
+    try:
+        source = tmp_path / 'image.png'
+        source.write_bytes(png(50, 50))
+        targets = {32: str(tmp_path / 'image-32.jpg')}
+        future = pool.submit(str(source), targets, str(tmp_path / 'none'))
+        assert future is not None
+        assert pool.submit(str(source), targets, str(tmp_path / 'none')) is None
+        assert pool.submit(str(tmp_path / 'other.png'), targets, str(tmp_path / 'none')) is None
+        assert future.result(timeout=60) == [32]
+    finally:
+        pool.shutdown()
+    assert PreviewPool(workers=0).submit(str(source), targets, str(tmp_path / 'none')) is None
+
+
+def test_unsupported_files_are_marked_once(tmp_path):
+    source = tmp_path / 'notes.bin'
+    source.write_bytes(b'\x00\x01 not an image')
+    marker = tmp_path / 'notes.preview-none'
+    assert render_previews(str(source), {320: str(tmp_path / 'notes-320.jpg')}, str(marker)) == []
+    assert marker.exists() and not (tmp_path / 'notes-320.jpg').exists()
+
+
+def test_broken_images_are_marked_too(tmp_path, monkeypatch):
+    truncated = tmp_path / 'cut.png'
+    truncated.write_bytes(png(400, 300)[:-200])
+    marker = tmp_path / 'cut.preview-none'
+    assert render_previews(str(truncated), {320: str(tmp_path / 'cut-320.jpg')}, str(marker)) == []
+    assert marker.exists()
+
+    monkeypatch.setattr(Image, 'MAX_IMAGE_PIXELS', 1000)  # twice this raises DecompressionBombError
+    bomb = tmp_path / 'bomb.png'
+    bomb.write_bytes(png(100, 100))
+    marker = tmp_path / 'bomb.preview-none'
+    assert render_previews(str(bomb), {320: str(tmp_path / 'bomb-320.jpg')}, str(marker)) == []
+    assert marker.exists()
+
+
+@pytest.mark.skipif(shutil.which('pdftoppm') is None, reason='needs poppler-utils')
+def test_pdf_first_page(tmp_path):
+    source = tmp_path / 'report.pdf'
+    Image.new('RGB', (600, 800), 'white').save(source, 'PDF')
+    targets = {320: str(tmp_path / 'report-320.jpg')}
+    assert render_previews(str(source), targets, str(tmp_path / 'none')) == [320]
+    assert Image.open(targets[320]).size == (240, 320)
+
+
+def test_collected_blobs_take_their_previews_along(app, tmp_path):
+    store = BlobStore(str(tmp_path))
+    digest, _, _ = store.store(io.BytesIO(png(40, 40)))
+    targets = {32: store.preview_path(digest, 32)}
+    render_previews(store.path(digest), targets, store.preview_path(digest, None))
+    assert os.path.exists(targets[32])
+
+    assert store.remove(digest)
+    assert os.listdir(os.path.dirname(targets[32])) == []
@@ -0,0 +1,65 @@
+"""
+Query count tests
+List pages must load related rows up front, so the number of queries a page
+issues stays the same however many rows it shows.
+"""
+
+from datetime import datetime, timedelta, time
+
+import pytest
+
+from app import db, fragment_cache, page_cache, Appointment, Doctor, Patient
+from conftest import captured_selects, login_as, make_user
+
+# Route -> most SELECTs it may issue (profile lookup, lists, notifications, ...)
+ROUTES = {
+    'patient': {'/patient/dashboard': 4, '/appointments': 2, '/book_appointment': 2, '/search_doctors': 1},
+    'doctor': {'/doctor/dashboard': 3, '/appointments': 2, '/doctor/patients': 3},
+    'hospital': {'/hospital/dashboard': 4, '/appointments': 2, '/hospital/patients': 3},
+}
+
+
+def add_history(sample_data, count):
+    """Appointments with fresh doctors and patients, so nothing is in the identity map"""
+    hospital, patient = sample_data['hospital'], sample_data['patients'][0]
+    today = datetime.utcnow().date()
+    for i in range(count):
+        doctor = Doctor(user_id=make_user(f'extra-doctor{i}@test.com', 'doctor').id, first_name=f'Extra{i}',
+                        last_name='Doctor', specialization='General', hospital_id=hospital.id)
+        other = Patient(user_id=make_user(f'extra-patient{i}@test.com', 'patient').id, first_name=f'Extra{i}',
+                        last_name='Patient')
+        db.session.add_all([doctor, other])
+        db.session.flush()
+        for patient_id, doctor_id in [(patient.id, doctor.id), (other.id, sample_data['doctors'][0].id)]:
+            db.session.add(Appointment(patient_id=patient_id, doctor_id=doctor_id, hospital_id=hospital.id,
+                                       appointment_date=today, appointment_time=time(8, i), status='pending'))
+    db.session.commit()
+
+
+def count_selects(client, path):
+    client.get(path)  # warm the per-process caches (session security state)
+    # ...but count a full render, not a cached page or fragments
+    page_cache.clear()
+    fragment_cache.clear()
+    db.session.expunge_all()
+    with captured_selects() as statements:
+        response = client.get(path)
+    assert response.status_code == 200
+    return len(statements)
+
+
+@pytest.mark.parametrize('role,path', [(role, path) for role, paths in ROUTES.items() for path in paths])
+def test_query_count_does_not_grow_with_rows(client, sample_data, role, path):
+    users = {
+        'patient': sample_data['patients'][0].user,
+        'doctor': sample_data['doctors'][0].user,
+        'hospital': sample_data['hospital'].user,
+    }
+    login_as(client, users[role])
+
+    before = count_selects(client, path)
+    add_history(sample_data, 15)
+    after = count_selects(client, path)
+
+    assert after == before
+    assert after <= ROUTES[role][path]
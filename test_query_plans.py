@@ -0,0 +1,81 @@
+"""
+Query plan regression tests
+Runs every SELECT a route issues through EXPLAIN QUERY PLAN and fails if
+SQLite would answer it with a full table scan instead of an index.
+"""
+
+import re
+
+import pytest
+
+from app import db, directory_cache
+from conftest import captured_selects, login_as
+
+# "SCAN appointment" is a full table scan; "SCAN appointment USING INDEX ..."
+# and "SEARCH appointment USING ..." are index driven.
+FULL_SCAN = re.compile(r'^SCAN (\w+)$')
+
+
+def full_scans(statements):
+    scans = []
+    with db.engine.connect() as conn:
+        for statement, parameters in statements:
+            plan = conn.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters).fetchall()
+            for row in plan:
+                if FULL_SCAN.match(row[-1]):
+                    scans.append(f'{row[-1]}: {statement}')
+    return scans
+
+
+def assert_indexed(client, path, method='GET', data=None):
+    with captured_selects() as statements:
+        response = client.open(path, method=method, data=data)
+    assert response.status_code in (200, 302)
+    assert statements, f'{path} issued no queries'
+    scans = full_scans(statements)
+    assert not scans, '\n'.join(scans)
+
+
+ROUTES = {
+    'patient': ['/patient/dashboard', '/appointments', '/records', '/book_appointment',
+                '/search_doctors?specialization=cardio', '/search_doctors?location=city&max_fee=200',
+                '/search_doctors?specialization=cardio&lat=39.78&lon=-89.65', '/api/slots?doctor_id=1&doctor_id=2',
+                '/api/v1/appointments', '/api/v1/records', '/api/v1/doctors/1/availability'],
+    'doctor': ['/doctor/dashboard', '/appointments', '/doctor/patients', '/records', '/notifications',
+               '/notifications?unread=1', '/api/v1/appointments?status=pending', '/api/v1/records',
+               '/api/v1/notifications?unread=1'],
+    'hospital': ['/hospital/dashboard', '/appointments', '/hospital/patients', '/api/v1/appointments'],
+}
+
+
+@pytest.mark.parametrize('role,path', [(role, path) for role, paths in ROUTES.items() for path in paths])
+def test_route_queries_use_indexes(client, sample_data, role, path):
+    users = {
+        'patient': sample_data['patients'][0].user,
+        'doctor': sample_data['doctors'][0].user,
+        'hospital': sample_data['hospital'].user,
+    }
+    login_as(client, users[role])
+    # The doctor directory is read whole on purpose, once per change
+    directory_cache.get()
+    assert_indexed(client, path)
+
+
+def test_login_otp_lookup_uses_index(client, sample_data):
+    email = sample_data['patients'][0].user.email
+    assert_indexed(client, '/login', 'POST', {'action': 'send_otp', 'email': email})
+
+    with client.session_transaction() as sess:
+        otp_code = sess['demo_otp']
+    assert_indexed(client, '/verify_otp', 'POST', {'otp': otp_code})
+
+
+def test_registration_otp_lookup_uses_index(client, app):
+    assert_indexed(client, '/register', 'POST', {
+        'action': 'send_otp', 'email': 'new@test.com', 'user_type': 'patient',
+        'password': 'password123', 'confirm_password': 'password123',
+    })
+
+    with client.session_transaction() as sess:
+        otp_code = sess['demo_otp']
+    assert_indexed(client, '/verify_otp', 'POST', {'otp': otp_code})
@@ -0,0 +1,109 @@
+"""
+Record sharing tests
+"""
+
+from datetime import datetime, timedelta
+
+from sqlalchemy import text
+
+from app import db, MedicalRecord, RecordShare, share_records, unshare_records, records_shared_with
+from conftest import login_as
+from migrations import migrate_shared_with
+
+
+def patient_record_ids(patient):
+    return [r.id for r in MedicalRecord.query.filter_by(patient_id=patient.id).order_by(MedicalRecord.id)]
+
+
+def test_share_and_unshare_in_bulk(sample_data):
+    doctor_a, doctor_b = sample_data['doctors']
+    record_ids = patient_record_ids(sample_data['patients'][0])
+
+    assert share_records(record_ids, [doctor_a.id, doctor_b.id]) == 2 * len(record_ids)
+    db.session.commit()
+    assert records_shared_with(doctor_a.id).count() == len(record_ids)
+    assert all(r.is_shared for r in MedicalRecord.query.filter(MedicalRecord.id.in_(record_ids)))
+
+    # Sharing again renews rather than duplicates
+    share_records(record_ids, [doctor_a.id])
+    db.session.commit()
+    assert RecordShare.query.count() == 2 * len(record_ids)
+
+    unshare_records(record_ids[:1], [doctor_a.id])
+    db.session.commit()
+    assert records_shared_with(doctor_a.id).count() == len(record_ids) - 1
+    assert db.session.get(MedicalRecord, record_ids[0]).is_shared  # still shared with doctor_b
+
+    unshare_records(record_ids[:1])
+    db.session.commit()
+    assert not db.session.get(MedicalRecord, record_ids[0]).is_shared
+
+
+def test_expired_shares_are_hidden(sample_data):
+    doctor = sample_data['doctors'][0]
+    record_ids = patient_record_ids(sample_data['patients'][0])
+
+    share_records(record_ids[:1], [doctor.id], expires_at=datetime.utcnow() - timedelta(minutes=1))
+    share_records(record_ids[1:], [doctor.id], expires_at=datetime.utcnow() + timedelta(days=1))
+    db.session.commit()
+
+    assert {r.id for r in records_shared_with(doctor.id)} == set(record_ids[1:])
+
+
+def test_share_route_only_shares_own_records(client, sample_data):
+    patient, other = sample_data['patients'][:2]
+    doctor = sample_data['doctors'][0]
+    own, foreign = patient_record_ids(patient), patient_record_ids(other)
+    login_as(client, patient.user)
+
+    response = client.post('/records/share', json={
+        'record_ids': own + foreign, 'doctor_ids': [doctor.id], 'expires_in_days': 7,
+    })
+    assert response.get_json()['records'] == own
+    assert {r.id for r in records_shared_with(doctor.id)} == set(own)
+
+    client.post('/records/share', data={'action': 'unshare', 'record_ids': own})
+    assert records_shared_with(doctor.id).count() == 0
+
+
+def test_share_route_rejects_malformed_requests(client, sample_data):
+    patient, doctor = sample_data['patients'][0], sample_data['doctors'][0]
+    login_as(client, patient.user)
+    record_ids = patient_record_ids(patient)
+
+    for body in ([], 'x', {'action': 'delete', 'record_ids': record_ids, 'doctor_ids': [doctor.id]},
+                 {'record_ids': 'abc', 'doctor_ids': [doctor.id]}, {'record_ids': [1], 'expires_in_days': 'soon'}):
+        response = client.post('/records/share', json=body)
+        assert response.status_code == 400 and response.get_json()['error']
+    assert RecordShare.query.count() == 0
+
+    response = client.post('/records/share', data={'action': 'delete', 'record_ids': record_ids})
+    assert response.status_code == 302 and RecordShare.query.count() == 0
+
+
+def test_doctor_sees_shared_records(client, sample_data):
+    doctor = sample_data['doctors'][0]
+    record_ids = patient_record_ids(sample_data['patients'][0])
+    share_records(record_ids[:1], [doctor.id])
+    db.session.commit()
+
+    login_as(client, doctor.user)
+    html = client.get('/records').get_data(as_text=True)
+    assert db.session.get(MedicalRecord, record_ids[0]).title in html
+
+
+def test_migrates_comma_separated_shared_with(sample_data):
+    doctors = sample_data['doctors']
+    record_ids = patient_record_ids(sample_data['patients'][0])
+    db.session.execute(text('ALTER TABLE medical_record ADD COLUMN shared_with VARCHAR(500)'))
+    db.session.execute(text('UPDATE medical_record SET shared_with = :v WHERE id = :id'),
+                       [{'v': f'{doctors[0].id},{doctors[1].id}', 'id': record_ids[0]},
+                        {'v': f' {doctors[1].id}, 999,abc', 'id': record_ids[1]}])
+    db.session.commit()
+
+    assert migrate_shared_with(db) == 3
+    assert {r.id for r in records_shared_with(doctors[0].id)} == {record_ids[0]}
+    assert {r.id for r in records_shared_with(doctors[1].id)} == set(record_ids[:2])
+
+    # Runs once: the old column is emptied
+    assert migrate_shared_with(db) == 0
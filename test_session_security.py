@@ -0,0 +1,110 @@
+"""
+Session verification tests
+"""
+
+import time
+
+from app import db, bump_security_version, security_stamp, user_security_state, User
+from cache import SharedStamp, TTLCache, MISSING
+from conftest import captured_selects, login_as
+
+
+def count_queries(client, path):
+    with captured_selects(selects_only=False) as statements:
+        client.get(path)
+    return statements
+
+
+def test_authenticated_requests_skip_the_user_lookup(client, sample_data):
+    login_as(client, sample_data['patients'][0].user)
+
+    assert count_queries(client, '/about')  # first request loads the security version
+    assert count_queries(client, '/about') == []
+    assert count_queries(client, '/static/css/styles.css') == []
+
+
+def test_logout_all_ends_other_sessions(app, sample_data):
+    user = sample_data['patients'][0].user
+    phone, laptop = app.test_client(), app.test_client()
+    login_as(phone, user)
+    login_as(laptop, user)
+    assert phone.get('/patient/dashboard').status_code == 200
+    assert laptop.get('/patient/dashboard').status_code == 200
+
+    phone.get('/logout_all')
+
+    response = laptop.get('/patient/dashboard')
+    assert response.status_code == 302 and '/login' in response.location
+
+
+def test_sessions_without_a_version_end_at_the_first_bump(client, sample_data):
+    user = sample_data['patients'][0].user
+    db.session.execute(db.update(User).where(User.id == user.id).values(security_version=2))
+    db.session.commit()
+
+    # A cookie signed before versions existed, replayed after a logout_all
+    login_as(client, user)
+    response = client.get('/patient/dashboard')
+    assert response.status_code == 302 and '/login' in response.location
+
+
+def test_logging_in_again_after_being_unverified(client, sample_data):
+    user = sample_data['patients'][0].user
+    login_as(client, user)
+    bump_security_version(user, unverify=True)
+    assert client.get('/patient/dashboard').status_code == 302  # caches the unverified state
+
+    client.post('/login', data={'action': 'send_otp', 'email': user.email})
+    with client.session_transaction() as sess:
+        otp_code = sess['demo_otp']
+    client.post('/verify_otp', data={'otp': otp_code})
+    assert client.get('/patient/dashboard').status_code == 200
+
+
+def test_version_bumped_by_another_worker_is_noticed(client, sample_data, monkeypatch):
+    user = sample_data['doctors'][0].user
+    login_as(client, user)
+    assert client.get('/doctor/dashboard').status_code == 200
+
+    # Another process unverifies the user and touches the shared stamp file
+    db.session.execute(db.update(User).where(User.id == user.id)
+                       .values(is_verified=False, security_version=User.security_version + 1))
+    db.session.commit()
+    SharedStamp(security_stamp.path).bump()
+    monkeypatch.setattr(security_stamp, '_next_check', 0.0)
+
+    response = client.get('/doctor/dashboard')
+    assert response.status_code == 302 and '/login' in response.location
+
+
+def test_security_state_is_cached(sample_data):
+    user = sample_data['patients'][0].user
+    assert user_security_state(user.id) == (True, 1)
+
+    db.session.execute(db.update(User).where(User.id == user.id).values(security_version=5))
+    db.session.commit()
+    assert user_security_state(user.id) == (True, 1)  # until invalidated
+    assert user_security_state(10 ** 6) is None
+
+
+def test_ttl_cache_expires_entries():
+    cache = TTLCache(ttl=0.05, maxsize=3)
+    cache.set('a', 1)
+    assert cache.get('a') == 1
+    time.sleep(0.06)
+    assert cache.get('a') is MISSING
+
+    for key in 'bcde':
+        cache.set(key, key)
+    assert len(cache) <= 3
+    assert cache.get('e') == 'e'
+
+
+def test_shared_stamp_signals_other_instances(tmp_path):
+    path = str(tmp_path / 'stamp')
+    mine, theirs = SharedStamp(path, check_interval=0), SharedStamp(path, check_interval=0)
+    assert not mine.changed()
+
+    theirs.bump()
+    assert mine.changed()
+    assert not mine.changed()
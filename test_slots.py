@@ -0,0 +1,110 @@
+"""
+Availability slot engine tests
+"""
+
+import time as timer
+from datetime import date, datetime, time, timedelta
+
+import slots
+from app import db, Appointment, DoctorAvailability, find_free_slots
+from conftest import login_as
+
+MONDAY = date(2030, 1, 7)
+
+
+def test_booked_intervals_merge_and_overlap():
+    busy = slots.BookedIntervals()
+    busy.add(600, 630)
+    busy.add(660, 690)
+    busy.add(630, 660)  # bridges the two
+    assert (busy.starts, busy.ends) == ([600], [690])
+
+    busy.add(540, 560)
+    assert len(busy) == 2
+    assert busy.overlaps(550, 580)
+    assert not busy.overlaps(560, 600)  # half-open intervals
+    assert busy.overlaps(689, 700)
+    assert not busy.overlaps(690, 720)
+
+
+def test_free_slots_subtract_bookings_and_respect_weekdays():
+    templates = slots.build_templates({1: {0: [(9 * 60, 11 * 60)], 2: [(14 * 60, 15 * 60)]}})
+    booked = slots.build_booked([(1, MONDAY, time(9, 30)), (1, MONDAY, time(10, 0))])
+
+    free = slots.free_slots(templates, booked, MONDAY, 7)[1]
+    assert free == {
+        '2030-01-07': ['09:00', '10:30'],
+        '2030-01-09': ['14:00', '14:30'],
+    }
+
+
+def test_free_slots_drop_past_times():
+    templates = slots.build_templates({1: slots.DEFAULT_WEEKLY_WINDOWS})
+    now = datetime.combine(MONDAY, time(15, 10))
+    free = slots.free_slots(templates, {}, MONDAY - timedelta(days=1), 2, now=now)[1]
+    assert list(free) == ['2030-01-07']
+    assert free['2030-01-07'] == ['15:30', '16:00', '16:30']
+
+
+def test_fifty_doctors_fourteen_days_is_fast():
+    windows = {doctor_id: {day: [(8 * 60, 12 * 60), (13 * 60, 18 * 60)] for day in range(6)}
+               for doctor_id in range(50)}
+    appointments = [(doctor_id, MONDAY + timedelta(days=i % 14), time(8 + i % 10, 0))
+                    for doctor_id in range(50) for i in range(40)]
+
+    started = timer.perf_counter()
+    free = slots.free_slots(slots.build_templates(windows), slots.build_booked(appointments), MONDAY, 14)
+    elapsed = timer.perf_counter() - started
+
+    assert len(free) == 50
+    assert elapsed < 0.1, f'{elapsed * 1000:.1f}ms'
+
+
+def test_find_free_slots_uses_availability_and_appointments(sample_data):
+    doctor, other = sample_data['doctors']
+    patient = sample_data['patients'][0]
+    db.session.add(DoctorAvailability(doctor_id=doctor.id, day_of_week=0,
+                                      start_time=time(9, 0), end_time=time(10, 0)))
+    db.session.add(DoctorAvailability(doctor_id=doctor.id, day_of_week=1, is_available=False,
+                                      start_time=time(9, 0), end_time=time(17, 0)))
+    db.session.add(Appointment(patient_id=patient.id, doctor_id=doctor.id, status='pending',
+                               appointment_date=MONDAY, appointment_time=time(9, 30)))
+    db.session.add(Appointment(patient_id=patient.id, doctor_id=doctor.id, status='cancelled',
+                               appointment_date=MONDAY, appointment_time=time(9, 0)))
+    db.session.commit()
+
+    free = find_free_slots([doctor.id, other.id], MONDAY, 7)
+    assert free[doctor.id] == {'2030-01-07': ['09:00']}
+    # No published availability: default hours every day
+    assert len(free[other.id]) == 7
+    # ...but only for doctors that exist
+    assert find_free_slots([doctor.id, 9999], MONDAY, 7).keys() == {doctor.id}
+
+
+def test_slots_endpoint(client, sample_data):
+    doctor = sample_data['doctors'][0]
+    assert client.get(f'/api/slots?doctor_id={doctor.id}').status_code == 401
+
+    login_as(client, sample_data['patients'][0].user)
+    response = client.get(f'/api/slots?doctor_id={doctor.id}&start=2030-01-07&days=3')
+    data = response.get_json()
+    assert data['slot_minutes'] == slots.SLOT_MINUTES
+    assert sorted(data['doctors'][str(doctor.id)]) == ['2030-01-07', '2030-01-08', '2030-01-09']
+
+    assert client.get('/api/slots').status_code == 400
+    assert client.get(f'/api/slots?doctor_id={doctor.id}&days=365').status_code == 400
+    assert client.get(f'/api/slots?doctor_id={doctor.id}&start=tomorrow').status_code == 400
+
+
+def test_booking_rejects_unavailable_slots(client, sample_data):
+    doctor = sample_data['doctors'][0]
+    login_as(client, sample_data['patients'][0].user)
+    form = {'doctor_id': doctor.id, 'appointment_date': '2030-01-07', 'reason': 'Checkup'}
+
+    assert client.post('/book_appointment', data={**form, 'appointment_time': '09:00'}).status_code == 302
+    assert Appointment.query.filter_by(appointment_date=MONDAY).count() == 1
+
+    # Already booked, and outside the doctor's hours
+    client.post('/book_appointment', data={**form, 'appointment_time': '09:00'})
+    client.post('/book_appointment', data={**form, 'appointment_time': '22:00'})
+    assert Appointment.query.filter_by(appointment_date=MONDAY).count() == 1
@@ -0,0 +1,63 @@
+"""
+Per-request SQL instrumentation tests
+"""
+
+import pytest
+
+from app import app as flask_app, sql_stats
+from conftest import captured_selects, login_as
+
+
+@pytest.fixture
+def stats_app(app):
+    saved = dict(app.config)
+    sql_stats.reset()
+    yield app
+    app.config.update(saved)
+    app.debug = False
+    sql_stats.reset()
+
+
+def test_debug_headers_count_the_requests_queries(client, sample_data, stats_app):
+    stats_app.debug = True
+    login_as(client, sample_data['patients'][0].user)
+    client.get('/patient/dashboard')
+
+    with captured_selects() as statements:
+        response = client.get('/patient/dashboard')
+    assert int(response.headers['X-SQL-Queries']) == len(statements)
+    assert float(response.headers['X-SQL-Time-ms']) <= float(response.headers['X-Request-Time-ms'])
+
+    stats_app.debug = False
+    assert 'X-SQL-Queries' not in client.get('/patient/dashboard').headers
+
+
+def test_slow_requests_are_logged_with_statements(client, sample_data, stats_app):
+    stats_app.config['SQL_SLOW_REQUEST_MS'] = 0
+    login_as(client, sample_data['doctors'][0].user)
+    client.get('/appointments')
+
+    for handler in sql_stats.slow_log.handlers:
+        handler.flush()
+    with open(flask_app.config['SQL_SLOW_LOG']) as log:
+        entry = log.read().split('Slow request GET /appointments (appointments)')[-1]
+    assert 'queries in' in entry
+    assert 'SELECT appointment.id' in entry
+
+
+def test_stats_endpoint_needs_the_token(client, sample_data, stats_app):
+    assert client.get('/internal/sql-stats').status_code == 404
+
+    stats_app.config['SQL_STATS_TOKEN'] = 'sekret'
+    assert client.get('/internal/sql-stats', headers={'X-Stats-Token': 'wrong'}).status_code == 404
+    assert client.get('/internal/sql-stats?token=sekret').status_code == 404  # never from the URL
+
+    login_as(client, sample_data['hospital'].user)
+    for _ in range(3):
+        client.get('/hospital/dashboard')
+
+    report = client.get('/internal/sql-stats', headers={'X-Stats-Token': 'sekret'}).get_json()
+    row = report['endpoints']['hospital_dashboard']
+    assert row['requests'] == 3
+    assert row['max_queries'] >= row['avg_queries'] > 0
+    assert row['slowest_statement'].startswith('SELECT')